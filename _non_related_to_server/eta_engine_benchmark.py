@@ -0,0 +1,180 @@
+"""Check the single-pass ETA engine against the per-ticket estimate it replaced.
+
+Run from the repository root:
+
+    python _non_related_to_server/eta_engine_benchmark.py --tickets 500
+
+Random queues (some tickets partly baked, some already on the wait list,
+some with injected urgent breads) are fed to both implementations; every
+ticket's wait time and the selected best ticket must match. The script then
+times both at the requested queue length.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from application import eta_engine  # noqa: E402
+
+
+def legacy_wait_times(reservation_dict, time_per_bread, bread_counts, bread_last_ts, base_done_ids,
+                      urgent_by_ticket, baking_time_s, urgent_remaining_time, now, bread_ids):
+    """The estimate_wait_until closure as it was in current_ticket / calculate_ready_status."""
+    reservation_keys = sorted(reservation_dict.keys())
+
+    virtual_by_ticket = {}
+    for tid, counts in reservation_dict.items():
+        if int(tid) not in base_done_ids:
+            continue
+        base_total = int(sum(int(x) for x in counts))
+        if base_total > 0:
+            virtual_by_ticket[int(tid)] = base_total
+
+    def breads_made(tid):
+        return bread_counts.get(int(tid), 0) + virtual_by_ticket.get(int(tid), 0)
+
+    total_needed_by_ticket = {}
+    base_detail_by_ticket = {}
+    for tid, counts in reservation_dict.items():
+        base_detail = {bid: int(c) for bid, c in zip(bread_ids, counts)}
+        base_detail_by_ticket[int(tid)] = base_detail
+        extra = urgent_by_ticket.get(int(tid), {}) or {}
+        total_needed_by_ticket[int(tid)] = int(sum(base_detail.values())) + int(sum(int(v) for v in extra.values()))
+
+    avg_cook_time = (sum(time_per_bread.values()) // len(time_per_bread)) if time_per_bread else 0
+
+    def eff_of(tid):
+        eff = dict(base_detail_by_ticket.get(int(tid), {}))
+        for k, v in (urgent_by_ticket.get(int(tid), {}) or {}).items():
+            eff[k] = int(eff.get(k, 0)) + int(v)
+        return eff
+
+    def estimate_wait_until(tid):
+        need_total = int(total_needed_by_ticket.get(int(tid), 0))
+        if need_total <= 0:
+            return 0
+
+        made_total = breads_made(tid)
+        ready_at = eta_engine.bread_ready_at(
+            bread_counts.get(int(tid), 0), bread_last_ts.get(int(tid), 0.0), need_total,
+            virtual_by_ticket.get(int(tid), 0),
+        )
+        if ready_at is not None:
+            return max(0, int(ready_at - now))
+
+        if not bread_counts:
+            total_wait_s = int(baking_time_s)
+            for key in reservation_keys:
+                if int(key) > int(tid):
+                    break
+                total_wait_s += sum(int(c) * int(time_per_bread[str(b)]) for b, c in eff_of(key).items())
+            return int(total_wait_s + urgent_remaining_time)
+
+        if not made_total:
+            prep_time = sum(int(c) * int(time_per_bread[str(b)]) for b, c in eff_of(tid).items())
+            total_remaining_before = 0
+            for cid in [key for key in reservation_keys if int(key) < int(tid)]:
+                made = breads_made(cid)
+                needed = int(total_needed_by_ticket.get(cid, 0))
+                if made >= needed:
+                    continue
+                if made > 0:
+                    total_remaining_before += (needed - made) * int(avg_cook_time)
+                else:
+                    total_remaining_before += sum(
+                        int(c) * int(time_per_bread[str(b)]) for b, c in eff_of(cid).items()
+                    )
+            return int(total_remaining_before + prep_time + baking_time_s + urgent_remaining_time)
+
+        remaining = need_total - made_total
+        active_types = [int(time_per_bread[str(b)]) for b, c in eff_of(tid).items() if int(c) > 0]
+        this_avg = (sum(active_types) // len(active_types)) if active_types else int(avg_cook_time)
+        return int(remaining * this_avg + baking_time_s)
+
+    return {int(tid): int(estimate_wait_until(tid)) for tid in reservation_keys}
+
+
+def build_queue(tickets, rnd, now):
+    time_per_bread = {"1": 60, "2": 90, "3": 45, "10": 30}
+    bread_ids = sorted(time_per_bread)
+    reservation_dict, bread_counts, bread_last_ts, urgent_by_ticket = {}, {}, {}, {}
+    base_done_ids = set()
+    started = rnd.random() < 0.8
+    numbers = sorted(rnd.sample(range(1, tickets * 3), tickets))
+    for i, tid in enumerate(numbers):
+        counts = [rnd.choice((0, 0, 1, 2, 3)) for _ in bread_ids]
+        if rnd.random() < 0.05:
+            counts = [0] * len(bread_ids)
+        reservation_dict[tid] = counts
+        need = sum(counts)
+        if rnd.random() < 0.1:
+            extra = {b: rnd.randint(1, 2) for b in rnd.sample(bread_ids, 2)}
+            urgent_by_ticket[tid] = extra
+            need += sum(extra.values())
+        if rnd.random() < 0.05:
+            base_done_ids.add(tid)
+        # Only the head of the queue has breads in the oven.
+        if started and i < tickets // 10:
+            made = rnd.randint(0, need)
+            if made:
+                bread_counts[tid] = made
+                bread_last_ts[tid] = now + rnd.randint(-600, 600)
+    return dict(
+        reservation_dict=reservation_dict,
+        time_per_bread=time_per_bread,
+        bread_counts=bread_counts,
+        bread_last_ts=bread_last_ts,
+        base_done_ids=base_done_ids,
+        urgent_by_ticket=urgent_by_ticket,
+        baking_time_s=rnd.choice((0, 300, 900)),
+        urgent_remaining_time=rnd.choice((0, 0, 120)),
+        now=now,
+        bread_ids=bread_ids,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tickets", type=int, default=500)
+    parser.add_argument("--cases", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    now = 1_700_000_000.0
+
+    for case in range(args.cases):
+        queue = build_queue(rnd.randint(1, 40), rnd, now)
+        expected = legacy_wait_times(**queue)
+        got = eta_engine.compute_wait_times(**queue)
+        if expected != got:
+            diff = {t: (expected.get(t), got.get(t)) for t in expected if expected.get(t) != got.get(t)}
+            raise SystemExit(f"case {case}: wait times differ (legacy, engine): {diff}")
+        order = list(queue["reservation_dict"])
+        rnd.shuffle(order)
+        legacy_best = eta_engine.select_best_ticket(order, expected)
+        if legacy_best != eta_engine.select_best_ticket(order, got):
+            raise SystemExit(f"case {case}: best ticket differs")
+    print(f"parity: {args.cases} random queues match")
+
+    queue = build_queue(args.tickets, rnd, now)
+    started = time.perf_counter()
+    expected = legacy_wait_times(**queue)
+    legacy_s = time.perf_counter() - started
+    started = time.perf_counter()
+    got = eta_engine.compute_wait_times(**queue)
+    engine_s = time.perf_counter() - started
+    if expected != got:
+        raise SystemExit("benchmark queue: wait times differ")
+
+    print(
+        f"{args.tickets} queued tickets | legacy {legacy_s * 1000:.1f} ms | "
+        f"engine {engine_s * 1000:.1f} ms | speedup x{legacy_s / engine_s if engine_s else float('inf'):.1f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Check the Redis slot allocator (LUA_ISSUE_TICKET) against the original linear-scan one.
+
+Run from the repository root (needs ``pip install "fakeredis[lua]"`` and the
+usual settings environment, since redis_helper is imported):
+
+    python _non_related_to_server/slot_allocator_benchmark.py --tickets 3000
+
+Both allocators are fed the same simulated day (mix of single and multi
+tickets, customers being served while new tickets arrive) and must hand out
+exactly the same numbers; the queue state replayed from the event log must
+hold the same consumed numbers. The script then prints the time each one
+took (the Lua side runs in fakeredis' emulator, so its timing is only a
+rough upper bound of a real Redis).
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+try:
+    import fakeredis
+except ImportError:
+    raise SystemExit('This benchmark needs fakeredis: pip install "fakeredis[lua]"')
+
+from application.bakery_queue_model import BakeryQueueState  # noqa: E402
+from application.helpers import redis_helper  # noqa: E402
+
+BAKERY_ID = 1
+TIME_PER_BREAD = {"1": 60}
+
+
+class LegacyAllocator:
+    """The Python allocator as it was before allocation moved to Redis."""
+
+    def __init__(self):
+        self.current_served = 0
+        self.consumed_numbers = set()
+        self.single_parity = None
+        self.multi_parity = None
+
+    def _get_global_max(self) -> int:
+        return max(self.consumed_numbers) if self.consumed_numbers else 0
+
+    def _find_valid_slots(self, target_parity: int):
+        threshold = self.current_served
+        return [
+            n
+            for n in range(threshold + 1, self._get_global_max())
+            if n not in self.consumed_numbers and n % 2 == target_parity
+        ]
+
+    def _get_next_sequence_number(self, target_parity: int) -> int:
+        search = max(self._get_global_max(), self.current_served) + 1
+        while search % 2 != target_parity:
+            search += 1
+        return search
+
+    def issue(self, quantity: int) -> int:
+        kind = "single" if quantity == 1 else "multi"
+        if self.single_parity is None:
+            self.single_parity, self.multi_parity = (1, 0) if kind == "single" else (0, 1)
+        target_parity = self.single_parity if kind == "single" else self.multi_parity
+        valid_slots = self._find_valid_slots(target_parity)
+
+        if kind == "single":
+            consumed_slots = valid_slots[:1] or [self._get_next_sequence_number(target_parity)]
+        elif len(valid_slots) >= quantity:
+            consumed_slots = valid_slots[:quantity]
+        else:
+            consumed_slots = [self._get_next_sequence_number(target_parity)]
+
+        self.consumed_numbers.update(consumed_slots)
+        return consumed_slots[-1]
+
+
+def build_day(tickets, seed):
+    rnd = random.Random(seed)
+    ops = []
+    for _ in range(tickets):
+        if rnd.random() < 0.3:
+            ops.append(("multi", rnd.randint(2, 5)))
+        else:
+            ops.append(("single", 1))
+        # Serving falls behind issuance a little so free slots pile up.
+        ops.append(("serve", rnd.randint(0, 2)))
+    return ops
+
+
+def run_legacy(ops):
+    state = LegacyAllocator()
+    issued = []
+    started = time.perf_counter()
+    for kind, value in ops:
+        if kind == "serve":
+            state.current_served = min(state.current_served + value, state._get_global_max())
+            continue
+        issued.append(state.issue(value))
+    return issued, time.perf_counter() - started, state
+
+
+async def run_lua(ops):
+    r = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer(), decode_responses=True)
+    # Mark today's structures seeded so issue_ticket never falls back to the DB.
+    await r.hset(redis_helper.REDIS_KEY_QUEUE_META.format(BAKERY_ID), "seeded", 1)
+
+    issued = []
+    current_served = max_number = 0
+    started = time.perf_counter()
+    for kind, value in ops:
+        if kind == "serve":
+            current_served = min(current_served + value, max_number)
+            await redis_helper.set_current_served(r, BAKERY_ID, current_served)
+            continue
+        ticket_id, _ = await redis_helper.issue_ticket(r, BAKERY_ID, {"1": value}, TIME_PER_BREAD)
+        issued.append(ticket_id)
+        max_number = max(max_number, ticket_id)
+    elapsed = time.perf_counter() - started
+
+    state = await redis_helper.load_queue_state(r, BAKERY_ID)
+    return issued, elapsed, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tickets", type=int, default=3_000)
+    parser.add_argument("--days", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    for day in range(args.days):
+        ops = build_day(args.tickets, args.seed + day)
+        legacy_numbers, legacy_s, legacy = run_legacy(ops)
+        lua_numbers, lua_s, state = asyncio.run(run_lua(ops))
+
+        if legacy_numbers != lua_numbers:
+            first = next(i for i, (a, b) in enumerate(zip(legacy_numbers, lua_numbers)) if a != b)
+            raise SystemExit(
+                f"day {day}: allocators diverged at ticket #{first}: "
+                f"legacy={legacy_numbers[first]} lua={lua_numbers[first]}"
+            )
+
+        restored = BakeryQueueState.loads(state.dumps())
+        if restored.consumed_numbers != legacy.consumed_numbers or restored.max_number != legacy._get_global_max():
+            raise SystemExit(f"day {day}: replayed queue state does not match the issued numbers")
+
+        print(
+            f"day {day}: {args.tickets} tickets, max number {restored.max_number} | "
+            f"legacy {legacy_s * 1000:.1f} ms | lua (fakeredis) {lua_s * 1000:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
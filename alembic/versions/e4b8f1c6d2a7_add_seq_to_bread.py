@@ -0,0 +1,30 @@
+"""add seq to bread
+
+Revision ID: e4b8f1c6d2a7
+Revises: c3d7e9a4b1f2
+Create Date: 2026-10-17
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = 'e4b8f1c6d2a7'
+down_revision: Union[str, None] = 'c3d7e9a4b1f2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('bread', sa.Column('seq', sa.Integer(), nullable=True))
+    op.add_column('bread', sa.Column('baked_date', sa.Date(), nullable=True))
+    op.create_index('uq_bread_bakery_date_seq', 'bread', ['bakery_id', 'baked_date', 'seq'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index('uq_bread_bakery_date_seq', table_name='bread')
+    op.drop_column('bread', 'baked_date')
+    op.drop_column('bread', 'seq')
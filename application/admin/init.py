@@ -29,6 +29,6 @@ async def init_admin(
     logger.info(f"{FILE_NAME}:init_admin")
     msg = f"👤 Admin Init Succesful!\n\nphone number: {admin.phone_number}"
 
-    tasks.report_to_admin_api.delay(msg, message_thread_id=settings.INFO_THREAD_ID)
+    tasks.notify_admin(msg, message_thread_id=settings.INFO_THREAD_ID)
 
     return {"message": "Admin initialized successfully", "admin_id": admin_db.admin_id}
@@ -0,0 +1,261 @@
+"""Admin Telegram notifier.
+
+    python -m application.admin_notifier
+
+With ADMIN_NOTIFIER enabled tasks.notify_admin queues admin messages on the
+``admin_notifications`` Redis stream instead of sending one Telegram request
+per event. This process buffers them per thread and sends one digest per
+thread every ADMIN_NOTIFIER_DIGEST_S (errors and OTP codes go out at once),
+over a single HTTP session, at most ADMIN_NOTIFIER_RATE_PER_MIN messages a
+minute with bursts of ADMIN_NOTIFIER_BURST. A 429 from Telegram pauses
+sending for its retry_after.
+
+When more than ADMIN_NOTIFIER_MAX_PENDING messages are waiting, new
+low-priority ones (tickets, ratings, info) are only counted and show up as a
+"skipped" line in the next digest; errors are always kept.
+
+Point TELEGRAM_API_URL at a local HTTP stub to try it without Telegram.
+"""
+import asyncio
+import signal
+import time
+from collections import Counter, deque
+
+import httpx
+from redis import asyncio as aioredis
+
+from application.helpers import redis_helper
+from application.logger_config import celery_logger
+from application.setting import settings
+from application.tasks import telegram_proxy_url
+
+# endpoint_helper.report_to_admin levels (plus "otp") that skip the digest window.
+IMMEDIATE_CATEGORIES = {"error", "emergency_error", "hardware_error", "otp"}
+# Levels that are only counted under backpressure.
+LOW_PRIORITY_CATEGORIES = {"ticket", "rate", "info"}
+
+TELEGRAM_MAX_CHARS = 4096
+DIGEST_SEPARATOR = "\n\n———\n\n"
+SEND_ATTEMPTS = 3
+SEND_RETRY_DELAY_S = 5
+READ_BATCH = 200
+# Longest a read blocks while nothing is buffered.
+IDLE_BLOCK_MS = 5000
+
+
+class TokenBucket:
+    def __init__(self, rate_per_s: float, burst: int):
+        self.rate_per_s = float(rate_per_s)
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def take(self, now: float) -> float:
+        """Take a token; returns 0, or the seconds to wait before one is available."""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_s)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate_per_s if self.rate_per_s > 0 else 1.0
+
+    def pause(self, now: float, seconds: float):
+        """Send nothing for ``seconds``, then one message before refilling."""
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 1.0
+        self.updated_at = self.paused_until
+
+
+class _Digest:
+    """Messages waiting for one (thread, parse_mode)."""
+
+    def __init__(self, now: float):
+        self.first_at = now
+        self.texts: list[str] = []
+        self.skipped: Counter = Counter()
+        self.immediate = False
+
+
+class AdminNotifier:
+    """Buffers admin messages and turns them into Telegram-sized digests."""
+
+    def __init__(self, digest_s: float, max_pending: int):
+        self.digest_s = float(digest_s)
+        self.max_pending = int(max_pending)
+        self.digests: dict[tuple[int, str | None], _Digest] = {}
+        # (thread_id, parse_mode, text) ready to send, oldest first.
+        self.outgoing: deque[tuple[int, str | None, str]] = deque()
+
+    def pending(self) -> int:
+        return sum(len(d.texts) for d in self.digests.values()) + len(self.outgoing)
+
+    def add(self, note: dict, now: float):
+        key = (int(note["thread_id"]), note.get("parse_mode"))
+        digest = self.digests.get(key)
+        if digest is None:
+            digest = self.digests[key] = _Digest(now)
+        category = note.get("category") or "info"
+        if category in LOW_PRIORITY_CATEGORIES and self.pending() >= self.max_pending:
+            digest.skipped[category] += 1
+        else:
+            digest.texts.append(str(note["msg"]))
+        if category in IMMEDIATE_CATEGORIES:
+            digest.immediate = True
+
+    def flush_due(self, now: float) -> int:
+        """Move every digest that is due to ``outgoing``; returns the messages added."""
+        added = 0
+        for key, digest in list(self.digests.items()):
+            if digest.immediate or now - digest.first_at >= self.digest_s:
+                del self.digests[key]
+                for text in render_digest(digest.texts, digest.skipped):
+                    self.outgoing.append((key[0], key[1], text))
+                    added += 1
+        return added
+
+    def next_flush_at(self) -> float | None:
+        if not self.digests:
+            return None
+        return min(d.first_at + self.digest_s for d in self.digests.values())
+
+
+def render_digest(texts: list[str], skipped: Counter) -> list[str]:
+    """Pack ``texts`` into as few Telegram messages as fit."""
+    limit = TELEGRAM_MAX_CHARS - 100
+    texts = [t if len(t) <= limit else t[:limit - 1] + "…" for t in texts]
+    notes = [f"➕ {n} more {category} messages skipped (backpressure)" for category, n in sorted(skipped.items())]
+    if len(texts) == 1 and not notes:
+        return texts
+
+    parts = [f"🧾 Digest: {len(texts) + sum(skipped.values())} messages", *texts, *notes]
+    messages, current = [], ""
+    for part in parts:
+        if current and len(current) + len(DIGEST_SEPARATOR) + len(part) > TELEGRAM_MAX_CHARS:
+            messages.append(current)
+            current = part
+        else:
+            current = f"{current}{DIGEST_SEPARATOR}{part}" if current else part
+    if current:
+        messages.append(current)
+    return messages
+
+
+async def _post(client: httpx.AsyncClient, thread_id: int, parse_mode: str | None, text: str) -> httpx.Response:
+    json_data = {"chat_id": settings.TELEGRAM_CHAT_ID, "text": text, "message_thread_id": thread_id}
+    if parse_mode:
+        json_data["parse_mode"] = parse_mode
+    return await client.post(f"/bot{settings.TELEGRAM_TOKEN}/sendMessage", json=json_data)
+
+
+def _retry_after(response: httpx.Response) -> float:
+    try:
+        return float(response.json()["parameters"]["retry_after"])
+    except Exception:
+        return float(response.headers.get("Retry-After") or SEND_RETRY_DELAY_S)
+
+
+async def _send_loop(client: httpx.AsyncClient, notifier: AdminNotifier, bucket: TokenBucket, wake: asyncio.Event):
+    attempts = 0
+    while True:
+        if not notifier.outgoing:
+            wake.clear()
+            await wake.wait()
+            continue
+
+        wait_s = bucket.take(time.monotonic())
+        if wait_s > 0:
+            await asyncio.sleep(wait_s)
+            continue
+
+        thread_id, parse_mode, text = notifier.outgoing[0]
+        started_at = time.monotonic()
+        try:
+            response = await _post(client, thread_id, parse_mode, text)
+            if response.status_code == 429:
+                retry_after = _retry_after(response)
+                bucket.pause(time.monotonic(), retry_after)
+                celery_logger.warning("admin_notifier rate limited", extra={"retry_after": retry_after})
+                continue
+            response.raise_for_status()
+        except (httpx.HTTPError, OSError) as e:
+            attempts += 1
+            retryable = not isinstance(e, httpx.HTTPStatusError) or e.response.status_code >= 500
+            if retryable and attempts < SEND_ATTEMPTS:
+                celery_logger.warning(
+                    "admin_notifier send failed, retrying",
+                    extra={"thread_id": thread_id, "attempt": attempts, "error": str(e)},
+                )
+                bucket.pause(time.monotonic(), SEND_RETRY_DELAY_S)
+                continue
+            celery_logger.error(
+                "admin_notifier dropped message",
+                extra={"thread_id": thread_id, "attempts": attempts, "error": str(e), "text": text[:200]},
+            )
+        else:
+            celery_logger.info(
+                "admin_notifier sent",
+                extra={
+                    "thread_id": thread_id,
+                    "chars": len(text),
+                    "queued": len(notifier.outgoing) - 1,
+                    "duration_ms": round((time.monotonic() - started_at) * 1000, 2),
+                },
+            )
+        notifier.outgoing.popleft()
+        attempts = 0
+
+
+async def run():
+    r = aioredis.from_url(settings.REDIS_URL, decode_responses=True)
+    notifier = AdminNotifier(settings.ADMIN_NOTIFIER_DIGEST_S, settings.ADMIN_NOTIFIER_MAX_PENDING)
+    bucket = TokenBucket(settings.ADMIN_NOTIFIER_RATE_PER_MIN / 60, settings.ADMIN_NOTIFIER_BURST)
+    wake = asyncio.Event()
+    client = httpx.AsyncClient(base_url=settings.TELEGRAM_API_URL, proxy=telegram_proxy_url(), timeout=10)
+    sender = asyncio.create_task(_send_loop(client, notifier, bucket, wake))
+    celery_logger.info("admin_notifier started")
+    try:
+        while True:
+            flush_at = notifier.next_flush_at()
+            block_ms = IDLE_BLOCK_MS
+            if flush_at is not None:
+                block_ms = max(1, min(block_ms, int((flush_at - time.monotonic()) * 1000)))
+
+            now = time.monotonic()
+            for note in await redis_helper.take_admin_notifications(r, READ_BATCH, block_ms=block_ms):
+                notifier.add(note, now)
+            if notifier.flush_due(time.monotonic()):
+                wake.set()
+    finally:
+        sender.cancel()
+        try:
+            await sender
+        except asyncio.CancelledError:
+            pass
+        await client.aclose()
+        await r.aclose()
+        celery_logger.info("admin_notifier stopped", extra={"unsent": notifier.pending()})
+
+
+def main():
+    if not settings.ADMIN_NOTIFIER:
+        celery_logger.info("admin_notifier not started: needs ADMIN_NOTIFIER")
+        return
+
+    async def _main():
+        worker = asyncio.create_task(run())
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, worker.cancel)
+        try:
+            await worker
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(_main())
+
+
+if __name__ == "__main__":
+    main()
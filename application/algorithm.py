@@ -1,37 +1,8 @@
-from typing import List, Dict
 from application.helpers import redis_helper
-from application.bakery_queue_model import BakeryQueueState
 
 
 class Algorithm:
 
-    @staticmethod
-    async def new_reservation(reservation_dict: Dict[int, List[int]], bread_counts: List[int], r, bakery_id):
-        """
-        reservation_dict: {position: [bread_counts]}
-        bread_counts: list of bread counts (any length)
-        """
-        total = sum(bread_counts)
-
-        # Load full BakeryQueueState from Redis
-        queue_state: BakeryQueueState = await redis_helper.load_queue_state(r, bakery_id)
-
-        # Keep queue cutoff aligned with bread progress persisted in Redis.
-        redis_current_served = await redis_helper.get_effective_current_served(r, bakery_id)
-        if redis_current_served > queue_state.current_served:
-            queue_state.current_served = redis_current_served
-
-        # Issue ticket using exact BakeryQueue logic
-        if total == 1:
-            ticket = queue_state.issue_single()
-        else:
-            ticket = queue_state.issue_multi(quantity=total)
-
-        # Persist updated state back to Redis
-        await redis_helper.save_queue_state(r, bakery_id, queue_state)
-
-        return ticket.number
-
     @staticmethod
     def compute_bread_time(time_per_bread_list, reserve):
         return sum(
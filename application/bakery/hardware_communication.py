@@ -1,12 +1,11 @@
 from datetime import datetime, timedelta
-import time
-import json
 from fastapi import APIRouter, HTTPException, Header, Request, Depends
-from application.helpers.general_helpers import seconds_until_midnight_iran, generate_daily_customer_token
+from application.helpers.general_helpers import generate_daily_customer_token
 from application.helpers import endpoint_helper, redis_helper, token_helpers
-from application import tasks, algorithm, mqtt_client, crud, schemas
+from application import tasks, mqtt_client, crud, schemas
 from application.logger_config import logger
 from application.database import SessionLocal
+from application.setting import settings
 
 FILE_NAME = "bakery:hardware_communication"
 handle_errors = endpoint_helper.handle_endpoint_errors(FILE_NAME)
@@ -22,60 +21,36 @@ def validate_token(authorization: str = Header(...)) -> str:
     return authorization[len("Bearer "):]
 
 
-def _safe_json_map(raw_value):
-    if not raw_value:
-        return {}
-    try:
-        payload = json.loads(raw_value)
-        return payload if isinstance(payload, dict) else {}
-    except Exception:
-        return {}
-
-
-def _get_grouped_urgent_breads_for_tickets(bakery_id: int, ticket_ids: list[int], bread_names: dict) -> dict[int, dict[str, dict[str, int]]]:
+async def _get_grouped_urgent_breads_for_tickets(r, bakery_id: int, ticket_ids: list[int], bread_names: dict) -> dict[int, dict[str, dict[str, int]]]:
     if not ticket_ids:
         return {}
-    ticket_set = {int(x) for x in ticket_ids}
+    summary = await redis_helper.get_urgent_log_summary(r, bakery_id, ticket_ids)
     grouped: dict[int, dict[str, dict[str, int]]] = {}
-    with SessionLocal() as db:
-        rows = crud.get_today_urgent_bread_logs(db, bakery_id)
-
-    for row in rows or []:
-        if str(getattr(row, "status", "")) == "CANCELLED":
-            continue
-        tid_raw = getattr(row, "ticket_id", None)
-        if tid_raw is None:
-            continue
-        try:
-            tid = int(tid_raw)
-        except Exception:
-            continue
-        if tid not in ticket_set:
-            continue
 
-        urgent_map = _safe_json_map(getattr(row, "original_breads_json", None))
-        breads_named = {}
-        for bid_raw, count in (urgent_map or {}).items():
-            try:
-                count_int = int(count)
-            except Exception:
-                count_int = 0
-            if count_int <= 0:
+    for tid, by_id in summary.items():
+        for urgent_id, entry in by_id.items():
+            breads_named = {}
+            for bid_raw, count in (entry["breads"] or {}).items():
+                try:
+                    count_int = int(count)
+                except Exception:
+                    count_int = 0
+                if count_int <= 0:
+                    continue
+                try:
+                    bid_int = int(bid_raw)
+                except Exception:
+                    bid_int = None
+                name = bread_names.get(str(bid_int), str(bid_int)) if bid_int is not None else str(bid_raw)
+                breads_named[str(name)] = int(breads_named.get(str(name), 0)) + int(count_int)
+
+            if not breads_named:
                 continue
-            try:
-                bid_int = int(bid_raw)
-            except Exception:
-                bid_int = None
-            name = bread_names.get(str(bid_int), str(bid_int)) if bid_int is not None else str(bid_raw)
-            breads_named[str(name)] = int(breads_named.get(str(name), 0)) + int(count_int)
-
-        if not breads_named:
-            continue
-        grouped.setdefault(int(tid), {})[str(getattr(row, "urgent_id", ""))] = {
-            "breads": breads_named,
-            "is_prepared": str(getattr(row, "status", "")) == "DONE",
-            "reason": "",
-        }
+            grouped.setdefault(int(tid), {})[str(urgent_id)] = {
+                "breads": breads_named,
+                "is_prepared": entry["status"] == "DONE",
+                "reason": "",
+            }
 
     return grouped
 
@@ -128,26 +103,21 @@ async def new_ticket(
     if bread_count <= 0:
         raise HTTPException(status_code=400, detail="Ticket should have at least one bread")
 
-    breads_type, reservation_dict, upcoming_set = await redis_helper.get_bakery_runtime_state(r, bakery_id)
+    breads_type = await redis_helper.get_bakery_time_per_bread(r, bakery_id)
+    if not breads_type:
+        raise HTTPException(status_code=404, detail={"error": "this bakery does not have any bread"})
     if breads_type.keys() != bread_requirements.keys():
         raise HTTPException(status_code=400, detail="Invalid bread types")
 
-    if not reservation_dict:
-        reservation_dict = await redis_helper.get_bakery_reservations(r, bakery_id, fetch_from_redis_first=False, bakery_time_per_bread=breads_type)
-
-    bread_ids_sorted = sorted(breads_type.keys())
-    counts_list = [int(bread_requirements.get(bid, 0)) for bid in bread_ids_sorted]
-    customer_ticket_id = await algorithm.Algorithm.new_reservation(reservation_dict, counts_list, r, bakery_id)
-
-    customer_token = generate_daily_customer_token(bakery_id, customer_ticket_id)
-
-    success = await redis_helper.add_customer_to_reservation_dict(
-        r, customer.bakery_id, customer_ticket_id, bread_requirements, time_per_bread=breads_type
+    customer_ticket_id, success = await redis_helper.issue_ticket(
+        r, bakery_id, bread_requirements, time_per_bread=breads_type, note=note
     )
 
     if not success:
         raise HTTPException(status_code=400, detail=f"Ticket {customer_ticket_id} already exists")
 
+    customer_token = generate_daily_customer_token(bakery_id, customer_ticket_id)
+
     # customer_in_upcoming_customer = await redis_helper.maybe_add_customer_to_upcoming_zset(
     #     r, customer.bakery_id, customer_ticket_id, bread_requirements, upcoming_members=upcoming_set
     # )
@@ -170,7 +140,11 @@ async def new_ticket(
             await redis_helper.set_current_served(r, bakery_id, customer_ticket_id)
     
     logger.info(f"{FILE_NAME}:new_cusomer", extra={"bakery_id": customer.bakery_id, "bread_requirements": bread_requirements, "customer_in_upcoming_customer": customer_in_upcoming_customer, "show_on_display": show_on_display, "token": customer_token})
-    tasks.register_new_customer.delay(customer_ticket_id, customer.bakery_id, bread_requirements, customer_in_upcoming_customer, customer_token, note)
+    # With the outbox on, issue_ticket already queued register_new_customer.
+    if not settings.OUTBOX:
+        tasks.register_new_customer.delay(
+            customer_ticket_id, customer.bakery_id, bread_requirements, customer_in_upcoming_customer, customer_token, note
+        )
 
     await mqtt_client.publish_ticket_job(
         request,
@@ -221,16 +195,9 @@ async def serve_ticket(
     customer_id = ticket.customer_ticket_id
     r = request.app.state.redis
 
-    time_key = redis_helper.REDIS_KEY_TIME_PER_BREAD.format(bakery_id)
-    wait_list_key = redis_helper.REDIS_KEY_WAIT_LIST.format(bakery_id)
-    pipe1 = r.pipeline()
-    pipe1.hgetall(time_key)
-    pipe1.hget(wait_list_key, str(customer_id))
-    pipe1.hdel(wait_list_key, str(customer_id))
-
-    time_per_bread, wait_list_reservations, remove_customer_from_wait_list= await pipe1.execute()
+    time_per_bread, wait_list_reservations = await redis_helper.take_from_wait_list(r, bakery_id, customer_id)
 
-    if not remove_customer_from_wait_list or not wait_list_reservations:
+    if not wait_list_reservations:
         raise HTTPException(
             status_code=404,
             detail={
@@ -238,7 +205,8 @@ async def serve_ticket(
             }
         )
 
-    tasks.serve_wait_list_ticket.delay(customer_id, bakery_id)
+    if not settings.OUTBOX:
+        tasks.serve_wait_list_ticket.delay(customer_id, bakery_id)
     customer_reservations = list(map(int, wait_list_reservations.split(",")))
 
     bread_ids = list(time_per_bread.keys())
@@ -266,8 +234,8 @@ async def serve_ticket(
         key = bread_names.get(str(bid), str(bid)) if bread_names else str(bid)
         breads_by_name[str(key)] = int(breads_by_name.get(str(key), 0)) + int(count_int)
 
-    urgent_grouped = _get_grouped_urgent_breads_for_tickets(
-        bakery_id, [int(customer_id)], bread_names
+    urgent_grouped = await _get_grouped_urgent_breads_for_tickets(
+        r, bakery_id, [int(customer_id)], bread_names
     )
     urgent_grouped = await _fill_urgent_reasons_from_redis(r, bakery_id, urgent_grouped)
     urgent_breads = urgent_grouped.get(int(customer_id), {})
@@ -319,16 +287,9 @@ async def serve_ticket_by_token(
 
     customer_id = customer.ticket_id
 
-    time_key = redis_helper.REDIS_KEY_TIME_PER_BREAD.format(bakery_id)
-    wait_list_key = redis_helper.REDIS_KEY_WAIT_LIST.format(bakery_id)
-    pipe1 = r.pipeline()
-    pipe1.hgetall(time_key)
-    pipe1.hget(wait_list_key, str(customer_id))
-    pipe1.hdel(wait_list_key, str(customer_id))
-
-    time_per_bread, wait_list_reservations, remove_customer_from_wait_list = await pipe1.execute()
+    time_per_bread, wait_list_reservations = await redis_helper.take_from_wait_list(r, bakery_id, customer_id)
 
-    if not remove_customer_from_wait_list or not wait_list_reservations:
+    if not wait_list_reservations:
         raise HTTPException(
             status_code=404,
             detail={
@@ -336,7 +297,8 @@ async def serve_ticket_by_token(
             }
         )
 
-    tasks.serve_wait_list_ticket.delay(customer_id, bakery_id)
+    if not settings.OUTBOX:
+        tasks.serve_wait_list_ticket.delay(customer_id, bakery_id)
     customer_reservations = list(map(int, wait_list_reservations.split(",")))
 
     bread_ids = list(time_per_bread.keys())
@@ -364,8 +326,8 @@ async def serve_ticket_by_token(
         key = bread_names.get(str(bid), str(bid)) if bread_names else str(bid)
         breads_by_name[str(key)] = int(breads_by_name.get(str(key), 0)) + int(count_int)
 
-    urgent_grouped = _get_grouped_urgent_breads_for_tickets(
-        bakery_id, [int(customer_id)], bread_names
+    urgent_grouped = await _get_grouped_urgent_breads_for_tickets(
+        r, bakery_id, [int(customer_id)], bread_names
     )
     urgent_grouped = await _fill_urgent_reasons_from_redis(r, bakery_id, urgent_grouped)
     urgent_breads = urgent_grouped.get(int(customer_id), {})
@@ -427,186 +389,38 @@ async def current_ticket(
 
     time_key = redis_helper.REDIS_KEY_TIME_PER_BREAD.format(bakery_id)
     order_key = redis_helper.REDIS_KEY_RESERVATION_ORDER.format(bakery_id)
-    res_key = redis_helper.REDIS_KEY_RESERVATIONS.format(bakery_id)
-    breads_key = redis_helper.REDIS_KEY_BREADS.format(bakery_id)
-    baking_time_key = redis_helper.REDIS_KEY_BAKING_TIME_S.format(bakery_id)
-    base_done_key = redis_helper.REDIS_KEY_BASE_DONE.format(bakery_id)
 
     pipe1 = r.pipeline()
-    pipe1.zrange(order_key, 0, -1)
+    pipe1.exists(order_key)
     pipe1.hgetall(time_key)
-    pipe1.hgetall(res_key)
-    pipe1.get(baking_time_key)
-    pipe1.zrangebyscore(breads_key, '-inf', '+inf')
-    pipe1.smembers(base_done_key)
-    order_ids_raw, time_per_bread, reservations_map, baking_time_s_raw, all_breads, base_done_raw = await pipe1.execute()
+    has_order, time_per_bread = await pipe1.execute()
 
-    if not order_ids_raw:
+    if not has_order:
         await mqtt_client.update_has_customer_in_queue(request, bakery_id, False)
         return {"has_customer_in_queue": False}
 
     if not time_per_bread:
         raise HTTPException(status_code=404, detail={"error": "empty bread type"})
 
-    if not reservations_map:
-        raise HTTPException(status_code=404, detail={"error": "reservation is empty"})
-
-    def _as_text(v):
-        if v is None:
-            return None
-        if isinstance(v, (bytes, bytearray)):
-            return v.decode()
-        return str(v)
-
     time_per_bread = {str(k): int(v) for k, v in time_per_bread.items()}
     bread_ids_sorted = sorted(time_per_bread.keys())
 
-    base_done_ids = set(int(_as_text(x)) for x in (base_done_raw or []) if _as_text(x) is not None)
-    baking_time_s = int(baking_time_s_raw) if baking_time_s_raw else 0
-
-    order_ids = [int(x) for x in order_ids_raw]
-    reservation_dict = {int(k): [int(x) for x in v.split(',')] for k, v in reservations_map.items()}
-    reservation_keys = sorted(reservation_dict.keys())
-
-    breads_by_customer = defaultdict(list)
-    for bread_value in all_breads:
-        if ':' not in str(bread_value):
-            continue
-        try:
-            parts = str(bread_value).split(':')
-            if len(parts) < 2:
-                continue
-            timestamp_str = parts[0]
-            cid_str = parts[-1]
-            customer_id = int(cid_str)
-            breads_by_customer[customer_id].append(float(timestamp_str))
-        except Exception:
-            continue
-
-    for cid in breads_by_customer:
-        breads_by_customer[cid].sort()
-
-    # Tickets that moved to wait list have their baked breads removed from Redis.
-    # Use base_done marker to treat base breads as already baked (timestamp=0.0).
-    for tid, counts in reservation_dict.items():
-        if int(tid) not in base_done_ids:
-            continue
-        base_total = int(sum(int(x) for x in counts))
-        if base_total <= 0:
-            continue
-        existing = breads_by_customer.get(int(tid), [])
-        breads_by_customer[int(tid)] = sorted(([0.0] * base_total) + list(existing))
-
-    urgent_by_ticket = await redis_helper.get_urgent_breads_by_ticket(r, bakery_id, time_per_bread)
-    urgent_remaining_time = await redis_helper.get_urgent_remaining_total_time(r, bakery_id, time_per_bread)
-
-    # Precompute total breads needed per ticket (base + injected urgent totals)
-    total_needed_by_ticket = {}
-    base_detail_by_ticket = {}
-    for tid, counts in reservation_dict.items():
-        base_detail = {bid: int(c) for bid, c in zip(bread_ids_sorted, counts)}
-        base_detail_by_ticket[int(tid)] = base_detail
-        extra = urgent_by_ticket.get(int(tid), {}) or {}
-        total_needed_by_ticket[int(tid)] = int(sum(base_detail.values())) + int(sum(int(v) for v in extra.values()))
-
-    now = time.time()
-    avg_cook_time = (sum(time_per_bread.values()) // len(time_per_bread)) if time_per_bread else 0
-
-    def estimate_wait_until(tid: int) -> int:
-        need_total = int(total_needed_by_ticket.get(int(tid), 0))
-        if need_total <= 0:
-            return 0
+    # Pick the ticket that will be ready the soonest (precomputed ETA table)
+    eta_meta, = await redis_helper.get_eta_table_fields(r, bakery_id)
+    if not eta_meta or not eta_meta.get("size"):
+        raise HTTPException(status_code=404, detail={"error": "reservation is empty"})
 
-        breads_ts = breads_by_customer.get(int(tid), [])
-        if breads_ts and len(breads_ts) >= need_total:
-            ready_at = float(breads_ts[need_total - 1])
-            return max(0, int(ready_at - now))
-
-        # Case1: no breads exist at all
-        if not all_breads:
-            total_wait_s = int(baking_time_s)
-            for key in reservation_keys:
-                if int(key) > int(tid):
-                    break
-                base_counts = reservation_dict[int(key)]
-                base_detail = {bid: int(c) for bid, c in zip(bread_ids_sorted, base_counts)}
-                extra = urgent_by_ticket.get(int(key), {}) or {}
-                eff = dict(base_detail)
-                for k, v in extra.items():
-                    eff[k] = int(eff.get(k, 0)) + int(v)
-                total_wait_s += sum(int(count) * int(time_per_bread[str(bid)]) for bid, count in eff.items())
-            if urgent_remaining_time:
-                total_wait_s += int(urgent_remaining_time)
-            return int(total_wait_s)
-
-        # Case2: some breads exist, but none for this customer
-        if not breads_ts:
-            base_detail = dict(base_detail_by_ticket.get(int(tid), {}))
-            extra = urgent_by_ticket.get(int(tid), {}) or {}
-            eff = dict(base_detail)
-            for k, v in extra.items():
-                eff[k] = int(eff.get(k, 0)) + int(v)
-
-            prep_time = sum(int(count) * int(time_per_bread[str(bid)]) for bid, count in eff.items())
-
-            total_remaining_before = 0
-            for cid in [key for key in reservation_keys if int(key) < int(tid)]:
-                cid = int(cid)
-                made = len(breads_by_customer.get(cid, []))
-                needed = int(total_needed_by_ticket.get(cid, 0))
-                if made >= needed:
-                    continue
-                if made > 0:
-                    total_remaining_before += (needed - made) * int(avg_cook_time)
-                else:
-                    base_detail_prev = dict(base_detail_by_ticket.get(cid, {}))
-                    extra_prev = urgent_by_ticket.get(cid, {}) or {}
-                    eff_prev = dict(base_detail_prev)
-                    for k, v in extra_prev.items():
-                        eff_prev[k] = int(eff_prev.get(k, 0)) + int(v)
-                    total_remaining_before += sum(
-                        int(count) * int(time_per_bread[str(bid)])
-                        for bid, count in eff_prev.items()
-                    )
-
-            total_wait_s = int(total_remaining_before) + int(prep_time) + int(baking_time_s)
-            if urgent_remaining_time:
-                total_wait_s += int(urgent_remaining_time)
-            return int(total_wait_s)
-
-        # Case3: partially prepared for this ticket
-        remaining = need_total - len(breads_ts)
-        active_types = []
-        base_detail = dict(base_detail_by_ticket.get(int(tid), {}))
-        extra = urgent_by_ticket.get(int(tid), {}) or {}
-        eff = dict(base_detail)
-        for k, v in extra.items():
-            eff[k] = int(eff.get(k, 0)) + int(v)
-
-        for bread_type, count in eff.items():
-            if int(count) > 0:
-                active_types.append(int(time_per_bread[str(bread_type)]))
-        this_avg = (sum(active_types) // len(active_types)) if active_types else int(avg_cook_time)
-
-        return int(remaining * this_avg + baking_time_s)
-
-    # Pick the ticket that will be ready the soonest
-    best_tid = None
-    best_wait = None
-    for tid in order_ids:
-        if tid not in reservation_dict:
-            continue
-        w = int(estimate_wait_until(int(tid)))
-        if best_wait is None or w < best_wait or (w == best_wait and int(tid) < int(best_tid)):
-            best_tid = int(tid)
-            best_wait = int(w)
+    best = redis_helper.select_best_eta_ticket(eta_meta)
+    best_tid, best_wait = best if best else (None, None)
 
     if best_tid is None:
         await mqtt_client.update_has_customer_in_queue(request, bakery_id, False)
         return {"has_customer_in_queue": False}
 
-    calc_counts = reservation_dict[int(best_tid)]
-    calc_user_breads = {bid: int(count) for bid, count in zip(bread_ids_sorted, calc_counts)}
+    # Read from the same _meta as the pick: a refresh in between cannot drop the row.
+    best_row = (eta_meta.get("rows") or {}).get(str(best_tid)) or {}
+
+    calc_counts = [int(x) for x in best_row.get("counts") or []]
 
     display_counts = list(calc_counts)
     if display_counts and all(int(x) == 0 for x in display_counts):
@@ -616,7 +430,7 @@ async def current_ticket(
         display_counts = [int(bread_counts.get(int(bid), 0)) for bid in bread_ids_sorted]
     display_user_breads = {bid: int(count) for bid, count in zip(bread_ids_sorted, display_counts)}
 
-    urgent_breads = urgent_by_ticket.get(int(best_tid), {})
+    urgent_breads = best_row.get("urgent_breads") or {}
     ready = bool(best_wait == 0)
 
     return {
@@ -642,41 +456,27 @@ async def send_ticket_to_wait_list(
 
     r = request.app.state.redis
 
-    order_key = redis_helper.REDIS_KEY_RESERVATION_ORDER.format(bakery_id)
-    res_key = redis_helper.REDIS_KEY_RESERVATIONS.format(bakery_id)
-
     best = await redis_helper.select_best_ticket_by_ready_time(r, int(bakery_id))
     if not best:
         raise HTTPException(status_code=404, detail={'status': 'The queue is empty'})
     customer_id = int(best["ticket_id"])
 
-    pipe = r.pipeline()
-    pipe.hget(res_key, str(customer_id))
-    pipe.hdel(res_key, customer_id)
-    pipe.zrem(order_key, customer_id)
-    current_customer_reservation, r1, r2 = await pipe.execute()
+    # Queue -> wait list, user-facing current ticket, bread consumption and served mark in one step
+    [(_, moved, _, removed)] = await redis_helper.send_tickets_to_wait_list(
+        r, int(bakery_id), [customer_id], source="manual_endpoint"
+    )
 
-    if not bool(r1 and r2):
+    if not moved:
         reservation_list = await redis_helper.get_bakery_reservations(r, bakery_id, fetch_from_redis_first=False)
         if not reservation_list:
             raise HTTPException(status_code=404, detail={'status': 'The queue is empty'})
-        status, current_customer_reservation = await redis_helper.remove_customer_id_from_reservation(r, bakery_id, customer_id)
-        if not status: raise HTTPException(status_code=401, detail="invalid customer_id")
-
-    queue_state = await redis_helper.load_queue_state(r, bakery_id)
-    queue_state.mark_ticket_served(customer_id)
-    await redis_helper.save_queue_state(r, bakery_id, queue_state)
-
-    await redis_helper.add_customer_to_wait_list(r, bakery_id, customer_id, reservations_str=current_customer_reservation)
-
-    # Update user-facing current ticket only when this ticket is ready to be served.
-    await redis_helper.set_user_current_ticket(r, bakery_id, customer_id)
+        [(_, moved, _, removed)] = await redis_helper.send_tickets_to_wait_list(
+            r, int(bakery_id), [customer_id], source="manual_endpoint"
+        )
+        if not moved: raise HTTPException(status_code=401, detail="invalid customer_id")
 
     await mqtt_client.call_customer(request, bakery_id, customer_id)
-    
-    # Consume breads for this customer before rebuilding prep_state
-    removed = await redis_helper.consume_ready_breads(r, bakery_id, customer_id)
-    
+
     # Rebuild prep_state immediately after removing customer to prevent race condition
     # where new_bread endpoint reads stale prep_state with removed customer ID
     await redis_helper.rebuild_prep_state(r, bakery_id)
@@ -697,20 +497,23 @@ async def send_ticket_to_wait_list(
         customer_reservation = await redis_helper.get_current_cusomter_detail(r, bakery_id, next_ticket_id, time_per_bread, customer_reservation)
         next_user_detail = await redis_helper.get_customer_reservation_detail(time_per_bread, customer_reservation)
 
-    db_waitlist_task = tasks.send_ticket_to_wait_list.delay(customer_id, bakery_id, "manual_endpoint")
-    logger.info(
-        "Queued DB wait-list sync task",
-        extra={"bakery_id": int(bakery_id), "customer_id": int(customer_id), "task_id": db_waitlist_task.id},
-    )
+    if not settings.OUTBOX:
+        db_waitlist_task = tasks.send_ticket_to_wait_list.delay(customer_id, bakery_id, "manual_endpoint")
+        logger.info(
+            "Queued DB wait-list sync task",
+            extra={"bakery_id": int(bakery_id), "customer_id": int(customer_id), "task_id": db_waitlist_task.id},
+        )
 
     if any(bread in time_per_bread.keys() for bread in upcoming_breads):
-        await redis_helper.remove_customer_from_upcoming_customers(r, bakery_id, customer_id)
-        tasks.remove_customer_from_upcoming_customers.delay(customer_id, bakery_id)
+        await redis_helper.remove_customer_from_upcoming_customers(r, bakery_id, customer_id, outbox=settings.OUTBOX)
+        if not settings.OUTBOX:
+            tasks.remove_customer_from_upcoming_customers.delay(customer_id, bakery_id)
 
-    # Mark breads as consumed in the database as well
-    with SessionLocal() as db:
-        consumed_count = crud.consume_breads_for_customer_today(db, bakery_id, customer_id)
-        logger.info(f"Marked {consumed_count} breads as consumed in DB for ticket {customer_id}")
+    # Mark breads as consumed in the database as well (the outbox entry does this itself)
+    if not settings.OUTBOX:
+        with SessionLocal() as db:
+            consumed_count = crud.consume_breads_for_customer_today(db, bakery_id, customer_id)
+            logger.info(f"Marked {consumed_count} breads as consumed in DB for ticket {customer_id}")
 
     logger.info(f"Removed {removed} breads for ticket {customer_id}")
     logger.info(f"{FILE_NAME}:send_ticket_to_wait_list", extra={"bakery_id": bakery_id, "customer_id": customer_id})
@@ -769,7 +572,7 @@ async def current_cook_customer(
     current_served_key = redis_helper.REDIS_KEY_CURRENT_SERVED.format(bakery_id)
     urgent_prep_key = redis_helper.REDIS_KEY_URGENT_PREP_STATE.format(bakery_id)
     urgent_queue_key = redis_helper.REDIS_KEY_URGENT_QUEUE.format(bakery_id)
-    breads_key = redis_helper.REDIS_KEY_BREADS.format(bakery_id)
+    bread_counts_key = redis_helper.REDIS_KEY_BREAD_COUNTS.format(bakery_id)
     time_key = redis_helper.REDIS_KEY_TIME_PER_BREAD.format(bakery_id)
     res_key = redis_helper.REDIS_KEY_RESERVATIONS.format(bakery_id)
     order_key = redis_helper.REDIS_KEY_RESERVATION_ORDER.format(bakery_id)
@@ -785,10 +588,10 @@ async def current_cook_customer(
     pipe.hgetall(res_key)
     pipe.hgetall(bread_name_key)
     pipe.zrange(order_key, 0, -1)
-    pipe.zrangebyscore(breads_key, '-inf', '+inf')  # Get all breads to count per customer
+    pipe.hgetall(bread_counts_key)  # Breads already made per customer
     pipe.smembers(base_done_key)
 
-    prep_state_str, current_served_raw, urgent_processing_raw, urgent_next_raw, time_per_bread, reservations_map, bread_names_raw, order_ids, all_breads, base_done_raw = await pipe.execute()
+    prep_state_str, current_served_raw, urgent_processing_raw, urgent_next_raw, time_per_bread, reservations_map, bread_names_raw, order_ids, bread_counts_raw, base_done_raw = await pipe.execute()
 
     def _as_text(v):
         if v is None:
@@ -826,20 +629,8 @@ async def current_cook_customer(
 
     base_done_ids = set(int(_as_text(x)) for x in (base_done_raw or []) if _as_text(x) is not None)
 
-    # Count breads already made per customer
-    breads_per_customer = {}
-    for bread_value in all_breads:
-        bread_value = _as_text(bread_value)
-        if not bread_value or ':' not in bread_value:
-            continue
-        try:
-            parts = str(bread_value).split(':')
-            if len(parts) < 2:
-                continue
-            cid = int(parts[-1])
-        except Exception:
-            continue
-        breads_per_customer[cid] = breads_per_customer.get(cid, 0) + 1
+    # Breads already made per customer
+    breads_per_customer, _ = redis_helper.decode_bread_index(bread_counts_raw, None)
 
     # If base is already complete for a ticket, treat its base breads as fully baked
     # even if breads were consumed from Redis when the ticket moved to wait list.
@@ -999,7 +790,7 @@ async def current_cook_customer(
                 return {
                     "customer_id": tid,
                     "original_breads": {"breads": _base_breads_by_name(tid), "is_prepared": bool(tid in base_done_ids), "note": str(note_map.get(int(tid), ""))},
-                    "urgent_breads": (await _fill_urgent_reasons_from_redis(r, bakery_id, _get_grouped_urgent_breads_for_tickets(bakery_id, [int(tid)], bread_names))).get(int(tid), {}),
+                    "urgent_breads": (await _fill_urgent_reasons_from_redis(r, bakery_id, await _get_grouped_urgent_breads_for_tickets(r, bakery_id, [int(tid)], bread_names))).get(int(tid), {}),
                     "next_customer": False,
                     "urgent": True,
                     "urgent_id": urgent_id,
@@ -1052,7 +843,7 @@ async def current_cook_customer(
             return {
                 "customer_id": tid,
                 "original_breads": {"breads": _base_breads_by_name(tid) if tid > 0 else {}, "is_prepared": bool(tid > 0 and tid in base_done_ids), "note": str(note_map.get(int(tid), "")) if tid > 0 else ""},
-                "urgent_breads": (await _fill_urgent_reasons_from_redis(r, bakery_id, _get_grouped_urgent_breads_for_tickets(bakery_id, [int(tid)], bread_names))).get(int(tid), {}) if tid > 0 else {str(urgent_id): {"breads": _counts_to_name_map(original_counts), "is_prepared": False, "reason": reason_text}},
+                "urgent_breads": (await _fill_urgent_reasons_from_redis(r, bakery_id, await _get_grouped_urgent_breads_for_tickets(r, bakery_id, [int(tid)], bread_names))).get(int(tid), {}) if tid > 0 else {str(urgent_id): {"breads": _counts_to_name_map(original_counts), "is_prepared": False, "reason": reason_text}},
                 "next_customer": False,
                 "urgent": True,
                 "urgent_id": urgent_id,
@@ -1125,7 +916,7 @@ async def current_cook_customer(
         response = {
             "customer_id": tid,
             "original_breads": {"breads": _base_breads_by_name(tid), "is_prepared": bool(tid in base_done_ids), "note": str(note_map.get(int(tid), ""))},
-            "urgent_breads": (await _fill_urgent_reasons_from_redis(r, bakery_id, _get_grouped_urgent_breads_for_tickets(bakery_id, [int(tid)], bread_names))).get(int(tid), {}),
+            "urgent_breads": (await _fill_urgent_reasons_from_redis(r, bakery_id, await _get_grouped_urgent_breads_for_tickets(r, bakery_id, [int(tid)], bread_names))).get(int(tid), {}),
             "next_customer": False,
             "urgent": False,
         }
@@ -1151,7 +942,7 @@ async def current_cook_customer(
                 return {
                     "customer_id": tid,
                     "original_breads": {"breads": _base_breads_by_name(tid) if tid > 0 else {}, "is_prepared": bool(tid > 0 and tid in base_done_ids), "note": str(note_map.get(int(tid), "")) if tid > 0 else ""},
-                    "urgent_breads": (await _fill_urgent_reasons_from_redis(r, bakery_id, _get_grouped_urgent_breads_for_tickets(bakery_id, [int(tid)], bread_names))).get(int(tid), {}) if tid > 0 else {str(urgent_id): {"breads": _counts_to_name_map(original_counts), "is_prepared": False, "reason": reason_text}},
+                    "urgent_breads": (await _fill_urgent_reasons_from_redis(r, bakery_id, await _get_grouped_urgent_breads_for_tickets(r, bakery_id, [int(tid)], bread_names))).get(int(tid), {}) if tid > 0 else {str(urgent_id): {"breads": _counts_to_name_map(original_counts), "is_prepared": False, "reason": reason_text}},
                     "next_customer": False,
                     "urgent": True,
                     "urgent_id": urgent_id,
@@ -1177,114 +968,29 @@ async def new_bread(
 
     r = request.app.state.redis
 
-    # 1. BRAIN: Decision & Archive
-    await redis_helper.rebuild_prep_state(r, bakery_id)
-
-    # 2. FETCH LOCK
-    pipe = r.pipeline()
-    pipe.get(redis_helper.REDIS_KEY_PREP_STATE.format(bakery_id))
-    pipe.get(redis_helper.REDIS_KEY_URGENT_PREP_STATE.format(bakery_id))
-    prep_raw, u_prep_raw = await pipe.execute()
-
-    def _t(v): return v.decode() if isinstance(v, (bytes, bytearray)) else (str(v) if v else None)
-    response = None
-
-    # --- EXECUTION: URGENT ---
-    if u_prep_raw:
-        urgent_id = _t(u_prep_raw)
-        time_per_bread = await redis_helper.get_bakery_time_per_bread(r, bakery_id)
-        urgent_state = await redis_helper.consume_one_urgent_bread(r, bakery_id, time_per_bread)
-        
-        if urgent_state:
-            tasks.log_urgent_remaining.delay(bakery_id, urgent_id, urgent_state.get("remaining_by_type") or {}, bool(urgent_state.get("done")))
-            
-            u_item_key = redis_helper.get_urgent_item_key(bakery_id, urgent_id)
-            pipe_u = r.pipeline()
-            pipe_u.hget(u_item_key, "ticket_id")
-            pipe_u.hget(u_item_key, "original_breads")
-            tid_raw, orig_raw = await pipe_u.execute()
-            
-            # Register Urgent Bread (ticket-linked or standalone as empty ticket=0)
-            tid = int(_t(tid_raw)) if tid_raw else 0
-            b_key = redis_helper.REDIS_KEY_BREADS.format(bakery_id)
-            b_time_key = redis_helper.REDIS_KEY_BAKING_TIME_S.format(bakery_id)
-
-            pipe_m = r.pipeline()
-            pipe_m.get(b_time_key)
-            pipe_m.zrevrange(b_key, 0, 0, withscores=True)
-            b_time_s_raw, last_b_data = await pipe_m.execute()
-
-            b_time_s = int(b_time_s_raw or 0)
-            idx = int(last_b_data[0][1]) + 1 if last_b_data else 1
-            now_ts = int(time.time())
-            cook_ts = now_ts + b_time_s
-            ttl = seconds_until_midnight_iran()
-
-            await r.zadd(b_key, {f"{cook_ts}:{idx}:{tid}": idx})
-            await r.expire(b_key, ttl)
-
-            b_ids = sorted(time_per_bread.keys())
-            orig_c = [int(x) for x in _t(orig_raw).split(",") if x] if orig_raw else []
-            if len(orig_c) < len(b_ids): orig_c += [0] * (len(b_ids) - len(orig_c))
-            
-            response = {
-                "customer_id": int(_t(tid_raw)) if tid_raw else 0,
-                "customer_breads": {bid: c for bid, c in zip(b_ids, orig_c)},
-                "next_customer": False,
-                "urgent": True,
-                "urgent_id": urgent_id,
-            }
+    # Decide, bake and advance prep state in one atomic script
+    result = await redis_helper.bake_one_bread(r, bakery_id)
 
-    # --- EXECUTION: NORMAL ---
-    elif prep_raw:
-        prep_str = _t(prep_raw)
-        if prep_str and ':' in prep_str:
-            ticket_id, current_progress = map(int, prep_str.split(':'))
-            
-            # --- Bake Normal Bread ---
-            b_time_key = redis_helper.REDIS_KEY_BAKING_TIME_S.format(bakery_id)
-            b_key = redis_helper.REDIS_KEY_BREADS.format(bakery_id)
-            last_t_key = redis_helper.REDIS_KEY_LAST_BREAD_TIME.format(bakery_id)
-            diff_key = redis_helper.REDIS_KEY_BREAD_TIME_DIFFS.format(bakery_id)
-            
-            pipe_m = r.pipeline()
-            pipe_m.get(b_time_key)
-            pipe_m.zrevrange(b_key, 0, 0, withscores=True)
-            pipe_m.get(last_t_key)
-            b_time_s_raw, last_b_data, last_ts = await pipe_m.execute()
-            
-            b_time_s = int(b_time_s_raw or 0)
-            idx = int(last_b_data[0][1]) + 1 if last_b_data else 1
-            now_ts = int(time.time())
-            cook_ts = now_ts + b_time_s
-            ttl = seconds_until_midnight_iran()
-            
-            pipe_w = r.pipeline(transaction=True)
-            pipe_w.zadd(b_key, {f"{cook_ts}:{idx}:{ticket_id}": idx})
-            pipe_w.expire(b_key, ttl)
-            pipe_w.set(last_t_key, now_ts, ex=ttl)
-            if last_ts: pipe_w.zadd(diff_key, {str(idx): now_ts - int(float(_t(last_ts)))})
-            pipe_w.set(redis_helper.REDIS_KEY_PREP_STATE.format(bakery_id), f"{ticket_id}:{current_progress + 1}", ex=ttl)
-            await pipe_w.execute()
-
-            tasks.save_bread_to_db.delay(ticket_id, bakery_id, cook_ts)
-
-            # --- RESPONSE FIX: Send Total (Base + Urgent) Counts ---
-            time_per_bread = await redis_helper.get_bakery_time_per_bread(r, bakery_id)
-            total_reqs = await redis_helper.get_tickets_total_bread_counts(r, bakery_id, [ticket_id], time_per_bread)
-            
-            response = {
-                "customer_id": ticket_id,
-                "customer_breads": total_reqs.get(ticket_id, {}),
-                "next_customer": False,
-            }
+    if settings.OUTBOX:
+        # bake_one_bread already queued the DB writes in the bakery outbox.
+        return result["response"]
 
-    if response is None:
-        response = {"has_customer": False, "belongs_to_customer": False}
+    urgent_log = result.get("urgent_log")
+    if urgent_log:
+        tasks.log_urgent_remaining.delay(
+            bakery_id, urgent_log["urgent_id"], urgent_log["remaining_by_type"], bool(urgent_log["done"])
+        )
 
-    await redis_helper.rebuild_prep_state(r, bakery_id)
+    bread = result.get("bread")
+    if bread:
+        if settings.BREAD_WRITER:
+            await redis_helper.enqueue_bread_write(r, bakery_id, bread)
+        else:
+            tasks.save_bread_to_db.delay(
+                bread["ticket_id"], bakery_id, bread["cook_ts"], bread["idx"], bread["pressed_at"]
+            )
 
-    return response
+    return result["response"]
 
 
 @router.get('/hardware_init')
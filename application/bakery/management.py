@@ -6,6 +6,7 @@ from application.helpers import database_helper, endpoint_helper, redis_helper
 from application import mqtt_client, crud, schemas, tasks
 from application import models
 from sqlalchemy.exc import IntegrityError
+from application.setting import settings
 import json
 from datetime import datetime, time
 import pytz
@@ -157,7 +158,8 @@ async def urgent_inject(
         reason=reason,
     )
 
-    tasks.log_urgent_inject.delay(bakery_id, urgent_id, ticket_id, bread_requirements, reason)
+    if not settings.OUTBOX:
+        tasks.log_urgent_inject.delay(bakery_id, urgent_id, ticket_id, bread_requirements, reason)
 
     await redis_helper.rebuild_prep_state(r, bakery_id)
 
@@ -216,7 +218,8 @@ async def urgent_edit(
     if not ok:
         raise HTTPException(status_code=400, detail={"error": "Urgent item cannot be edited (not found or not pending)"})
 
-    tasks.log_urgent_edit.delay(bakery_id, urgent_id, bread_requirements, reason)
+    if not settings.OUTBOX:
+        tasks.log_urgent_edit.delay(bakery_id, urgent_id, bread_requirements, reason)
 
     logger.info(f"{FILE_NAME}:urgent_edit", extra={
         "bakery_id": bakery_id,
@@ -250,7 +253,8 @@ async def urgent_delete(
     if not ok:
         raise HTTPException(status_code=400, detail={"error": "Urgent item cannot be deleted (not found or not pending)"})
 
-    tasks.log_urgent_cancel.delay(bakery_id, urgent_id)
+    if not settings.OUTBOX:
+        tasks.log_urgent_cancel.delay(bakery_id, urgent_id)
 
     logger.info(f"{FILE_NAME}:urgent_delete", extra={
         "bakery_id": bakery_id,
@@ -280,6 +284,20 @@ async def urgent_list(
     return {"items": items}
 
 
+@router.get('/queue/archive/{bakery_id}')
+@handle_errors
+async def queue_archive(
+        bakery_id: int,
+        request: Request,
+        db: Session = Depends(endpoint_helper.get_db),
+        _: int = Depends(require_admin),
+):
+    bakery_id = int(bakery_id)
+    r = request.app.state.redis
+    items = await redis_helper.get_archived_queue_tickets(r, bakery_id)
+    return {"items": items}
+
+
 @router.post('/reset_today')
 @handle_errors
 async def reset_today(
@@ -472,19 +490,8 @@ async def modify_ticket(
     bread_ids = list(time_per_bread.keys())
     encoded_reservation = ",".join(str(int(bread_requirements.get(bid, 0))) for bid in bread_ids)
 
-    breads_key = redis_helper.REDIS_KEY_BREADS.format(bakery_id)
-    all_breads = await r.zrangebyscore(breads_key, '-inf', '+inf')
-    baked_count = 0
-    suffix = f":{customer_ticket_id}"
-    for bread_value in all_breads:
-        if isinstance(bread_value, bytes):
-            try:
-                bread_value = bread_value.decode()
-            except Exception:
-                continue
-
-        if isinstance(bread_value, str) and bread_value.endswith(suffix):
-            baked_count += 1
+    bread_counts_key = redis_helper.REDIS_KEY_BREAD_COUNTS.format(bakery_id)
+    baked_count = int(await r.hget(bread_counts_key, str(customer_ticket_id)) or 0)
 
     if baked_count > 0:
         raise HTTPException(
@@ -525,8 +532,7 @@ async def modify_ticket(
     if bool(in_wait_list):
         raise HTTPException(status_code=400, detail={"error": "Ticket is in wait list and cannot be modified"})
 
-    queue_state = await redis_helper.load_queue_state(r, bakery_id)
-    ticket_state = queue_state.tickets.get(int(customer_ticket_id)) if getattr(queue_state, "tickets", None) else None
+    ticket_state = await redis_helper.get_queue_ticket(r, bakery_id, int(customer_ticket_id))
     original_ticket_kind = ticket_state.kind if ticket_state and getattr(ticket_state, "kind", None) in ("single", "multi") else None
 
     def _safe_total_from_reservation(raw_value) -> int | None:
@@ -605,19 +611,7 @@ async def modify_ticket(
     order_ids = [int(_as_text(x)) for x in order_ids] if order_ids else []
     reservations_map = {_as_text(k): _as_text(v) for k, v in (reservations_map or {}).items()}
 
-    breads_per_customer = {}
-    for bread_value in all_breads:
-        bread_value = _as_text(bread_value)
-        if not bread_value or ':' not in bread_value:
-            continue
-        try:
-            parts = str(bread_value).split(':')
-            if len(parts) < 2:
-                continue
-            cid = int(parts[-1])
-        except Exception:
-            continue
-        breads_per_customer[cid] = breads_per_customer.get(cid, 0) + 1
+    breads_per_customer, _ = redis_helper.decode_bread_index(await r.hgetall(bread_counts_key), None)
 
     def _get_customer_needs(ticket_id: int):
         if not ticket_id or str(ticket_id) not in reservations_map:
@@ -750,7 +744,6 @@ async def remove_ticket(
     served_key = redis_helper.REDIS_KEY_SERVED_TICKETS.format(bakery_id)
     upcoming_customers_key = redis_helper.REDIS_KEY_UPCOMING_CUSTOMERS.format(bakery_id)
     current_upcoming_key = redis_helper.REDIS_KEY_CURRENT_UPCOMING_CUSTOMER.format(bakery_id)
-    breads_key = redis_helper.REDIS_KEY_BREADS.format(bakery_id)
     user_current_ticket_key = redis_helper.REDIS_KEY_USER_CURRENT_TICKET.format(bakery_id)
 
     pipe0 = r.pipeline()
@@ -765,18 +758,6 @@ async def remove_ticket(
     if not (in_queue or in_wait_list or bool(is_served) or exists_in_db):
         raise HTTPException(status_code=404, detail={"error": "Ticket does not exist"})
 
-    all_breads = await r.zrangebyscore(breads_key, '-inf', '+inf')
-    suffix = f":{customer_ticket_id}"
-    to_remove_breads = []
-    for bread_value in all_breads:
-        if isinstance(bread_value, bytes):
-            try:
-                bread_value = bread_value.decode()
-            except Exception:
-                continue
-        if isinstance(bread_value, str) and bread_value.endswith(suffix):
-            to_remove_breads.append(bread_value)
-
     pipe = r.pipeline()
     pipe.hdel(res_key, str(customer_ticket_id))
     pipe.zrem(order_key, str(customer_ticket_id))
@@ -790,23 +771,16 @@ async def remove_ticket(
     if user_current_raw is not None and str(user_current_raw) == str(customer_ticket_id):
         pipe.delete(user_current_ticket_key)
 
-    if to_remove_breads:
-        pipe.zrem(breads_key, *to_remove_breads)
-
     await pipe.execute()
+    removed_breads = await redis_helper.consume_ready_breads(r, bakery_id, customer_ticket_id)
 
     numbers_to_free = {customer_ticket_id}
     for num, t in list(queue_state.tickets.items()):
         if int(num) == customer_ticket_id or (t.parent_ticket is not None and int(t.parent_ticket) == customer_ticket_id):
             numbers_to_free.add(int(num))
 
-    for num in numbers_to_free:
-        # Burn removed ticket numbers permanently so allocator never reuses them.
-        queue_state.tickets.pop(int(num), None)
-        if hasattr(queue_state, "consumed_numbers"):
-            queue_state.consumed_numbers.add(int(num))
-
-    await redis_helper.save_queue_state(r, bakery_id, queue_state)
+    # Burn removed ticket numbers permanently so allocator never reuses them.
+    await redis_helper.burn_queue_tickets(r, bakery_id, numbers_to_free)
 
     crud.delete_customer_by_ticket_id_today(db, bakery_id, customer_ticket_id)
 
@@ -838,7 +812,7 @@ async def remove_ticket(
         "bakery_id": bakery_id,
         "customer_ticket_id": customer_ticket_id,
         "burned_numbers": sorted(list(numbers_to_free)),
-        "removed_breads": len(to_remove_breads),
+        "removed_breads": removed_breads,
     })
 
     remove_msg = endpoint_helper.format_admin_event_message(
@@ -847,7 +821,7 @@ async def remove_ticket(
             "bakery_id": bakery_id,
             "ticket_number": customer_ticket_id,
             "burned_numbers": sorted(list(numbers_to_free)),
-            "removed_breads": len(to_remove_breads),
+            "removed_breads": removed_breads,
         },
     )
     await endpoint_helper.report_to_admin("ticket", f"{FILE_NAME}:remove_ticket", remove_msg)
@@ -1,29 +1,142 @@
-from dataclasses import dataclass, asdict
+import base64
+import json
+import struct
 from datetime import datetime
-from typing import Dict, Optional, Set
+from typing import Dict, List, Optional, Set, Union
+
+
+TICKET_KINDS = ("single", "multi", "consumed")
+TICKET_STATUSES = ("waiting", "served", "consumed")
+_KIND_CODES = {k: i for i, k in enumerate(TICKET_KINDS)}
+_STATUS_CODES = {s: i for i, s in enumerate(TICKET_STATUSES)}
+
+
+def _to_epoch(value: Union[int, str, None]) -> int:
+    """Local naive ISO string or epoch seconds -> epoch seconds; 0 means unset."""
+    if value is None or value == "":
+        return 0
+    if isinstance(value, int):
+        return value
+    value = str(value)
+    if value.isdigit():
+        return int(value)
+    return int(datetime.fromisoformat(value).timestamp())
+
+
+def _to_iso(epoch: int) -> Optional[str]:
+    return datetime.fromtimestamp(epoch).isoformat(timespec="seconds") if epoch else None
 
 
-@dataclass
 class Ticket:
-    number: int
-    kind: str  # 'single', 'multi', or 'consumed'
-    quantity: int
-    timestamp: str
-    status: str = "waiting"
-    served_at: Optional[str] = None
-    parent_ticket: Optional[int] = None
+    """One issued (or placeholder) ticket.
+
+    kind/status are stored as small int codes and times as epoch seconds;
+    the string/ISO attributes are exposed as properties so callers keep
+    using ``ticket.kind == "single"`` and ``ticket.timestamp``.
+    """
+
+    __slots__ = ("number", "kind_code", "quantity", "created_ts", "status_code", "served_ts", "parent_ticket")
+
+    def __init__(
+        self,
+        number: int,
+        kind: str,  # 'single', 'multi', or 'consumed'
+        quantity: int,
+        timestamp: Union[int, str, None],
+        status: str = "waiting",
+        served_at: Union[int, str, None] = None,
+        parent_ticket: Optional[int] = None,
+    ):
+        self.number = int(number)
+        self.kind_code = _KIND_CODES[kind]
+        self.quantity = int(quantity or 0)
+        self.created_ts = _to_epoch(timestamp)
+        self.status_code = _STATUS_CODES[status]
+        self.served_ts = _to_epoch(served_at)
+        self.parent_ticket = int(parent_ticket) if parent_ticket is not None else None
+
+    @property
+    def kind(self) -> str:
+        return TICKET_KINDS[self.kind_code]
+
+    @kind.setter
+    def kind(self, value: str) -> None:
+        self.kind_code = _KIND_CODES[value]
+
+    @property
+    def status(self) -> str:
+        return TICKET_STATUSES[self.status_code]
+
+    @status.setter
+    def status(self, value: str) -> None:
+        self.status_code = _STATUS_CODES[value]
+
+    @property
+    def timestamp(self) -> str:
+        return _to_iso(self.created_ts) or ""
+
+    @property
+    def served_at(self) -> Optional[str]:
+        return _to_iso(self.served_ts)
+
+    @served_at.setter
+    def served_at(self, value: Union[int, str, None]) -> None:
+        self.served_ts = _to_epoch(value)
+
+    def to_dict(self) -> Dict:
+        return {
+            "number": self.number,
+            "kind": self.kind,
+            "quantity": self.quantity,
+            "timestamp": self.timestamp,
+            "status": self.status,
+            "served_at": self.served_at,
+            "parent_ticket": self.parent_ticket,
+        }
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Ticket):
+            return NotImplemented
+        return all(getattr(self, f) == getattr(other, f) for f in self.__slots__)
+
+    def __repr__(self) -> str:
+        return (
+            f"Ticket(number={self.number}, kind={self.kind!r}, quantity={self.quantity}, "
+            f"status={self.status!r}, parent_ticket={self.parent_ticket})"
+        )
+
+
+# Binary snapshot layout (little endian), prefixed with "qs<version>:" and
+# base64 encoded because the Redis client runs with decode_responses=True.
+#   header: current_served, floor (v2+), max, flags(bit0 parity_determined),
+#           single_parity, multi_parity (-1 = unknown), ticket count
+#   consumed bitmap: bit set when number n is consumed, n in floor+1..max
+#   tickets: number, kind, status, quantity, created_ts, served_ts,
+#            parent_ticket (0 = none)
+_SNAPSHOT_VERSION = 2
+_SNAPSHOT_HEADERS = {
+    1: struct.Struct("<IIBbbI"),
+    2: struct.Struct("<IIIBbbI"),
+}
+_SNAPSHOT_TICKET = struct.Struct("<IBBHIII")
 
 
 class BakeryQueueState:
-    """Parity-based ticket allocator.
+    """Ticket queue of one bakery, as replayed from its queue event log.
 
-    The first real ticket determines parity mapping:
+    Numbers are allocated in Redis by LUA_ISSUE_TICKET
+    (application.helpers.redis_helper); this class only rebuilds and
+    snapshots the result. The first real ticket determines parity mapping:
     - if first is single: singles=odd, multis=even
     - if first is multi: multis=odd, singles=even
 
     Multi tickets can consume multiple same-parity slots and get the last slot as
     the visible ticket number. Previous consumed slots are stored as placeholder
     tickets (kind='consumed').
+
+    Windowed mode: archive_served() drops finished tickets at or below
+    current_served and collapses their numbers into ``floor`` (every number
+    <= floor counts as consumed), so the hot state tracks the queue length.
     """
 
     def __init__(self):
@@ -31,13 +144,16 @@ class BakeryQueueState:
         self.current_served: int = 0
 
         self.consumed_numbers: Set[int] = set()
+        self.floor: int = 0
         self.parity_determined: bool = False
         self.single_parity: Optional[int] = None
         self.multi_parity: Optional[int] = None
 
+        self._max_consumed: int = 0
+
     @staticmethod
-    def _now_iso() -> str:
-        return datetime.now().isoformat(timespec="seconds")
+    def _now_ts() -> int:
+        return int(datetime.now().timestamp())
 
     def _determine_parity(self, first_kind: str) -> None:
         if self.parity_determined:
@@ -49,86 +165,111 @@ class BakeryQueueState:
         self.parity_determined = True
 
     def _get_global_max(self) -> int:
-        return max(self.consumed_numbers) if self.consumed_numbers else 0
-
-    def _get_threshold_number(self) -> int:
-        return int(self.current_served or 0)
-
-    def _find_valid_slots(self, target_parity: int):
-        threshold = self._get_threshold_number()
-        global_max = self._get_global_max()
-        return [
-            n
-            for n in range(threshold + 1, global_max)
-            if n not in self.consumed_numbers and n % 2 == target_parity
-        ]
+        return self._max_consumed
 
-    def _get_next_sequence_number(self, target_parity: int) -> int:
-        start_point = max(self._get_global_max(), self._get_threshold_number())
-        search = start_point + 1
-        while search % 2 != target_parity:
-            search += 1
-        return search
+    @property
+    def max_number(self) -> int:
+        return self._get_global_max()
 
-    def _assign_ticket(self, kind: str, quantity: int) -> Ticket:
-        self._determine_parity(kind)
-        target_parity = self.single_parity if kind == "single" else self.multi_parity
-        valid_slots = self._find_valid_slots(int(target_parity))
+    def _rebuild_max(self) -> None:
+        self._max_consumed = max(max(self.consumed_numbers, default=0), self.floor)
 
-        if kind == "single":
-            consumed_slots = [valid_slots[0]] if valid_slots else [self._get_next_sequence_number(int(target_parity))]
-        else:
-            if len(valid_slots) >= int(quantity):
-                consumed_slots = valid_slots[: int(quantity)]
-            else:
-                consumed_slots = [self._get_next_sequence_number(int(target_parity))]
-
-        assigned = int(consumed_slots[-1])
-        for slot in consumed_slots:
-            self.consumed_numbers.add(int(slot))
-
-        if kind == "multi" and len(consumed_slots) > 1:
-            for slot in consumed_slots[:-1]:
-                self.tickets[int(slot)] = Ticket(
-                    number=int(slot),
-                    kind="consumed",
-                    quantity=0,
-                    timestamp=self._now_iso(),
-                    status="consumed",
-                    parent_ticket=assigned,
-                )
+    def _consume_slot(self, slot: int) -> None:
+        slot = int(slot)
+        if slot <= self.floor or slot in self.consumed_numbers:
+            return
+        self.consumed_numbers.add(slot)
+        if slot > self._max_consumed:
+            self._max_consumed = slot
+
+    def burn_number(self, number: int) -> None:
+        """Mark a number as permanently used so the allocator never reuses it."""
+        self._consume_slot(int(number))
+
+    def archive_served(self) -> List[Ticket]:
+        """Remove served/placeholder tickets at or below current_served.
 
-        t = Ticket(number=assigned, kind=kind, quantity=int(quantity), timestamp=self._now_iso())
-        self.tickets[assigned] = t
-        return t
+        Returns the removed tickets so the caller can store them in the cold
+        archive. Waiting tickets stay hot whatever their number, because
+        dispatch can serve out of order.
+        """
+        cutoff = int(self.current_served or 0)
+        archived = [t for n, t in self.tickets.items() if n <= cutoff and t.status != "waiting"]
+        for t in archived:
+            del self.tickets[t.number]
 
-    def issue_single(self):
-        return self._assign_ticket("single", 1)
+        if cutoff > self.floor:
+            self.floor = cutoff
+            self.consumed_numbers = {n for n in self.consumed_numbers if n > cutoff}
+            if cutoff > self._max_consumed:
+                self._max_consumed = cutoff
 
-    def issue_multi(self, quantity: int):
-        if quantity < 2:
-            raise ValueError("quantity must be >= 2 for multi")
-        return self._assign_ticket("multi", int(quantity))
+        return archived
 
     def to_dict(self) -> Dict:
         return {
-            "tickets": {str(n): asdict(t) for n, t in self.tickets.items()},
+            "tickets": {str(n): t.to_dict() for n, t in self.tickets.items()},
             "current_served": self.current_served,
+            "floor": self.floor,
             "consumed_numbers": sorted(list(self.consumed_numbers)),
             "parity_determined": self.parity_determined,
             "single_parity": self.single_parity,
             "multi_parity": self.multi_parity,
         }
 
-    def mark_ticket_served(self, ticket_id: int) -> None:
+    def mark_ticket_served(self, ticket_id: int, served_at: Optional[str] = None) -> None:
+        # Dispatch can serve out of order: only the ticket's own status
+        # says whether it was served, current_served is the highest one.
         t = self.tickets.get(ticket_id)
         if not t or t.kind not in ("single", "multi") or t.status == "served":
             return
-        if ticket_id <= self.current_served:
-            return
         t.status = "served"
-        t.served_at = self._now_iso()
-        self.current_served = ticket_id
+        t.served_at = served_at or self._now_ts()
+        if ticket_id > self.current_served:
+            self.current_served = ticket_id
+
+    def apply_event(self, event: Dict) -> None:
+        """Replay one entry of the per-bakery queue event log.
+
+        Events are flat string dicts as written to the Redis stream:
+        - issue: number, kind, quantity, ts, served (cutoff used at issue
+          time; informational, it does not mark anything served) and slots
+          (CSV of placeholder numbers for multis)
+        - serve: number, ts
+        - burn: numbers (CSV)
+        """
+        etype = event.get("type")
+
+        if etype == "issue":
+            number = int(event["number"])
+            kind = event["kind"]
+            ts = event.get("ts") or self._now_ts()
+
+            self._determine_parity(kind)
+            slots = [int(x) for x in str(event.get("slots") or "").split(",") if x]
+            for slot in slots + [number]:
+                self._consume_slot(slot)
+            for slot in slots:
+                self.tickets[slot] = Ticket(
+                    number=slot,
+                    kind="consumed",
+                    quantity=0,
+                    timestamp=ts,
+                    status="consumed",
+                    parent_ticket=number,
+                )
+            self.tickets[number] = Ticket(
+                number=number, kind=kind, quantity=int(event.get("quantity") or 0), timestamp=ts
+            )
+
+        elif etype == "serve":
+            self.mark_ticket_served(int(event["number"]), served_at=event.get("ts"))
+
+        elif etype == "burn":
+            for x in str(event.get("numbers") or "").split(","):
+                if x:
+                    self.tickets.pop(int(x), None)
+                    self.burn_number(int(x))
 
     @classmethod
     def from_dict(cls, data: Dict) -> "BakeryQueueState":
@@ -152,7 +293,9 @@ class BakeryQueueState:
         if consumed is None:
             # Backward compatibility for old snapshots.
             consumed = list(inst.tickets.keys())
-        inst.consumed_numbers = set(int(x) for x in consumed)
+        inst.floor = int(data.get("floor", 0) or 0)
+        inst.consumed_numbers = set(int(x) for x in consumed if int(x) > inst.floor)
+        inst._rebuild_max()
 
         inst.parity_determined = bool(data.get("parity_determined", False))
         inst.single_parity = data.get("single_parity")
@@ -167,3 +310,90 @@ class BakeryQueueState:
                 inst._determine_parity(real_tickets[0].kind)
 
         return inst
+
+    def to_bytes(self) -> bytes:
+        """Versioned compact binary form of the state (see _SNAPSHOT_*)."""
+        max_number = self._get_global_max()
+        floor = self.floor
+        bitmap = bytearray((max_number - floor + 7) // 8)
+        for n in self.consumed_numbers:
+            i = n - floor - 1
+            bitmap[i >> 3] |= 1 << (i & 7)
+
+        def parity(value):
+            return -1 if value is None else int(value)
+
+        parts = [
+            _SNAPSHOT_HEADERS[_SNAPSHOT_VERSION].pack(
+                int(self.current_served or 0),
+                floor,
+                max_number,
+                1 if self.parity_determined else 0,
+                parity(self.single_parity),
+                parity(self.multi_parity),
+                len(self.tickets),
+            ),
+            bytes(bitmap),
+        ]
+        pack = _SNAPSHOT_TICKET.pack
+        for t in self.tickets.values():
+            parts.append(pack(
+                t.number, t.kind_code, t.status_code, t.quantity,
+                t.created_ts, t.served_ts, t.parent_ticket or 0,
+            ))
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, payload: bytes, version: int = _SNAPSHOT_VERSION) -> "BakeryQueueState":
+        inst = cls()
+        header = _SNAPSHOT_HEADERS[version]
+        if version == 1:
+            current_served, max_number, flags, single_parity, multi_parity, count = header.unpack_from(payload, 0)
+            floor = 0
+        else:
+            current_served, floor, max_number, flags, single_parity, multi_parity, count = header.unpack_from(payload, 0)
+        offset = header.size
+
+        bitmap_len = (max_number - floor + 7) // 8
+        bitmap = payload[offset:offset + bitmap_len]
+        offset += bitmap_len
+        inst.floor = floor
+        inst.consumed_numbers = {
+            floor + i + 1 for i in range(max_number - floor)
+            if bitmap[i >> 3] & (1 << (i & 7))
+        }
+        inst._rebuild_max()
+
+        end = offset + count * _SNAPSHOT_TICKET.size
+        for number, kind_code, status_code, quantity, created_ts, served_ts, parent in \
+                _SNAPSHOT_TICKET.iter_unpack(payload[offset:end]):
+            t = Ticket.__new__(Ticket)
+            t.number = number
+            t.kind_code = kind_code
+            t.quantity = quantity
+            t.created_ts = created_ts
+            t.status_code = status_code
+            t.served_ts = served_ts
+            t.parent_ticket = parent or None
+            inst.tickets[number] = t
+
+        inst.current_served = current_served
+        inst.parity_determined = bool(flags & 1)
+        inst.single_parity = single_parity if single_parity >= 0 else None
+        inst.multi_parity = multi_parity if multi_parity >= 0 else None
+        return inst
+
+    def dumps(self) -> str:
+        """Text form for the Redis queue_state key."""
+        return f"qs{_SNAPSHOT_VERSION}:" + base64.b64encode(self.to_bytes()).decode("ascii")
+
+    @classmethod
+    def loads(cls, raw: str) -> "BakeryQueueState":
+        """Inverse of dumps(); also accepts older versions and legacy JSON."""
+        if raw.startswith("qs"):
+            tag, body = raw.split(":", 1)
+            version = int(tag[2:])
+            if version not in _SNAPSHOT_HEADERS:
+                raise ValueError(f"Unsupported queue_state snapshot version: {tag}")
+            return cls.from_bytes(base64.b64decode(body), version=version)
+        return cls.from_dict(json.loads(raw))
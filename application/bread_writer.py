@@ -0,0 +1,120 @@
+"""Bulk bread persistence service.
+
+    python -m application.bread_writer
+
+With BREAD_WRITER enabled /hc/new_bread queues every baked bread on the
+``bread_writes`` Redis stream (redis_helper.enqueue_bread_write) instead of
+sending one ``save_bread_to_db`` Celery task per loaf. This process buffers
+the stream and writes it with crud.create_breads_bulk whenever
+BREAD_WRITER_BATCH_SIZE breads are waiting or the oldest one has waited
+BREAD_WRITER_FLUSH_MS.
+
+Entries are acknowledged only after their batch is committed. Whatever a
+stopped writer left unacknowledged is written again on the next start;
+inserts are idempotent on (bakery_id, seq), so nothing is stored twice.
+"""
+import asyncio
+import signal
+import time
+import traceback
+
+from redis import asyncio as aioredis
+
+from application import crud, tasks
+from application.database import SessionLocal
+from application.helpers import redis_helper
+from application.logger_config import celery_logger
+from application.setting import settings
+
+FLUSH_RETRY_DELAY_S = 5
+# Longest a read blocks while the buffer is empty.
+IDLE_BLOCK_MS = 5000
+
+
+def _write_breads(breads: list[dict]) -> int:
+    with SessionLocal() as db:
+        return crud.create_breads_bulk(db, breads)
+
+
+async def _flush(r, entries: list[tuple[str, dict]]):
+    """Write ``entries`` and acknowledge them, retrying until the DB accepts them."""
+    breads = [fields for _, fields in entries]
+    while True:
+        started_at = time.monotonic()
+        try:
+            inserted = await asyncio.to_thread(_write_breads, breads)
+            break
+        except Exception as e:
+            celery_logger.error(
+                "bread_writer flush failed",
+                extra={"breads": len(breads), "error": str(e), "traceback": traceback.format_exc()},
+            )
+            tasks.notify_admin(
+                f"[🔴 ERROR] bread_writer"
+                f"\n\nBreads: {len(breads)}"
+                f"\nType: {type(e)}"
+                f"\nReason: {str(e)}"
+            )
+            await asyncio.sleep(FLUSH_RETRY_DELAY_S)
+
+    await redis_helper.ack_bread_writes(r, [entry_id for entry_id, _ in entries])
+    celery_logger.info(
+        "bread_writer flushed",
+        extra={
+            "breads": len(breads),
+            "inserted": inserted,
+            "duration_ms": round((time.monotonic() - started_at) * 1000, 2),
+        },
+    )
+
+
+async def run():
+    r = aioredis.from_url(settings.REDIS_URL, decode_responses=True)
+    batch_size = max(1, int(settings.BREAD_WRITER_BATCH_SIZE))
+    flush_s = max(0.0, float(settings.BREAD_WRITER_FLUSH_MS) / 1000)
+    celery_logger.info("bread_writer started")
+    try:
+        await redis_helper.ensure_bread_writes_group(r)
+
+        # Catch up on what an earlier run read but never committed.
+        while pending := await redis_helper.read_bread_writes(r, batch_size, pending=True):
+            await _flush(r, pending)
+
+        buffer: list[tuple[str, dict]] = []
+        flush_at = 0.0
+        while True:
+            if buffer and (len(buffer) >= batch_size or time.monotonic() >= flush_at):
+                await _flush(r, buffer)
+                buffer = []
+                continue
+
+            block_ms = max(1, int((flush_at - time.monotonic()) * 1000)) if buffer else IDLE_BLOCK_MS
+            entries = await redis_helper.read_bread_writes(r, batch_size - len(buffer), block_ms=block_ms)
+            if entries and not buffer:
+                flush_at = time.monotonic() + flush_s
+            buffer.extend(entries)
+    finally:
+        await r.aclose()
+        celery_logger.info("bread_writer stopped")
+
+
+def main():
+    if not settings.BREAD_WRITER:
+        celery_logger.info("bread_writer not started: needs BREAD_WRITER")
+        return
+
+    async def _main():
+        writer = asyncio.create_task(run())
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, writer.cancel)
+        try:
+            await writer
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(_main())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 from sqlalchemy.orm import Session
 from sqlalchemy import update, case, select, func
+from sqlalchemy.dialects import postgresql, sqlite
 from application import models, schemas
 from application.auth import hash_password_md5
 import pytz
@@ -7,6 +8,7 @@ from datetime import datetime, timezone
 from sqlalchemy import asc
 from datetime import datetime, time
 import json
+from collections import defaultdict
 
 def get_user_by_phone_number(db: Session, phone_number: str):
     return db.query(models.User).filter(models.User.phone_number == phone_number).first()
@@ -472,6 +474,24 @@ def get_today_last_customer(db: Session, bakery_id: int):
     return last_customer
 
 
+def get_today_ticket_ids(db: Session, bakery_id: int) -> list[int]:
+    """Return every ticket_id registered today for this bakery, in any status."""
+    tehran = pytz.timezone("Asia/Tehran")
+    now_tehran = datetime.now(tehran)
+    midnight_tehran = tehran.localize(datetime.combine(now_tehran.date(), time.min))
+    midnight_utc = midnight_tehran.astimezone(pytz.utc)
+
+    rows = (
+        db.query(models.Customer.ticket_id)
+        .filter(
+            models.Customer.bakery_id == bakery_id,
+            models.Customer.register_date >= midnight_utc,
+        )
+        .all()
+    )
+    return [int(row.ticket_id) for row in rows if row.ticket_id is not None]
+
+
 def upsert_queue_state_snapshot(db: Session, bakery_id: int, state_dict: dict):
     """Insert or update today's QueueStateSnapshot for this bakery.
 
@@ -747,6 +767,69 @@ def create_bread(db, bakery_id:int, customer_internal_id: int, baked_at: datetim
     return bread
 
 
+def create_breads_bulk(db: Session, breads) -> int:
+    """Insert baked breads with one multi-row INSERT.
+
+    ``breads`` are dicts with bakery_id, ticket_id, baked_at (epoch seconds),
+    seq (the Redis bread index) and pressed_at (epoch seconds of the button
+    press). Tickets are resolved to today's queued
+    customers with one query per bakery; breads without one are stored as
+    consumed, like create_bread callers do. A (bakery_id, baked_date, seq)
+    that is already stored is skipped by the unique index
+    (ON CONFLICT DO NOTHING), so a replayed or concurrent batch inserts
+    nothing twice. Returns the number of rows inserted.
+    """
+    tehran = pytz.timezone("Asia/Tehran")
+    now_tehran = datetime.now(tehran)
+    midnight_tehran = tehran.localize(datetime.combine(now_tehran.date(), time.min))
+    midnight_utc = midnight_tehran.astimezone(pytz.utc)
+
+    by_bakery = defaultdict(dict)
+    for bread in breads:
+        by_bakery[int(bread["bakery_id"])].setdefault(int(bread["seq"]), bread)
+
+    rows = []
+    for bakery_id, by_seq in by_bakery.items():
+        tickets = {int(b["ticket_id"]) for b in by_seq.values() if b.get("ticket_id")}
+        customer_ids = {}
+        if tickets:
+            for ticket_id, customer_id in (
+                db.query(models.Customer.ticket_id, models.Customer.id)
+                .filter(
+                    models.Customer.bakery_id == bakery_id,
+                    models.Customer.ticket_id.in_(tickets),
+                    models.Customer.is_in_queue == True,
+                    models.Customer.register_date >= midnight_utc,
+                )
+                .order_by(models.Customer.id)
+            ):
+                customer_ids.setdefault(int(ticket_id), int(customer_id))
+
+        for seq, bread in by_seq.items():
+            customer_id = customer_ids.get(int(bread.get("ticket_id") or 0))
+            # The Redis bread index restarts every Tehran day, so the day is the
+            # press time's; baked_at adds the baking time and can cross midnight.
+            pressed_at = float(bread.get("pressed_at") or bread["baked_at"])
+            rows.append({
+                "belongs_to": customer_id,
+                "baked_at": datetime.fromtimestamp(float(bread["baked_at"]), tz=pytz.utc),
+                "baked_date": datetime.fromtimestamp(pressed_at, tehran).date(),
+                "bakery_id": bakery_id,
+                "consumed": customer_id is None,
+                "seq": seq,
+            })
+
+    inserted = 0
+    if rows:
+        dialect_insert = sqlite.insert if db.get_bind().dialect.name == "sqlite" else postgresql.insert
+        stmt = dialect_insert(models.Bread).values(rows).on_conflict_do_nothing(
+            index_elements=["bakery_id", "baked_date", "seq"]
+        )
+        inserted = db.execute(stmt).rowcount
+    db.commit()
+    return inserted
+
+
 def get_today_breads(db, bakery_id: int):
     tehran = pytz.timezone("Asia/Tehran")
     now_tehran = datetime.now(tehran)
@@ -776,6 +859,22 @@ def get_today_total_baked_breads(db: Session, bakery_id: int) -> int:
     return int(total or 0)
 
 
+def get_today_max_bread_id(db: Session, bakery_id: int) -> int:
+    tehran = pytz.timezone("Asia/Tehran")
+    now_tehran = datetime.now(tehran)
+    midnight_tehran = tehran.localize(datetime.combine(now_tehran.date(), time.min))
+    midnight_utc = midnight_tehran.astimezone(pytz.utc)
+
+    # seq holds the Redis bread index; rows written before it existed only have id.
+    max_id, max_seq = (
+        db.query(func.max(models.Bread.id), func.max(models.Bread.seq))
+        .filter(models.Bread.bakery_id == int(bakery_id))
+        .filter(models.Bread.enter_date >= midnight_utc)
+        .one()
+    )
+    return max(int(max_id or 0), int(max_seq or 0))
+
+
 def get_today_total_required_breads(db: Session, bakery_id: int) -> int:
     tehran = pytz.timezone("Asia/Tehran")
     now_tehran = datetime.now(tehran)
@@ -935,6 +1034,15 @@ def create_urgent_bread_log(
     return obj.id
 
 
+def urgent_bread_log_exists(db: Session, bakery_id: int, urgent_id: str) -> bool:
+    return (
+        db.query(models.UrgentBreadLog.id)
+        .filter(models.UrgentBreadLog.bakery_id == int(bakery_id))
+        .filter(models.UrgentBreadLog.urgent_id == str(urgent_id))
+        .first()
+    ) is not None
+
+
 def update_urgent_bread_log(
     db: Session,
     bakery_id: int,
@@ -0,0 +1,68 @@
+"""Long-running auto-dispatch service.
+
+    python -m application.dispatch_worker
+
+Runs the same dispatch as the ``auto_dispatch_ready_tickets`` Celery task, but
+in one asyncio process that keeps a single Redis connection pool, the
+SQLAlchemy engine pool and one persistent MQTT connection
+(mqtt_client.background_publisher) for its whole lifetime. It sleeps until
+the earliest deadline in ``auto_dispatch:due`` and is woken early through
+``auto_dispatch:wake`` when a request makes a bakery due sooner
+(redis_helper.request_dispatch with AUTO_DISPATCH_WORKER enabled).
+"""
+import asyncio
+import signal
+import time
+
+from redis import asyncio as aioredis
+
+from application import mqtt_client, tasks
+from application.helpers import redis_helper
+from application.logger_config import celery_logger
+from application.setting import settings
+
+
+async def run():
+    r = aioredis.from_url(settings.REDIS_URL, decode_responses=True)
+    # Connect now rather than on the first dispatched ticket.
+    mqtt_client.background_publisher()
+    sweep_s = float(settings.AUTO_DISPATCH_SWEEP_INTERVAL_S)
+    stragglers: set[asyncio.Task] = set()
+    celery_logger.info("dispatch_worker started")
+    try:
+        while True:
+            await tasks.dispatch_due_bakeries(r, stragglers=stragglers)
+            await redis_helper.rearm_dispatch(r)
+
+            deadline = await redis_helper.next_dispatch_deadline(r)
+            wait_s = sweep_s if deadline is None else min(sweep_s, deadline - time.time())
+            if wait_s > 0:
+                await r.blpop([redis_helper.REDIS_KEY_DISPATCH_WAKE], timeout=wait_s)
+    finally:
+        if stragglers:
+            await asyncio.wait(stragglers)
+        await asyncio.to_thread(mqtt_client.close_background_publisher)
+        await r.aclose()
+        celery_logger.info("dispatch_worker stopped")
+
+
+def main():
+    if not (settings.ENABLE_AUTO_DISPATCH_READY_TICKETS and settings.AUTO_DISPATCH_WORKER):
+        celery_logger.info("dispatch_worker not started: needs ENABLE_AUTO_DISPATCH_READY_TICKETS and AUTO_DISPATCH_WORKER")
+        return
+
+    async def _main():
+        worker = asyncio.create_task(run())
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, worker.cancel)
+        try:
+            await worker
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(_main())
+
+
+if __name__ == "__main__":
+    main()
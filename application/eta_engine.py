@@ -0,0 +1,167 @@
+"""Wait-time estimates for every queued ticket in one pass.
+
+All callers that need "when will ticket X be ready" (the materialized ETA
+table behind /res and /hc/current_ticket, calculate_ready_status) go through
+``compute_eta`` so the estimate is defined in exactly one place.
+
+For a ticket that still needs breads the estimate is one of:
+
+1. all breads already in the oven/index: time until the last one is done;
+2. no bread in the oven at all: bread-seconds of every ticket up to and
+   including this one, plus baking time and outstanding urgent work;
+3. nothing baked for this ticket yet: remaining bread-seconds of earlier
+   tickets, this ticket's bread-seconds, baking time and urgent work;
+4. partially baked: remaining breads times this ticket's average bread
+   time, plus baking time.
+
+Cases 2 and 3 only depend on tickets *before* this one, so they are kept
+as running prefix sums while walking the queue once in ticket order.
+"""
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+def bread_ready_at(count: int, last_ts: float, need: int, virtual: int = 0) -> Optional[float]:
+    """Ready time of a ticket's ``need``-th bread, or None if fewer exist.
+
+    ``virtual`` breads (base breads of tickets already moved to the wait
+    list) count as ready at 0. Breads of one ticket are cooked back to back,
+    so the latest ready timestamp stands in for the need-th one.
+    """
+    if need <= 0:
+        return 0.0
+    if int(count) + int(virtual) < need:
+        return None
+    if need <= int(virtual) or not count:
+        return 0.0
+    return float(last_ts)
+
+
+def compute_eta(
+    reservation_dict: Dict[int, Sequence[int]],
+    time_per_bread: Dict[str, int],
+    bread_counts: Dict[int, int],
+    bread_last_ts: Dict[int, float],
+    base_done_ids: Iterable[int],
+    urgent_by_ticket: Dict[int, Dict[str, int]],
+    baking_time_s: int,
+    urgent_remaining_time: int,
+    bread_ids: Optional[List[str]] = None,
+) -> Dict[int, Tuple[Optional[int], Optional[float]]]:
+    """Time-independent estimate for each ticket in ``reservation_dict``.
+
+    Maps ticket -> ``(wait_s, ready_at)`` with exactly one side set: case 1
+    tickets get the absolute ``ready_at`` of their last bread, every other
+    ticket a fixed ``wait_s``. Use ``wait_at`` to turn an entry into seconds.
+
+    ``reservation_dict`` maps ticket -> base counts in ``bread_ids`` order
+    (default: sorted bread ids). ``urgent_by_ticket`` holds the unfinished
+    urgent breads injected into a ticket (get_urgent_breads_by_ticket).
+    """
+    time_per_bread = {str(k): int(v) for k, v in time_per_bread.items()}
+    bread_ids = [str(b) for b in (bread_ids if bread_ids is not None else sorted(time_per_bread))]
+    avg_cook_time = (sum(time_per_bread.values()) // len(time_per_bread)) if time_per_bread else 0
+    base_done_ids = {int(x) for x in base_done_ids}
+    baking_time_s = int(baking_time_s or 0)
+    urgent_remaining_time = int(urgent_remaining_time or 0)
+    any_bread = bool(bread_counts)
+
+    etas: Dict[int, Tuple[Optional[int], Optional[float]]] = {}
+    seconds_through = 0    # case 2: bread-seconds of tickets <= current
+    remaining_before = 0   # case 3: remaining bread-seconds of tickets < current
+
+    for tid in sorted(int(k) for k in reservation_dict):
+        eff = {bid: int(c) for bid, c in zip(bread_ids, reservation_dict[tid])}
+        base_total = sum(eff.values())
+        for bid, c in (urgent_by_ticket.get(tid) or {}).items():
+            eff[str(bid)] = eff.get(str(bid), 0) + int(c)
+        need_total = sum(eff.values())
+        eff_seconds = sum(c * time_per_bread.get(bid, 0) for bid, c in eff.items())
+
+        count = int(bread_counts.get(tid, 0))
+        virtual = base_total if (tid in base_done_ids and base_total > 0) else 0
+        made_total = count + virtual
+
+        seconds_through += eff_seconds
+
+        if need_total <= 0:
+            etas[tid] = (0, None)
+        else:
+            ready_at = bread_ready_at(count, bread_last_ts.get(tid, 0.0), need_total, virtual)
+            if ready_at is not None:
+                etas[tid] = (None, ready_at)
+            elif not any_bread:
+                etas[tid] = (baking_time_s + seconds_through + urgent_remaining_time, None)
+            elif not made_total:
+                etas[tid] = (remaining_before + eff_seconds + baking_time_s + urgent_remaining_time, None)
+            else:
+                active = [time_per_bread.get(bid, 0) for bid, c in eff.items() if c > 0]
+                this_avg = (sum(active) // len(active)) if active else avg_cook_time
+                etas[tid] = ((need_total - made_total) * this_avg + baking_time_s, None)
+
+        if made_total < need_total:
+            remaining_before += (need_total - made_total) * avg_cook_time if made_total > 0 else eff_seconds
+
+    return etas
+
+
+def wait_at(wait_s: Optional[int], ready_at: Optional[float], now: float) -> int:
+    """Seconds left at ``now`` for one ``compute_eta`` entry."""
+    if ready_at is not None:
+        return max(0, int(float(ready_at) - now))
+    return int(wait_s or 0)
+
+
+def compute_wait_times(
+    reservation_dict: Dict[int, Sequence[int]],
+    time_per_bread: Dict[str, int],
+    bread_counts: Dict[int, int],
+    bread_last_ts: Dict[int, float],
+    base_done_ids: Iterable[int],
+    urgent_by_ticket: Dict[int, Dict[str, int]],
+    baking_time_s: int,
+    urgent_remaining_time: int,
+    now: float,
+    bread_ids: Optional[List[str]] = None,
+) -> Dict[int, int]:
+    """Seconds until each ticket in ``reservation_dict`` is ready (``compute_eta`` at ``now``)."""
+    etas = compute_eta(
+        reservation_dict, time_per_bread, bread_counts, bread_last_ts, base_done_ids,
+        urgent_by_ticket, baking_time_s, urgent_remaining_time, bread_ids=bread_ids,
+    )
+    return {tid: wait_at(wait_s, ready_at, now) for tid, (wait_s, ready_at) in etas.items()}
+
+
+def empty_slot_counts(keys: Sequence[int], reservation_dict: Dict[int, Sequence[int]]) -> Dict[int, int]:
+    """``Algorithm.compute_empty_slot_time(keys, k, reservation_dict)`` for every k in ``keys``.
+
+    The single-single streak is reset by any later pair, so only the streak
+    after the last reset counts; the multi-multi pairs are a plain prefix count.
+    """
+    sums = [sum(reservation_dict[k]) for k in keys]
+    last_reset = 0
+    for i in range(1, len(keys)):
+        if not (sums[i - 1] == 1 and sums[i] == 1):
+            last_reset = i
+
+    counts: Dict[int, int] = {}
+    full_pairs = 0
+    for i, key in enumerate(keys):
+        if i and sums[i - 1] > 1 and sums[i] > 1:
+            full_pairs += 1
+        counts[key] = max(0, i - last_reset) + full_pairs
+    return counts
+
+
+def select_best_ticket(order_ids: Iterable[int], wait_times: Dict[int, int]) -> Optional[Tuple[int, int]]:
+    """(ticket, wait) of the queued ticket that will be ready first; ties go to the lower ticket."""
+    best_tid, best_wait = None, None
+    for tid in order_ids:
+        tid = int(tid)
+        if tid not in wait_times:
+            continue
+        w = int(wait_times[tid])
+        if best_wait is None or w < best_wait or (w == best_wait and tid < best_tid):
+            best_tid, best_wait = tid, w
+    if best_tid is None:
+        return None
+    return best_tid, best_wait
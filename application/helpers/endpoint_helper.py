@@ -1,6 +1,6 @@
 from fastapi import Depends, HTTPException
 from application.database import SessionLocal
-from application.tasks import report_to_admin_api
+from application.tasks import notify_admin
 from application.setting import settings
 import traceback
 from uuid import uuid4
@@ -45,7 +45,7 @@ async def report_to_admin(level: str, fun_name: str, msg: str):
 
         message = f"{emoji} Report {level.replace('_', ' ')} {fun_name}\n\n{msg}"
 
-        report_to_admin_api.delay(message, message_thread_id=thread_id, parse_mode="HTML")
+        notify_admin(message, message_thread_id=thread_id, parse_mode="HTML", category=level)
 
     except Exception as e:
         logger.error("error in report_to_admin", extra={"error": str(e)})
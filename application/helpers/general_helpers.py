@@ -12,15 +12,17 @@ def seconds_until_midnight_iran():
     return int((midnight - now).total_seconds())
 
 
-def generate_daily_customer_token(bakery_id: int, ticket_id: int) -> str:
+def generate_daily_customer_token(bakery_id: int, ticket_id: int, issued_at: float | None = None) -> str:
     """Generate a short, per-day token for a customer.
 
     The token is derived from (bakery_id, ticket_id, local Tehran date) and
     encoded into at most 5 base36 characters so it is compact enough for QR
-    codes while remaining stable for that day.
+    codes while remaining stable for that day. ``issued_at`` (epoch seconds)
+    picks the day of the ticket instead of today.
     """
     tz = ZoneInfo("Asia/Tehran")
-    today = datetime.now(tz).date().isoformat()
+    issued = datetime.fromtimestamp(issued_at, tz) if issued_at else datetime.now(tz)
+    today = issued.date().isoformat()
 
     payload = f"{bakery_id}-{ticket_id}-{today}".encode("utf-8")
     digest = hashlib.sha1(payload).digest()
@@ -1,12 +1,15 @@
 from fastapi import HTTPException
-from application import crud
+from application import crud, eta_engine
 from application.database import SessionLocal
 from application.helpers.general_helpers import seconds_until_midnight_iran
+from application.setting import settings
+import asyncio
 import json
 import uuid
 import time
 from collections import defaultdict
 from typing import Optional
+from redis.exceptions import ResponseError
 
 
 REDIS_KEY_PREFIX = "bakery:{0}"
@@ -21,6 +24,11 @@ REDIS_KEY_CURRENT_UPCOMING_CUSTOMER = f"{REDIS_KEY_PREFIX}:current_upcoming_cust
 REDIS_KEY_BAKING_TIME_S = f"{REDIS_KEY_PREFIX}:baking_time_s"
 REDIS_KEY_TIMEOUT_SEC = f"{REDIS_KEY_PREFIX}:timeout_sec"
 REDIS_KEY_BREADS = f"{REDIS_KEY_PREFIX}:breads"
+REDIS_KEY_BREAD_COUNTS = f"{REDIS_KEY_PREFIX}:bread_counts"
+REDIS_KEY_BREAD_LAST_TS = f"{REDIS_KEY_PREFIX}:bread_last_ts"
+REDIS_KEY_BREAD_MAX_TICKET = f"{REDIS_KEY_PREFIX}:bread_max_ticket"
+REDIS_KEY_BREAD_SEQ = f"{REDIS_KEY_PREFIX}:bread_seq"
+REDIS_KEY_TICKET_BREADS = f"{REDIS_KEY_PREFIX}:ticket_breads"
 REDIS_KEY_LAST_BREAD_TIME = f"{REDIS_KEY_PREFIX}:last_bread_time"
 REDIS_KEY_BREAD_TIME_DIFFS = f"{REDIS_KEY_PREFIX}:bread_time_diff"
 REDIS_KEY_PREP_STATE = f"{REDIS_KEY_PREFIX}:prep_state"
@@ -33,6 +41,13 @@ REDIS_KEY_LAST_SINGLE = f"{REDIS_KEY_PREFIX}:last_single"
 REDIS_KEY_LAST_MULTI = f"{REDIS_KEY_PREFIX}:last_multi"
 REDIS_KEY_CURRENT_SERVED = f"{REDIS_KEY_PREFIX}:current_served"
 REDIS_KEY_QUEUE_STATE = f"{REDIS_KEY_PREFIX}:queue_state"
+REDIS_KEY_QUEUE_META = f"{REDIS_KEY_PREFIX}:queue_meta"
+REDIS_KEY_QUEUE_EVENTS = f"{REDIS_KEY_PREFIX}:queue_events"
+REDIS_KEY_QUEUE_ARCHIVE = f"{REDIS_KEY_PREFIX}:queue_archive"
+REDIS_KEY_QUEUE_SERVED = f"{REDIS_KEY_PREFIX}:queue_served"
+REDIS_KEY_QUEUE_FREE_ODD = f"{REDIS_KEY_PREFIX}:queue_free_odd"
+REDIS_KEY_QUEUE_FREE_EVEN = f"{REDIS_KEY_PREFIX}:queue_free_even"
+REDIS_KEY_QUEUE_SEED_LOCK = f"{REDIS_KEY_PREFIX}:queue_seed_lock"
 REDIS_KEY_SERVED_TICKETS = f"{REDIS_KEY_PREFIX}:served_tickets"
 REDIS_KEY_USER_CURRENT_TICKET = f"{REDIS_KEY_PREFIX}:user_current_ticket"
 REDIS_KEY_URGENT_QUEUE = f"{REDIS_KEY_PREFIX}:urgent_queue"
@@ -40,7 +55,41 @@ REDIS_KEY_URGENT_PREP_STATE = f"{REDIS_KEY_PREFIX}:urgent_prep_state"
 REDIS_KEY_URGENT_ALL_IDS = f"{REDIS_KEY_PREFIX}:urgent_all_ids"
 REDIS_KEY_URGENT_EPOCH = f"{REDIS_KEY_PREFIX}:urgent_epoch"
 REDIS_KEY_URGENT_HISTORY = f"{REDIS_KEY_PREFIX}:urgent_history"
+REDIS_KEY_URGENT_ACTIVE_IDS = f"{REDIS_KEY_PREFIX}:urgent_active_ids"
+REDIS_KEY_URGENT_ACTIVE_BREADS = f"{REDIS_KEY_PREFIX}:urgent_active_breads"
+REDIS_KEY_URGENT_REMAINING_S = f"{REDIS_KEY_PREFIX}:urgent_remaining_s"
+REDIS_KEY_URGENT_LOG = f"{REDIS_KEY_PREFIX}:urgent_log"
+REDIS_KEY_URGENT_LOG_TICKETS = f"{REDIS_KEY_PREFIX}:urgent_log_tickets"
 REDIS_KEY_BASE_DONE = f"{REDIS_KEY_PREFIX}:base_done"
+REDIS_KEY_ETA_TABLE = f"{REDIS_KEY_PREFIX}:eta_table"
+REDIS_KEY_ETA_VERSION = f"{REDIS_KEY_PREFIX}:eta_version"
+REDIS_KEY_ETA_LOCK = f"{REDIS_KEY_PREFIX}:eta_lock"
+REDIS_KEY_DISPATCH_STATS = f"{REDIS_KEY_PREFIX}:dispatch_stats"
+REDIS_KEY_DISPATCH_DUE = "auto_dispatch:due"
+REDIS_KEY_DISPATCH_ARMED = "auto_dispatch:armed"
+REDIS_KEY_DISPATCH_WAKE = "auto_dispatch:wake"
+REDIS_KEY_BREAD_WRITES = "bread_writes"
+REDIS_KEY_OUTBOX = f"{REDIS_KEY_PREFIX}:outbox"
+REDIS_KEY_OUTBOX_BAKERIES = "outbox:bakeries"
+REDIS_KEY_OUTBOX_DEAD = "outbox:dead"
+REDIS_KEY_ADMIN_NOTIFICATIONS = "admin_notifications"
+REDIS_KEY_MQTT_STATE = "mqtt_state:{0}"
+REDIS_KEY_MQTT_STATE_LOCK = "mqtt_state_lock:{0}"
+
+# Upper bound on how long a materialized ETA table is trusted without a
+# version bump; covers mutation paths that do not call mark_eta_table_stale.
+ETA_TABLE_MAX_AGE_S = 30
+
+# An armed dispatcher run that has not cleared auto_dispatch:armed this long
+# after its deadline is presumed lost, so the next event arms a new one.
+DISPATCH_ARM_GRACE_S = 30
+
+# Consumer group and consumer reading bread_writes (application.bread_writer).
+BREAD_WRITES_GROUP = "bread_writer"
+BREAD_WRITES_CONSUMER = "bread_writer"
+
+# Cap on admin_notifications while no notifier drains it; oldest entries go first.
+ADMIN_NOTIFICATIONS_MAXLEN = 10000
 
 
 def get_urgent_item_key(bakery_id: int, urgent_id: str) -> str:
@@ -362,6 +411,7 @@ async def get_bakery_reservations(r, bakery_id: int, fetch_from_redis_first=True
             pipe.expire(order_key, ttl)
         
         await pipe.execute()
+        await mark_eta_table_stale(r, bakery_id)
         print("fetch reservation from db")
 
         return reservation_dict
@@ -392,6 +442,7 @@ async def get_bakery_time_per_bread(r, bakery_id: int, fetch_from_redis_first=Tr
             pipe.expire(time_key, ttl)
         
         await pipe.execute()
+        await rebuild_urgent_remaining_seconds(r, bakery_id)
         print("fetch time per bread from db")
         return time_per_bread
 
@@ -409,6 +460,7 @@ def reset_time_per_bread_sync(r, db, bakery_id: int):
         pipe.expire(time_key, ttl)
 
     pipe.execute()
+    r.register_script(LUA_URGENT_REMAINING_REBUILD)(*_urgent_remaining_rebuild_call(bakery_id))
     print("fetch time per bread from db")
     return time_per_bread
 
@@ -491,78 +543,581 @@ async def get_user_current_ticket(r, bakery_id: int) -> int | None:
         return None
 
 
-async def load_queue_state(r, bakery_id: int):
+# Per-bakery outbox (settings.OUTBOX, application.outbox_worker): a stream of
+# deferred DB writes, each a tasks.py task name plus its JSON-encoded args.
+# Scripts append to it in the same call as the state change it records;
+# KEYS[k] is the bakery's outbox stream, KEYS[k + 1] outbox:bakeries and
+# ARGV[a] the bakery id, or '' while the outbox is off.
+_LUA_OUTBOX_FN = """
+    local function outbox_at(k, a)
+        if not ARGV[a] or ARGV[a] == '' then
+            return nil
+        end
+        return {stream = KEYS[k], bakeries = KEYS[k + 1], bakery_id = ARGV[a]}
+    end
+
+    local function outbox_add(outbox, task, args_json)
+        if not outbox then
+            return
+        end
+        redis.call('XADD', outbox.stream, '*', 'task', task, 'args', args_json)
+        redis.call('SADD', outbox.bakeries, outbox.bakery_id)
+    end
+"""
+
+
+# Queue allocator state lives in Redis as:
+#   queue_meta       HASH   seeded, max, current_served (highest served
+#                           ticket), issue_cutoff (highest cutoff used by
+#                           LUA_ISSUE_TICKET), parity_determined,
+#                           single_parity, multi_parity, snapshot_event_id
+#   queue_free_odd   ZSET   unconsumed odd numbers below max (score = number)
+#   queue_free_even  ZSET   unconsumed even numbers below max
+#   queue_events     STREAM append-only issue/serve/burn events
+#   queue_state      STRING compacted snapshot (BakeryQueueState.dumps());
+#                           covers every event up to meta.snapshot_event_id
+#   queue_archive    HASH   number -> JSON of served/placeholder tickets
+#                           dropped from the hot snapshot by compaction
+#   queue_served     SET    ticket numbers already served today
+# Issuing or serving a ticket is one O(1) XADD; compact_queue_state folds
+# the log into the snapshot periodically.
+
+LUA_ISSUE_TICKET = _LUA_OUTBOX_FN + """
+    local meta = KEYS[1]
+    local free_odd = KEYS[2]
+    local free_even = KEYS[3]
+    local events = KEYS[4]
+    local reservations = KEYS[5]
+    local order = KEYS[6]
+    local last_ticket = KEYS[7]
+    local current_served = KEYS[8]
+    local bread_max_ticket = KEYS[9]
+    local prep_state = KEYS[10]
+
+    local kind = ARGV[1]
+    local quantity = tonumber(ARGV[2])
+    local value = ARGV[3]
+    local now = ARGV[4]
+    local ttl = tonumber(ARGV[5])
+    local outbox = outbox_at(11, 6)
+    local bread_requirements = ARGV[7]
+    local note = ARGV[8]
+
+    if redis.call('HGET', meta, 'seeded') ~= '1' then
+        return {0, 0}
+    end
+
+    -- Effective current_served: served tickets, the previous cutoff, the
+    -- explicit cutoff, any ticket that already has breads, and the ticket
+    -- the baker is preparing right now.
+    local threshold = tonumber(redis.call('HGET', meta, 'current_served') or '0') or 0
+    local cutoff = tonumber(redis.call('HGET', meta, 'issue_cutoff') or '0') or 0
+    if cutoff > threshold then threshold = cutoff end
+    local served = tonumber(redis.call('GET', current_served) or '0') or 0
+    if served > threshold then threshold = served end
+    local bread_max = tonumber(redis.call('GET', bread_max_ticket) or '0') or 0
+    if bread_max > threshold then threshold = bread_max end
+    local prep = redis.call('GET', prep_state)
+    if prep then
+        local tid = tonumber(string.match(prep, '^(%d+)'))
+        if tid and tid > threshold then threshold = tid end
+    end
+
+    local raw_single = redis.call('HGET', meta, 'single_parity')
+    local raw_multi = redis.call('HGET', meta, 'multi_parity')
+    local single_parity = raw_single and tonumber(raw_single)
+    local multi_parity = raw_multi and tonumber(raw_multi)
+    if not single_parity or not multi_parity then
+        if kind == 'single' then
+            single_parity, multi_parity = 1, 0
+        else
+            single_parity, multi_parity = 0, 1
+        end
+        redis.call('HSET', meta, 'single_parity', single_parity, 'multi_parity', multi_parity, 'parity_determined', 1)
+    end
+
+    local parity = multi_parity
+    local need = quantity
+    if kind == 'single' then
+        parity = single_parity
+        need = 1
+    end
+
+    local free_key = free_even
+    if parity == 1 then free_key = free_odd end
+
+    local consumed = {}
+    local slots = redis.call('ZRANGEBYSCORE', free_key, '(' .. threshold, '+inf', 'LIMIT', 0, need)
+    if #slots >= need then
+        for i, slot in ipairs(slots) do consumed[i] = slot end
+        redis.call('ZREM', free_key, unpack(slots))
+    else
+        local max_number = tonumber(redis.call('HGET', meta, 'max') or '0') or 0
+        local candidate = math.max(max_number, threshold) + 1
+        if candidate % 2 ~= parity then candidate = candidate + 1 end
+        for gap = max_number + 1, candidate - 1 do
+            if gap % 2 == 1 then
+                redis.call('ZADD', free_odd, gap, gap)
+            else
+                redis.call('ZADD', free_even, gap, gap)
+            end
+        end
+        redis.call('HSET', meta, 'max', candidate)
+        consumed[1] = tostring(candidate)
+    end
+
+    local ticket = consumed[#consumed]
+    local assigned = tonumber(ticket)
+
+    local ok = redis.call('HSETNX', reservations, ticket, value)
+    if ok == 1 then
+        redis.call('ZADD', order, assigned, ticket)
+        redis.call('SET', last_ticket, ticket)
+        redis.call('XADD', events, '*',
+            'type', 'issue', 'number', ticket, 'kind', kind, 'quantity', quantity,
+            'ts', now, 'served', threshold, 'slots', table.concat(consumed, ',', 1, #consumed - 1))
+        if outbox then
+            -- register_new_customer rebuilds the customer token from the issue time.
+            outbox_add(outbox, 'register_new_customer', cjson.encode(
+                {assigned, tonumber(outbox.bakery_id), cjson.decode(bread_requirements),
+                 false, cjson.null, note, tonumber(now)}))
+        end
+    else
+        -- The number is taken by a stray reservation: keep it consumed.
+        redis.call('XADD', events, '*', 'type', 'burn', 'numbers', table.concat(consumed, ','))
+    end
+
+    -- Kept apart from current_served, which only serves advance: the
+    -- cutoff counts tickets that are still waiting.
+    redis.call('HSET', meta, 'issue_cutoff', threshold)
+    for i = 1, 7 do
+        redis.call('EXPIRE', KEYS[i], ttl)
+    end
+
+    return {assigned, ok}
+"""
+
+def _outbox_keys(bakery_id: int) -> list[str]:
+    return [REDIS_KEY_OUTBOX.format(bakery_id), REDIS_KEY_OUTBOX_BAKERIES]
+
+
+def _outbox_arg(bakery_id: int) -> str:
+    return str(int(bakery_id)) if settings.OUTBOX else ""
+
+
+def outbox_add_to_pipe(pipe, bakery_id: int, task: str, args: list):
+    """Queue an outbox entry on ``pipe``, next to the state change it records."""
+    pipe.xadd(REDIS_KEY_OUTBOX.format(bakery_id), {"task": task, "args": json.dumps(args)})
+    pipe.sadd(REDIS_KEY_OUTBOX_BAKERIES, int(bakery_id))
+
+
+async def outbox_add(r, bakery_id: int, task: str, args: list):
+    pipe = r.pipeline(transaction=True)
+    outbox_add_to_pipe(pipe, bakery_id, task, args)
+    await pipe.execute()
+
+
+async def outbox_bakeries(r) -> list[int]:
+    return sorted(int(b) for b in await r.smembers(REDIS_KEY_OUTBOX_BAKERIES))
+
+
+async def read_outbox(r, bakery_ids, count: int, block_ms: int | None = None) -> dict[int, list[tuple[str, str, list]]]:
+    """
+    Oldest entries of each bakery's outbox as {bakery: [(entry_id, task, args)]}.
+    Applied entries are deleted (drop_outbox_entries), so reading from the
+    start always yields what is still to be done.
+    """
+    if not bakery_ids:
+        return {}
+    streams = await r.xread(
+        {REDIS_KEY_OUTBOX.format(b): "0" for b in bakery_ids}, count=int(count), block=block_ms
+    )
+    out = {}
+    for stream, entries in streams or []:
+        bakery_id = int(stream.split(":")[1])
+        out[bakery_id] = [(entry_id, fields["task"], json.loads(fields["args"])) for entry_id, fields in entries]
+    return out
+
+
+async def drop_outbox_entries(r, bakery_id: int, entry_ids):
+    if entry_ids:
+        await r.xdel(REDIS_KEY_OUTBOX.format(bakery_id), *entry_ids)
+
+
+async def dead_letter_outbox_entry(r, bakery_id: int, entry_id: str, task: str, args: list, error: str):
+    """Park an entry that keeps failing in outbox:dead and drop it from the bakery outbox."""
+    pipe = r.pipeline(transaction=True)
+    pipe.xadd(
+        REDIS_KEY_OUTBOX_DEAD,
+        {"bakery_id": int(bakery_id), "entry_id": entry_id, "task": task, "args": json.dumps(args), "error": error},
+    )
+    pipe.xdel(REDIS_KEY_OUTBOX.format(bakery_id), entry_id)
+    await pipe.execute()
+
+
+# Dispatch can serve out of order, so "already served" is the ticket's own
+# entry in queue_served, not a comparison with current_served.
+_LUA_MARK_TICKET_SERVED_FN = """
+    local function mark_ticket_served(meta, events, served, ticket, now, ttl)
+        if redis.call('SADD', served, ticket) == 0 then
+            return 0
+        end
+        redis.call('EXPIRE', served, ttl)
+
+        local number = tonumber(ticket)
+        if number > (tonumber(redis.call('HGET', meta, 'current_served') or '0') or 0) then
+            redis.call('HSET', meta, 'current_served', number)
+        end
+        redis.call('XADD', events, '*', 'type', 'serve', 'number', ticket, 'ts', now)
+        redis.call('EXPIRE', events, ttl)
+        return 1
+    end
+"""
+
+LUA_MARK_TICKET_SERVED = _LUA_MARK_TICKET_SERVED_FN + """
+    return mark_ticket_served(KEYS[1], KEYS[2], KEYS[3], ARGV[1], ARGV[2], tonumber(ARGV[3]))
+"""
+
+LUA_COMPACT_QUEUE_STATE = """
+    local meta = KEYS[1]
+    local snapshot = KEYS[2]
+    local events = KEYS[3]
+    local free_odd = KEYS[4]
+    local free_even = KEYS[5]
+    local archive = KEYS[6]
+    local expected = ARGV[1]
+    local cursor = ARGV[2]
+    local payload = ARGV[3]
+    local ttl = tonumber(ARGV[4])
+    local min_id = ARGV[5]
+    local floor = ARGV[6]
+    local archived = cjson.decode(ARGV[7])
+
+    -- Another compaction (or a full rewrite) got in first.
+    if (redis.call('HGET', meta, 'snapshot_event_id') or '0-0') ~= expected then
+        return 0
+    end
+
+    -- Tickets dropped from the windowed snapshot go to the cold archive.
+    local has_archived = false
+    for number, row in pairs(archived) do
+        redis.call('HSET', archive, number, row)
+        has_archived = true
+    end
+    if has_archived then
+        redis.call('EXPIRE', archive, ttl)
+    end
+
+    redis.call('SET', snapshot, payload, 'EX', ttl)
+    redis.call('HSET', meta, 'snapshot_event_id', cursor)
+    redis.call('XTRIM', events, 'MINID', min_id)
+    -- Slots at or below the snapshot floor can never be handed out again.
+    redis.call('ZREMRANGEBYSCORE', free_odd, '-inf', floor)
+    redis.call('ZREMRANGEBYSCORE', free_even, '-inf', floor)
+    return 1
+"""
+
+
+def _queue_state_keys(bakery_id: int) -> list[str]:
+    return [
+        REDIS_KEY_QUEUE_META.format(bakery_id),
+        REDIS_KEY_QUEUE_FREE_ODD.format(bakery_id),
+        REDIS_KEY_QUEUE_FREE_EVEN.format(bakery_id),
+        REDIS_KEY_QUEUE_EVENTS.format(bakery_id),
+    ]
+
+
+async def _load_legacy_queue_state(r, bakery_id: int):
+    """Build a BakeryQueueState from the pre-index sources.
+
+    Order: the old JSON ``queue_state`` key, today's DB snapshot, then a
+    fresh state.
+    """
     from application.bakery_queue_model import BakeryQueueState
 
-    key = REDIS_KEY_QUEUE_STATE.format(bakery_id)
-    raw = await r.get(key)
-    import json
+    raw = await r.get(REDIS_KEY_QUEUE_STATE.format(bakery_id))
+    if raw:
+        try:
+            return BakeryQueueState.loads(raw)
+        except Exception:
+            # Redis payload is corrupted: fall through to the DB snapshot.
+            pass
 
-    if not raw:
-        # No Redis state: try to restore from today's DB snapshot first.
-        from application.database import SessionLocal
-        from application import crud
+    with SessionLocal() as db:
+        snapshot = crud.get_today_queue_state_snapshot(db, bakery_id)
 
-        with SessionLocal() as db:
-            snapshot = crud.get_today_queue_state_snapshot(db, bakery_id)
+    if snapshot and snapshot.state_json:
+        try:
+            return BakeryQueueState.from_dict(json.loads(snapshot.state_json))
+        except Exception:
+            # Fallback to fresh state if snapshot is corrupted.
+            pass
 
-        if snapshot and snapshot.state_json:
-            try:
-                data = json.loads(snapshot.state_json)
-                return BakeryQueueState.from_dict(data)
-            except Exception:
-                # Fallback to fresh state if snapshot is corrupted.
-                pass
+    return BakeryQueueState()
 
-        # Fresh state: seed next_number from today's last ticket so
-        # hardware ticket IDs remain monotonic across restarts.
-        state = BakeryQueueState()
-        last_ticket = await get_last_ticket_number(r, bakery_id)
-        state.next_number = last_ticket + 1
-        return state
+
+async def _seed_queue_state(r, bakery_id: int) -> None:
+    """Populate the Redis allocator structures once for today.
+
+    Every ticket number already handed out today (reservations, wait list,
+    DB customers) is burned so a lost snapshot can never reissue a number.
+    Guarded by a short lock so concurrent workers do not seed twice.
+    """
+    lock_key = REDIS_KEY_QUEUE_SEED_LOCK.format(bakery_id)
+    token = uuid.uuid4().hex
+    if not await r.set(lock_key, token, nx=True, ex=10):
+        # Another worker is seeding; give it a moment before retrying.
+        await asyncio.sleep(0.05)
+        return
 
     try:
-        data = json.loads(raw)
-    except Exception:
-        # Redis payload is corrupted: attempt DB snapshot, else fall back
-        # to a fresh state seeded from today's last ticket.
-        from application.database import SessionLocal
-        from application import crud
+        if await r.hget(REDIS_KEY_QUEUE_META.format(bakery_id), "seeded") == "1":
+            return
+
+        state = await _load_legacy_queue_state(r, bakery_id)
+
+        pipe = r.pipeline()
+        pipe.hkeys(REDIS_KEY_RESERVATIONS.format(bakery_id))
+        pipe.hkeys(REDIS_KEY_WAIT_LIST.format(bakery_id))
+        reserved, waiting = await pipe.execute()
 
         with SessionLocal() as db:
-            snapshot = crud.get_today_queue_state_snapshot(db, bakery_id)
+            used_today = crud.get_today_ticket_ids(db, bakery_id)
 
-        if snapshot and snapshot.state_json:
-            try:
-                data = json.loads(snapshot.state_json)
-                return BakeryQueueState.from_dict(data)
-            except Exception:
-                pass
+        for number in set(map(int, reserved)) | set(map(int, waiting)) | set(used_today):
+            state.burn_number(number)
 
-        state = BakeryQueueState()
-        last_ticket = await get_last_ticket_number(r, bakery_id)
-        state.next_number = last_ticket + 1
-        return state
+        await save_queue_state(r, bakery_id, state)
+    finally:
+        if await r.get(lock_key) == token:
+            await r.delete(lock_key)
 
-    return BakeryQueueState.from_dict(data)
 
+async def issue_ticket(
+    r, bakery_id: int, bread_count_data: dict[str, int], time_per_bread=None, note: str = ""
+) -> tuple[int, bool]:
+    """Allocate a ticket number and add its reservation in one atomic call.
 
-async def save_queue_state(r, bakery_id: int, state) -> None:
-    key = REDIS_KEY_QUEUE_STATE.format(bakery_id)
+    With settings.OUTBOX the customer's register_new_customer entry is
+    queued by the same call. Returns ``(ticket_id, created)``; ``created``
+    is False when the allocated number unexpectedly already had a
+    reservation.
+    """
+    time_per_bread = time_per_bread or await get_bakery_time_per_bread(r, bakery_id)
+    reservation = [int(bread_count_data.get(bid, 0)) for bid in time_per_bread.keys()]
+    total = sum(reservation)
+
+    keys = _queue_state_keys(bakery_id) + [
+        REDIS_KEY_RESERVATIONS.format(bakery_id),
+        REDIS_KEY_RESERVATION_ORDER.format(bakery_id),
+        REDIS_KEY_LAST_KEY.format(bakery_id),
+        REDIS_KEY_CURRENT_SERVED.format(bakery_id),
+        REDIS_KEY_BREAD_MAX_TICKET.format(bakery_id),
+        REDIS_KEY_PREP_STATE.format(bakery_id),
+        *_outbox_keys(bakery_id),
+    ]
+    args = [
+        "single" if total == 1 else "multi",
+        str(total),
+        ",".join(map(str, reservation)),
+        str(int(time.time())),
+        str(seconds_until_midnight_iran()),
+        _outbox_arg(bakery_id),
+        json.dumps({str(bid): int(c) for bid, c in bread_count_data.items()}),
+        note or "",
+    ]
+
+    script = r.register_script(LUA_ISSUE_TICKET)
+    for _ in range(5):
+        ticket_id, created = await script(keys=keys, args=args)
+        if int(ticket_id) > 0:
+            await mark_eta_table_stale(r, bakery_id)
+            return int(ticket_id), int(created) == 1
+        await _seed_queue_state(r, bakery_id)
+
+    raise HTTPException(status_code=503, detail="Ticket allocator is busy, try again")
+
+
+async def mark_queue_ticket_served(r, bakery_id: int, ticket_id: int) -> bool:
+    """Atomically mark a ticket served and log a serve event; False if it already was."""
+    meta_key, _, _, events_key = _queue_state_keys(bakery_id)
+    script = r.register_script(LUA_MARK_TICKET_SERVED)
+    result = await script(
+        keys=[meta_key, events_key, REDIS_KEY_QUEUE_SERVED.format(bakery_id)],
+        args=[
+            str(int(ticket_id)),
+            str(int(time.time())),
+            str(seconds_until_midnight_iran()),
+        ],
+    )
+    return result == 1
+
+
+async def burn_queue_tickets(r, bakery_id: int, numbers) -> None:
+    """Drop ticket records while keeping their numbers consumed for today."""
+    numbers = sorted(int(n) for n in numbers)
+    if not numbers:
+        return
+    _, free_odd_key, free_even_key, events_key = _queue_state_keys(bakery_id)
+    pipe = r.pipeline(transaction=True)
+    pipe.zrem(free_odd_key, *numbers)
+    pipe.zrem(free_even_key, *numbers)
+    pipe.xadd(events_key, {"type": "burn", "numbers": ",".join(map(str, numbers))})
+    pipe.expire(events_key, seconds_until_midnight_iran())
+    await pipe.execute()
+
+
+async def _load_queue_state_with_cursor(r, bakery_id: int):
+    """Return ``(state, snapshot_cursor, last_event_id)`` from snapshot + log tail.
+
+    ``state`` is None when today's structures have not been seeded yet.
+    """
+    from application.bakery_queue_model import BakeryQueueState
 
-    import json
+    meta_key, _, _, events_key = _queue_state_keys(bakery_id)
+    pipe = r.pipeline(transaction=True)
+    pipe.hmget(meta_key, "seeded", "snapshot_event_id")
+    pipe.get(REDIS_KEY_QUEUE_STATE.format(bakery_id))
+    pipe.xrange(events_key)
+    (seeded, cursor), raw, events = await pipe.execute()
+
+    if seeded != "1":
+        return None, None, None
+
+    cursor = cursor or "0-0"
+    state = BakeryQueueState.loads(raw) if raw else BakeryQueueState()
+    last_event_id = cursor
+    for event_id, fields in events:
+        if _stream_id_le(event_id, cursor):
+            continue
+        state.apply_event(fields)
+        last_event_id = event_id
+
+    return state, cursor, last_event_id
+
+
+def _stream_id_le(a: str, b: str) -> bool:
+    ams, aseq = a.split("-")
+    bms, bseq = b.split("-")
+    return (int(ams), int(aseq)) <= (int(bms), int(bseq))
+
+
+async def load_queue_state(r, bakery_id: int):
+    state, _, _ = await _load_queue_state_with_cursor(r, bakery_id)
+    if state is None:
+        return await _load_legacy_queue_state(r, bakery_id)
+    return state
+
+
+async def compact_queue_state(r, bakery_id: int, archive_served: bool = True):
+    """Fold the event log into the queue_state snapshot and trim it.
+
+    With ``archive_served`` the snapshot is windowed: finished tickets at or
+    below current_served move to the queue_archive hash, in the same script
+    that checks no other compaction got in first.
+    Returns the compacted state, or None when there was nothing to fold
+    (or another compaction won the race).
+    """
+    state, cursor, last_event_id = await _load_queue_state_with_cursor(r, bakery_id)
+    if state is None or last_event_id == cursor:
+        return None
+
+    ttl = seconds_until_midnight_iran()
+    archived = state.archive_served() if archive_served else []
+
+    ms, seq = last_event_id.split("-")
+    meta_key, free_odd_key, free_even_key, events_key = _queue_state_keys(bakery_id)
+    script = r.register_script(LUA_COMPACT_QUEUE_STATE)
+    ok = await script(
+        keys=[
+            meta_key,
+            REDIS_KEY_QUEUE_STATE.format(bakery_id),
+            events_key,
+            free_odd_key,
+            free_even_key,
+            REDIS_KEY_QUEUE_ARCHIVE.format(bakery_id),
+        ],
+        args=[
+            cursor,
+            last_event_id,
+            state.dumps(),
+            str(ttl),
+            f"{ms}-{int(seq) + 1}",
+            str(state.floor),
+            json.dumps({
+                str(t.number): json.dumps(t.to_dict(), ensure_ascii=False) for t in archived
+            }, ensure_ascii=False),
+        ],
+    )
+    return state if ok == 1 else None
 
-    payload = json.dumps(state.to_dict(), ensure_ascii=False)
+
+async def get_archived_queue_tickets(r, bakery_id: int) -> list[dict]:
+    """Served and placeholder tickets moved out of the hot queue state today."""
+    raw = await r.hgetall(REDIS_KEY_QUEUE_ARCHIVE.format(bakery_id))
+    return [json.loads(raw[k]) for k in sorted(raw, key=int)]
+
+
+async def get_queue_ticket(r, bakery_id: int, ticket_id: int):
+    """Return the Ticket for ``ticket_id`` from the archive or the hot state."""
+    from application.bakery_queue_model import Ticket
+
+    raw = await r.hget(REDIS_KEY_QUEUE_ARCHIVE.format(bakery_id), str(int(ticket_id)))
+    if raw:
+        return Ticket(**json.loads(raw))
+    state = await load_queue_state(r, bakery_id)
+    return state.tickets.get(int(ticket_id))
+
+
+async def save_queue_state(r, bakery_id: int, state) -> None:
+    """Replace the Redis queue state with ``state`` and snapshot it to the DB.
+
+    Only used for seeding and full rewrites; hot paths append events via
+    issue_ticket / mark_queue_ticket_served / burn_queue_tickets.
+    """
+    data = state.to_dict()
+    consumed = set(data["consumed_numbers"])
+    max_number = state.max_number
+    free = [n for n in range(state.floor + 1, max_number) if n not in consumed]
+
+    meta = {
+        "seeded": 1,
+        "max": max_number,
+        "current_served": int(data["current_served"] or 0),
+        "parity_determined": 1 if data["parity_determined"] else 0,
+        "snapshot_event_id": "0-0",
+    }
+    if data["single_parity"] is not None and data["multi_parity"] is not None:
+        meta["single_parity"] = int(data["single_parity"])
+        meta["multi_parity"] = int(data["multi_parity"])
+
+    meta_key, free_odd_key, free_even_key, events_key = _queue_state_keys(bakery_id)
+    snapshot_key = REDIS_KEY_QUEUE_STATE.format(bakery_id)
+    served_key = REDIS_KEY_QUEUE_SERVED.format(bakery_id)
+    served = [n for n, t in state.tickets.items() if t.status == "served"]
     ttl = seconds_until_midnight_iran()
-    await r.set(key, payload, ex=ttl)
+
+    pipe = r.pipeline(transaction=True)
+    pipe.delete(meta_key, free_odd_key, free_even_key, events_key, served_key)
+    pipe.hset(meta_key, mapping=meta)
+    if served:
+        pipe.sadd(served_key, *served)
+        pipe.expire(served_key, ttl)
+    odd = {str(n): n for n in free if n % 2 == 1}
+    even = {str(n): n for n in free if n % 2 == 0}
+    if odd:
+        pipe.zadd(free_odd_key, odd)
+    if even:
+        pipe.zadd(free_even_key, even)
+    pipe.set(snapshot_key, state.dumps(), ex=ttl)
+    for key in (meta_key, free_odd_key, free_even_key):
+        pipe.expire(key, ttl)
+    await pipe.execute()
 
     # Persist a daily snapshot to the database for crash recovery and
     # debugging. This keeps one row per bakery per local_tehran_date.
-    from application.database import SessionLocal
-    from application import crud
-
     with SessionLocal() as db:
-        crud.upsert_queue_state_snapshot(db, bakery_id, state.to_dict())
+        crud.upsert_queue_state_snapshot(db, bakery_id, data)
 
 
 async def get_effective_current_served(r, bakery_id: int) -> int:
@@ -570,7 +1125,8 @@ async def get_effective_current_served(r, bakery_id: int) -> int:
 
     This combines:
     - explicit current_served (set from new_bread),
-    - the maximum ticket_id that has any bread recorded in breads,
+    - the maximum ticket_id that has had a bread recorded today
+      (bread_max_ticket),
     - and the currently active prep_state ticket (if baker has started
       a ticket but no bread has been cooked yet).
 
@@ -581,35 +1137,18 @@ async def get_effective_current_served(r, bakery_id: int) -> int:
     but without loading or touching any of the legacy slot/next/last keys.
     """
     current_key = REDIS_KEY_CURRENT_SERVED.format(bakery_id)
-    breads_key = REDIS_KEY_BREADS.format(bakery_id)
+    max_bread_ticket_key = REDIS_KEY_BREAD_MAX_TICKET.format(bakery_id)
     prep_state_key = REDIS_KEY_PREP_STATE.format(bakery_id)
 
     pipe = r.pipeline()
     pipe.get(current_key)
-    pipe.zrangebyscore(breads_key, '-inf', '+inf')
+    pipe.get(max_bread_ticket_key)
     pipe.get(prep_state_key)
-    raw_current, all_breads, raw_prep_state = await pipe.execute()
+    raw_current, raw_max_bread_ticket, raw_prep_state = await pipe.execute()
 
     current_served = int(raw_current) if raw_current is not None else 0
 
-    max_ticket_from_breads = 0
-    if all_breads:
-        for bread_value in all_breads:
-            if isinstance(bread_value, (bytes, bytearray)):
-                try:
-                    bread_value = bread_value.decode()
-                except Exception:
-                    continue
-            if ':' in str(bread_value):
-                try:
-                    parts = str(bread_value).split(':')
-                    if len(parts) < 2:
-                        continue
-                    cid = int(parts[-1])
-                    if cid > max_ticket_from_breads:
-                        max_ticket_from_breads = cid
-                except (ValueError, TypeError):
-                    continue
+    max_ticket_from_breads = int(raw_max_bread_ticket) if raw_max_bread_ticket else 0
 
     if max_ticket_from_breads > current_served:
         current_served = max_ticket_from_breads
@@ -634,7 +1173,7 @@ async def get_slots_state(r, bakery_id: int):
     last_single_key = REDIS_KEY_LAST_SINGLE.format(bakery_id)
     last_multi_key = REDIS_KEY_LAST_MULTI.format(bakery_id)
     current_key = REDIS_KEY_CURRENT_SERVED.format(bakery_id)
-    breads_key = REDIS_KEY_BREADS.format(bakery_id)
+    max_bread_ticket_key = REDIS_KEY_BREAD_MAX_TICKET.format(bakery_id)
 
     pipe = r.pipeline()
     pipe.smembers(multi_key)
@@ -643,8 +1182,8 @@ async def get_slots_state(r, bakery_id: int):
     pipe.get(last_single_key)
     pipe.get(last_multi_key)
     pipe.get(current_key)
-    pipe.zrangebyscore(breads_key, '-inf', '+inf')
-    raw_multi, raw_single, raw_next, raw_last_single, raw_last_multi, raw_current, all_breads = await pipe.execute()
+    pipe.get(max_bread_ticket_key)
+    raw_multi, raw_single, raw_next, raw_last_single, raw_last_multi, raw_current, raw_max_bread_ticket = await pipe.execute()
 
     slots_for_multis = {int(x) for x in raw_multi} if raw_multi else set()
     slots_for_singles = {int(x) for x in raw_single} if raw_single else set()
@@ -659,24 +1198,7 @@ async def get_slots_state(r, bakery_id: int):
     last_multi = int(raw_last_multi) if raw_last_multi is not None else 0
     current_served = int(raw_current) if raw_current is not None else 0
 
-    max_ticket_from_breads = 0
-    if all_breads:
-        for bread_value in all_breads:
-            if isinstance(bread_value, (bytes, bytearray)):
-                try:
-                    bread_value = bread_value.decode()
-                except Exception:
-                    continue
-            if ':' in str(bread_value):
-                try:
-                    parts = str(bread_value).split(':')
-                    if len(parts) < 2:
-                        continue
-                    cid = int(parts[-1])
-                    if cid > max_ticket_from_breads:
-                        max_ticket_from_breads = cid
-                except (ValueError, TypeError):
-                    continue
+    max_ticket_from_breads = int(raw_max_bread_ticket) if raw_max_bread_ticket else 0
 
     if max_ticket_from_breads > current_served:
         current_served = max_ticket_from_breads
@@ -937,9 +1459,22 @@ async def update_timeout(r, bakery_id: int, new_timeout_second: int):
     await pipe.execute()
 
 
-async def remove_customer_from_upcoming_customers(r, bakery_id, customer_id):
+async def remove_customer_from_upcoming_customers(r, bakery_id, customer_id, outbox: bool = False):
+    """With ``outbox`` the DB removal is queued in the bakery outbox in the same transaction."""
+    zkey = REDIS_KEY_UPCOMING_CUSTOMERS.format(bakery_id)
+    if not outbox:
+        await r.zrem(zkey, customer_id)
+        return
+    pipe = r.pipeline(transaction=True)
+    pipe.zrem(zkey, customer_id)
+    outbox_add_to_pipe(pipe, bakery_id, "remove_customer_from_upcoming_customers", [int(customer_id), int(bakery_id)])
+    await pipe.execute()
+
+async def remove_customers_from_upcoming_customers(r, bakery_id, customer_ids):
+    if not customer_ids:
+        return
     zkey = REDIS_KEY_UPCOMING_CUSTOMERS.format(bakery_id)
-    await r.zrem(zkey, customer_id)
+    await r.zrem(zkey, *customer_ids)
 
 async def remove_customer_from_upcoming_customers_and_add_to_current_upcoming_customer(r, bakery_id, customer_id, preparation_time):
     cur_key = REDIS_KEY_CURRENT_UPCOMING_CUSTOMER.format(bakery_id)
@@ -971,8 +1506,15 @@ async def load_urgent_from_db(r, bakery_id: int, time_per_bread: dict):
     - PENDING -> urgent_queue ZSET
     - PROCESSING -> urgent_prep_state + item status
 
-    This makes urgent injections resilient to Redis restarts.
+    This makes urgent injections resilient to Redis restarts. The urgent_log
+    projection read by the serve/summary endpoints is rebuilt from all of
+    today's logs.
     """
+    with SessionLocal() as db:
+        all_rows = crud.get_today_urgent_bread_logs(db, bakery_id)
+
+    await _rebuild_urgent_log_projection(r, bakery_id, all_rows)
+
     if not time_per_bread:
         return
 
@@ -981,16 +1523,18 @@ async def load_urgent_from_db(r, bakery_id: int, time_per_bread: dict):
 
     queue_key = REDIS_KEY_URGENT_QUEUE.format(bakery_id)
     prep_key = REDIS_KEY_URGENT_PREP_STATE.format(bakery_id)
+    active_keys = _urgent_index_keys(bakery_id)[:3]
 
-    with SessionLocal() as db:
-        rows = crud.get_today_urgent_bread_logs(db, bakery_id, statuses=["PENDING", "PROCESSING"])
+    rows = [row for row in all_rows if str(row.status) in ("PENDING", "PROCESSING")]
 
     if not rows:
+        await r.delete(*active_keys)
         return
 
     pipe = r.pipeline(transaction=True)
     pipe.delete(queue_key)
     pipe.delete(prep_key)
+    pipe.delete(*active_keys)
 
     processing_id = None
     pending_ids = []
@@ -1025,6 +1569,7 @@ async def load_urgent_from_db(r, bakery_id: int, time_per_bread: dict):
             "reason": str(getattr(row, "reason", "") or ""),
         })
         pipe.expire(item_key, ttl)
+        await _apply_urgent_active(r, bakery_id, urgent_id, bread_ids_sorted, 1, client=pipe)
 
         if str(row.status) == "PROCESSING" and processing_id is None:
             processing_id = urgent_id
@@ -1041,6 +1586,35 @@ async def load_urgent_from_db(r, bakery_id: int, time_per_bread: dict):
 
     await pipe.execute()
 
+async def _rebuild_urgent_log_projection(r, bakery_id: int, rows):
+    prefix = REDIS_KEY_URGENT_LOG.format(bakery_id)
+    tickets_key = REDIS_KEY_URGENT_LOG_TICKETS.format(bakery_id)
+    ttl = seconds_until_midnight_iran()
+
+    stale_tickets = set(await r.hvals(tickets_key) or [])
+    stale_tickets.update(str(int(row.ticket_id)) for row in rows if row.ticket_id is not None)
+
+    pipe = r.pipeline(transaction=True)
+    pipe.delete(tickets_key, *[f"{prefix}:{tid}" for tid in stale_tickets])
+    for row in rows:
+        if row.ticket_id is None or str(row.status) == "CANCELLED":
+            continue
+        try:
+            original_map = json.loads(row.original_breads_json) if row.original_breads_json else {}
+        except Exception:
+            original_map = {}
+        tid = str(int(row.ticket_id))
+        entry = {
+            "breads": original_map if isinstance(original_map, dict) else {},
+            "status": str(row.status),
+            "created_at": int(row.register_date.timestamp()) if row.register_date else 0,
+        }
+        pipe.hset(tickets_key, str(row.urgent_id), tid)
+        pipe.hset(f"{prefix}:{tid}", str(row.urgent_id), json.dumps(entry))
+        pipe.expire(f"{prefix}:{tid}", ttl)
+    pipe.expire(tickets_key, ttl)
+    await pipe.execute()
+
 async def initialize_redis_sets_only_12_oclock(r, bakery_id: int):
     await reset_timeout(r, bakery_id)
 
@@ -1058,6 +1632,10 @@ async def purge_bakery_data(r, bakery_id: int):
         REDIS_KEY_TIMEOUT_SEC.format(bakery_id),
         REDIS_KEY_PREP_STATE.format(bakery_id),
         REDIS_KEY_BREADS.format(bakery_id),
+        REDIS_KEY_BREAD_COUNTS.format(bakery_id),
+        REDIS_KEY_BREAD_LAST_TS.format(bakery_id),
+        REDIS_KEY_BREAD_MAX_TICKET.format(bakery_id),
+        REDIS_KEY_BREAD_SEQ.format(bakery_id),
         REDIS_KEY_DISPLAY_CUSTOMER.format(bakery_id),
         REDIS_KEY_LAST_BREAD_TIME.format(bakery_id),
         REDIS_KEY_BREAD_TIME_DIFFS.format(bakery_id),
@@ -1068,18 +1646,33 @@ async def purge_bakery_data(r, bakery_id: int):
         REDIS_KEY_LAST_MULTI.format(bakery_id),
         REDIS_KEY_CURRENT_SERVED.format(bakery_id),
         REDIS_KEY_QUEUE_STATE.format(bakery_id),
+        REDIS_KEY_QUEUE_META.format(bakery_id),
+        REDIS_KEY_QUEUE_EVENTS.format(bakery_id),
+        REDIS_KEY_QUEUE_ARCHIVE.format(bakery_id),
+        REDIS_KEY_QUEUE_SERVED.format(bakery_id),
+        REDIS_KEY_QUEUE_FREE_ODD.format(bakery_id),
+        REDIS_KEY_QUEUE_FREE_EVEN.format(bakery_id),
         REDIS_KEY_SERVED_TICKETS.format(bakery_id),
         REDIS_KEY_USER_CURRENT_TICKET.format(bakery_id),
         REDIS_KEY_URGENT_QUEUE.format(bakery_id),
         REDIS_KEY_URGENT_PREP_STATE.format(bakery_id),
         REDIS_KEY_URGENT_ALL_IDS.format(bakery_id),
         REDIS_KEY_URGENT_EPOCH.format(bakery_id),
+        REDIS_KEY_URGENT_ACTIVE_IDS.format(bakery_id),
+        REDIS_KEY_URGENT_ACTIVE_BREADS.format(bakery_id),
+        REDIS_KEY_URGENT_REMAINING_S.format(bakery_id),
+        REDIS_KEY_URGENT_LOG_TICKETS.format(bakery_id),
         REDIS_KEY_BASE_DONE.format(bakery_id),
+        REDIS_KEY_ETA_TABLE.format(bakery_id),
+        REDIS_KEY_ETA_VERSION.format(bakery_id),
+        REDIS_KEY_ETA_LOCK.format(bakery_id),
+        REDIS_KEY_DISPATCH_STATS.format(bakery_id),
     ]
 
     pipe = r.pipeline(transaction=True)
     for key in keys:
         pipe.delete(key)
+    pipe.zrem(REDIS_KEY_DISPATCH_DUE, int(bakery_id))
     await pipe.execute()
 
     # Also remove all urgent item hashes for this bakery.
@@ -1105,6 +1698,18 @@ async def purge_bakery_data(r, bakery_id: int):
             pipe3.delete(k)
         await pipe3.execute()
 
+    pattern_urgent_log = f"{REDIS_KEY_URGENT_LOG.format(int(bakery_id))}:*"
+    urgent_log_keys = []
+    async for k in r.scan_iter(match=pattern_urgent_log, count=200):
+        urgent_log_keys.append(k)
+    if urgent_log_keys:
+        pipe4 = r.pipeline(transaction=True)
+        for k in urgent_log_keys:
+            pipe4.delete(k)
+        await pipe4.execute()
+
+    await _delete_ticket_bread_sets(r, bakery_id)
+
 async def get_tickets_total_bread_counts(r, bakery_id: int, ticket_ids: list[int], time_per_bread: dict) -> dict[int, dict[str, int]]:
     """
     Returns the TRUE total bread requirements for list of tickets.
@@ -1138,46 +1743,38 @@ async def get_tickets_total_bread_counts(r, bakery_id: int, ticket_ids: list[int
         
     return result
 
-async def select_best_ticket_by_ready_time(r, bakery_id: int):
+async def _ticket_ready_times(r, bakery_id: int) -> list[tuple[int, float]]:
     """
-    Identifies tickets that are 100% finished (Base + All History Urgent)
-    AND have finished the baking timer.
+    (ticket, ready_at) in queue order for tickets that are 100% finished
+    (Base + All History Urgent); ready_at is when the baking timer of their
+    last loaf runs out.
     """
-    res_key = REDIS_KEY_RESERVATIONS.format(bakery_id)
     order_key = REDIS_KEY_RESERVATION_ORDER.format(bakery_id)
-    breads_key = REDIS_KEY_BREADS.format(bakery_id)
     base_done_key = REDIS_KEY_BASE_DONE.format(bakery_id)
 
     pipe = r.pipeline()
     pipe.zrange(order_key, 0, -1)
-    pipe.zrangebyscore(breads_key, '-inf', '+inf')
+    pipe.hgetall(REDIS_KEY_BREAD_COUNTS.format(bakery_id))
+    pipe.hgetall(REDIS_KEY_BREAD_LAST_TS.format(bakery_id))
     pipe.smembers(base_done_key)
     pipe.hgetall(REDIS_KEY_TIME_PER_BREAD.format(bakery_id))
     results = await pipe.execute()
     
-    order_ids_raw, all_breads, base_done_raw, time_per_bread_raw = results
-    if not order_ids_raw: return None
+    order_ids_raw, counts_raw, last_ts_raw, base_done_raw, time_per_bread_raw = results
+    if not order_ids_raw: return []
 
     order_ids = [int(x) for x in order_ids_raw]
     base_done_ids = set(int(x) for x in (base_done_raw or []) if x)
     time_per_bread = {str(k): int(v) for k, v in time_per_bread_raw.items()}
 
-    # 1. Count ALL physical breads in Redis for the day
-    breads_by_customer = defaultdict(list)
-    for b_val in all_breads:
-        try:
-            parts = str(b_val).split(':')
-            ts, cid = float(parts[0]), int(parts[-1])
-            breads_by_customer[cid].append(ts)
-        except: continue
-    for cid in breads_by_customer: breads_by_customer[cid].sort()
+    # 1. Physical breads in Redis per ticket (count + latest ready time)
+    bread_counts, bread_last_ts = decode_bread_index(counts_raw, last_ts_raw)
 
     # 2. Get Cumulative Targets (Base + Urgent) using new helper
     total_requirements = await get_tickets_total_bread_counts(r, bakery_id, order_ids, time_per_bread)
     urgent_active = await get_urgent_breads_by_ticket(r, bakery_id, time_per_bread)
     
-    now = time.time()
-    best_tid, best_wait = None, None
+    ready_times = []
 
     for tid in order_ids:
         if tid in urgent_active: continue # Pending active urgent work
@@ -1189,286 +1786,200 @@ async def select_best_ticket_by_ready_time(r, bakery_id: int):
         # We need base count specifically to limit virtual fill
         # (We can re-fetch or infer. For safety, let's assume if base_done, we fill gaps)
         
-        breads_ts = breads_by_customer.get(tid, [])
-        
+        made = bread_counts.get(tid, 0)
+
         # If in waitlist, fill missing with virtual 0.0s
-        if tid in base_done_ids:
-            missing = max(0, total_required - len(breads_ts))
-            breads_ts = sorted(([0.0] * missing) + breads_ts)
+        virtual = max(0, total_required - made) if tid in base_done_ids else 0
 
-        if len(breads_ts) >= total_required and total_required >= 0:
-            if total_required == 0:
-                wait_seconds = 0
-            else:
-                last_loaf_done_at = breads_ts[total_required - 1]
-                wait_seconds = max(0, int(last_loaf_done_at - now))
-            
-            if best_wait is None or wait_seconds < best_wait:
-                best_tid, best_wait = tid, wait_seconds
+        last_loaf_done_at = eta_engine.bread_ready_at(made, bread_last_ts.get(tid, 0.0), total_required, virtual)
+        if last_loaf_done_at is not None:
+            ready_times.append((tid, last_loaf_done_at))
+
+    return ready_times
+
+async def select_best_ticket_by_ready_time(r, bakery_id: int):
+    """
+    Identifies tickets that are 100% finished (Base + All History Urgent)
+    AND have finished the baking timer.
+    """
+    now = time.time()
+    best_tid, best_wait = None, None
+
+    for tid, last_loaf_done_at in await _ticket_ready_times(r, bakery_id):
+        wait_seconds = max(0, int(last_loaf_done_at - now))
+        if best_wait is None or wait_seconds < best_wait:
+            best_tid, best_wait = tid, wait_seconds
 
     if best_tid is not None:
         return {"ticket_id": best_tid, "wait_until": best_wait, "ready": best_wait <= 0}
     return None
 
-async def rebuild_prep_state(r, bakery_id: int):
+async def select_ready_tickets_by_ready_time(r, bakery_id: int) -> tuple[list[int], Optional[int]]:
     """
-    STRICT STATE MACHINE.
-    Uses get_tickets_total_bread_counts for accurate locking logic.
+    Every ticket select_best_ticket_by_ready_time would report as ready, in
+    ready-time order (queue order on ties), plus the wait in seconds of the
+    first ticket that is finished but still baking (None if there is none).
     """
-    prep_state_key = REDIS_KEY_PREP_STATE.format(bakery_id)
-    u_prep_key = REDIS_KEY_URGENT_PREP_STATE.format(bakery_id)
-    res_key = REDIS_KEY_RESERVATIONS.format(bakery_id)
-    order_key = REDIS_KEY_RESERVATION_ORDER.format(bakery_id)
-    breads_key = REDIS_KEY_BREADS.format(bakery_id)
-    base_done_key = REDIS_KEY_BASE_DONE.format(bakery_id)
-    u_queue_key = REDIS_KEY_URGENT_QUEUE.format(bakery_id)
+    now = time.time()
+    ready, next_wait = [], None
 
-    pipe = r.pipeline()
-    pipe.get(prep_state_key)
-    pipe.get(u_prep_key)
-    pipe.zrange(order_key, 0, -1)
-    pipe.hgetall(res_key)
-    pipe.zrangebyscore(breads_key, '-inf', '+inf')
-    pipe.smembers(base_done_key)
-    pipe.zcard(u_queue_key)
-    pipe.hgetall(REDIS_KEY_TIME_PER_BREAD.format(bakery_id))
-    raw = await pipe.execute()
-    
-    prep_raw, u_prep_raw, order_ids_raw, res_map, all_breads, b_done_raw, u_q_len, time_per_bread_raw = raw
-    def _t(v): return v.decode() if isinstance(v, (bytes, bytearray)) else (str(v) if v else None)
-    
-    if not order_ids_raw:
-        await r.delete(prep_state_key)
-        # Urgent-only mode: still process pending/processing urgent items even when queue is empty.
-        if u_prep_raw:
-            return
-        if int(u_q_len or 0) > 0:
-            await start_next_urgent_if_available(r, bakery_id)
-        return
+    for pos, (tid, last_loaf_done_at) in enumerate(await _ticket_ready_times(r, bakery_id)):
+        wait_seconds = max(0, int(last_loaf_done_at - now))
+        if wait_seconds <= 0:
+            ready.append((last_loaf_done_at, pos, tid))
+        elif next_wait is None or wait_seconds < next_wait:
+            next_wait = wait_seconds
 
-    order_ids = [int(_t(x)) for x in order_ids_raw]
-    b_done_ids = set(int(_t(x)) for x in (b_done_raw or []) if x)
-    time_per_bread = {str(k): int(v) for k, v in time_per_bread_raw.items()}
+    return [tid for _, _, tid in sorted(ready)], next_wait
 
-    # --- 0. NOTE: No implicit dispatch here ---
-    # Keep rebuild_prep_state side-effect free for queue/wait-list transitions.
-    # Ready-ticket dispatch is handled by the canonical task:
-    # application.tasks.auto_dispatch_ready_tickets
+async def schedule_dispatch(r, bakery_id: int, at: float | None = None) -> Optional[float]:
+    """
+    Make sure the auto-dispatcher looks at ``bakery_id`` no later than ``at``
+    (default: now). An earlier pending deadline is kept.
 
-    # --- 1. URGENT LOCK ---
-    if u_prep_raw:
-        await r.delete(prep_state_key)
-        return
+    Returns the time a dispatcher run has to be armed for, or None when a
+    run is already armed at or before it.
+    """
+    now = time.time()
+    at = now if at is None else float(at)
+    script = r.register_script(LUA_DISPATCH_SCHEDULE)
+    armed = await script(
+        keys=[REDIS_KEY_DISPATCH_DUE, REDIS_KEY_DISPATCH_ARMED],
+        args=[int(bakery_id), at, now, DISPATCH_ARM_GRACE_S],
+    )
+    return at if int(armed or 0) else None
 
-    # Calculate Totals for Locking Decisions
-    total_reqs = await get_tickets_total_bread_counts(r, bakery_id, order_ids, time_per_bread)
 
-    # --- 2. NORMAL LOCK ---
-    curr_p = _t(prep_raw)
-    if curr_p and ':' in curr_p:
-        tid, _ = map(int, curr_p.split(':'))
-        if tid in order_ids:
-            total_needed = sum(total_reqs.get(tid, {}).values())
-            
-            # Count cumulative breads in oven
-            made = sum(1 for b in all_breads if str(b).endswith(f":{tid}"))
-            if tid in b_done_ids: made = max(made, total_needed)
-            
-            if made < total_needed:
-                await r.set(prep_state_key, f"{tid}:{made}", ex=seconds_until_midnight_iran())
-                return
-            else:
-                await r.delete(prep_state_key)
+async def request_dispatch(r, bakery_id: int, at: float | None = None) -> None:
+    """schedule_dispatch, waking the dispatcher when needed.
 
-    # --- 3. URGENT QUEUE ---
-    if int(u_q_len or 0) > 0:
-        await r.delete(prep_state_key)
-        await start_next_urgent_if_available(r, bakery_id)
+    Called whenever a bread is recorded or a ticket's requirements change.
+    With AUTO_DISPATCH_WORKER the long-running dispatch worker is woken
+    through auto_dispatch:wake, otherwise a Celery run is armed.
+    """
+    if not settings.ENABLE_AUTO_DISPATCH_READY_TICKETS:
         return
+    wake_at = await schedule_dispatch(r, bakery_id, at)
+    if wake_at is None:
+        return
+    if settings.AUTO_DISPATCH_WORKER:
+        pipe = r.pipeline()
+        pipe.lpush(REDIS_KEY_DISPATCH_WAKE, int(bakery_id))
+        pipe.ltrim(REDIS_KEY_DISPATCH_WAKE, 0, 0)
+        await pipe.execute()
+    else:
+        from application import tasks
+        tasks.arm_auto_dispatch(wake_at)
 
-    # --- 4. NORMAL PRIORITY ---
-    for tid in order_ids:
-        if tid in b_done_ids: continue
-        
-        total_needed = sum(total_reqs.get(tid, {}).values())
-        made = sum(1 for b in all_breads if str(b).endswith(f":{tid}"))
-        
-        if made < total_needed:
-            await r.set(prep_state_key, f"{tid}:0", ex=seconds_until_midnight_iran())
-            return
 
-async def calculate_ready_status(
-        r, bakery_id: int, current_user_detail: dict, time_per_bread: dict,
-        reservation_keys: list, reservation_number: int, reservation_dict: dict
-):
-    """
-    Calculate if customer's breads are ready.
-    Now uses actual customer_id from bread values: "timestamp:customer_id"
+async def pop_due_dispatch(r, now: float | None = None) -> Optional[int]:
+    """Remove and return the earliest bakery whose dispatch deadline has passed."""
+    script = r.register_script(LUA_DISPATCH_POP_DUE)
+    bakery_id = await script(keys=[REDIS_KEY_DISPATCH_DUE], args=[time.time() if now is None else now])
+    return int(bakery_id) if bakery_id else None
 
-    Logic:
-    1. No breads at all → Calculate full preparation time for all customers before + this customer
-    2. Some breads exist but none for this customer → Calculate remaining time for previous customers + this customer
-    3. Some breads for this customer but not all → Calculate remaining breads × average prep time
-    4. All breads for this customer exist → Check if last bread is done baking
-    """
-    breads_key = REDIS_KEY_BREADS.format(bakery_id)
-    baking_time_key = REDIS_KEY_BAKING_TIME_S.format(bakery_id)
-    base_done_key = REDIS_KEY_BASE_DONE.format(bakery_id)
 
-    now = time.time()
-    urgent_original_extra = await get_urgent_original_counts_for_ticket(r, bakery_id, reservation_number, time_per_bread)
-    effective_user_detail = dict(current_user_detail or {})
-    if urgent_original_extra:
-        for k, v in urgent_original_extra.items():
-            effective_user_detail[k] = int(effective_user_detail.get(k, 0)) + int(v)
+async def next_dispatch_deadline(r) -> Optional[float]:
+    """Earliest deadline in auto_dispatch:due, or None when no bakery is waiting."""
+    head = await r.zrange(REDIS_KEY_DISPATCH_DUE, 0, 0, withscores=True)
+    return float(head[0][1]) if head else None
+
+
+async def rearm_dispatch(r) -> Optional[float]:
+    """Deadline the next dispatcher run must be armed for, if any."""
+    script = r.register_script(LUA_DISPATCH_REARM)
+    at = await script(keys=[REDIS_KEY_DISPATCH_DUE, REDIS_KEY_DISPATCH_ARMED], args=[time.time(), DISPATCH_ARM_GRACE_S])
+    return float(at) if at else None
+
+async def rebuild_prep_state(r, bakery_id: int):
+    """
+    STRICT STATE MACHINE.
+    Urgent lock > normal lock (started ticket) > urgent queue > first ticket
+    in order that still needs breads. Runs server-side in one script
+    (LUA_BAKE_ONE_BREAD, "rebuild" mode).
 
-    bread_count = sum(effective_user_detail.values())
-    average_cook_time = sum(time_per_bread.values()) // len(time_per_bread)
-    people_before = [key for key in reservation_keys if key < reservation_number]
+    No implicit dispatch here: ready-ticket dispatch is handled by
+    application.tasks.auto_dispatch_ready_tickets.
+    """
+    await _run_prep_state_script(r, bakery_id, "rebuild")
 
-    # Fetch all breads and baking time
+async def _fetch_eta_inputs(r, bakery_id: int, time_per_bread: dict) -> dict:
+    """Live inputs of eta_engine.compute_eta besides the reservations."""
     pipe = r.pipeline()
-    pipe.get(baking_time_key)
-    pipe.zrangebyscore(breads_key, '-inf', '+inf')
-    pipe.smembers(base_done_key)
-    baking_time_s_raw, all_breads, base_done_raw = await pipe.execute()
+    pipe.get(REDIS_KEY_BAKING_TIME_S.format(bakery_id))
+    pipe.hgetall(REDIS_KEY_BREAD_COUNTS.format(bakery_id))
+    pipe.hgetall(REDIS_KEY_BREAD_LAST_TS.format(bakery_id))
+    pipe.smembers(REDIS_KEY_BASE_DONE.format(bakery_id))
+    baking_time_s_raw, counts_raw, last_ts_raw, base_done_raw = await pipe.execute()
 
-    baking_time_s = int(baking_time_s_raw) if baking_time_s_raw else 0
-    order_ids = [int(x) for x in reservation_keys]
-    reservation_dict = {int(k): [int(x) for x in v.split(',')] for k, v in reservation_dict.items()}
-    reservation_keys = sorted(reservation_dict.keys())
+    bread_counts, bread_last_ts = decode_bread_index(counts_raw, last_ts_raw)
+    return {
+        "bread_counts": bread_counts,
+        "bread_last_ts": bread_last_ts,
+        "base_done_ids": set(int(x) for x in (base_done_raw or []) if x is not None),
+        "urgent_by_ticket": await get_urgent_breads_by_ticket(r, bakery_id, time_per_bread),
+        "baking_time_s": int(baking_time_s_raw) if baking_time_s_raw else 0,
+        "urgent_remaining_time": await get_urgent_remaining_total_time(r, bakery_id, time_per_bread),
+    }
 
-    base_done_ids = set(int(x) for x in (base_done_raw or []) if x is not None)
 
-    breads_by_customer = defaultdict(list)
-    for bread_value in all_breads or []:
-        bread_value = str(bread_value)
-        if not bread_value or ':' not in bread_value:
-            continue
-        try:
-            parts = str(bread_value).split(':')
-            if len(parts) < 2:
-                continue
-            ts_str = parts[0]
-            cid_str = parts[-1]
-            cid = int(cid_str)
-            ts = float(ts_str)
-        except Exception:
-            continue
-        breads_by_customer[cid].append(ts)
-    for cid in breads_by_customer:
-        breads_by_customer[cid].sort()
-
-    # Tickets that moved to wait list have their baked breads removed from Redis.
-    # Use base_done marker to treat base breads as already baked (timestamp=0.0).
-    for tid, counts in reservation_dict.items():
-        if int(tid) not in base_done_ids:
-            continue
-        base_total = int(sum(int(x) for x in counts))
-        if base_total <= 0:
-            continue
-        existing = breads_by_customer.get(int(tid), [])
-        breads_by_customer[int(tid)] = sorted(([0.0] * base_total) + list(existing))
+async def record_dispatch_stats(r, bakery_id: int, duration_ms: float | None, outcome: str) -> None:
+    """
+    Today's auto-dispatch stats for one bakery (dispatch_stats hash):
+    "<outcome>" run counts (ok / error / timeout) and, for finished runs,
+    total_ms, max_ms and last_ms.
+    """
+    key = REDIS_KEY_DISPATCH_STATS.format(bakery_id)
+    pipe = r.pipeline()
+    pipe.hincrby(key, outcome, 1)
+    if duration_ms is not None:
+        pipe.hincrbyfloat(key, "total_ms", duration_ms)
+        pipe.hset(key, "last_ms", duration_ms)
+    pipe.expire(key, seconds_until_midnight_iran())
+    await pipe.execute()
+    if duration_ms is not None:
+        script = r.register_script(LUA_HASH_MAX)
+        await script(keys=[key], args=["max_ms", duration_ms])
 
-    urgent_by_ticket = await get_urgent_breads_by_ticket(r, bakery_id, time_per_bread)
-    urgent_remaining_time = await get_urgent_remaining_total_time(r, bakery_id, time_per_bread)
 
-    total_needed_by_ticket = {}
-    base_detail_by_ticket = {}
-    for tid, counts in reservation_dict.items():
-        base_detail = {bid: int(c) for bid, c in zip(time_per_bread.keys(), counts)}
-        base_detail_by_ticket[int(tid)] = base_detail
-        extra = urgent_by_ticket.get(int(tid), {}) or {}
-        total_needed_by_ticket[int(tid)] = int(sum(base_detail.values())) + int(sum(int(v) for v in extra.values()))
+async def compute_queue_wait_times(
+        r, bakery_id: int, reservation_dict: dict[int, list[int]], time_per_bread: dict, bread_ids=None
+) -> tuple[dict[int, int], dict[int, dict[str, int]]]:
+    """
+    Fetch the live inputs (bread index, base_done, baking time, urgent work)
+    and run the ETA engine over every ticket in reservation_dict.
 
-    now = time.time()
-    avg_cook_time = (sum(time_per_bread.values()) // len(time_per_bread)) if time_per_bread else 0
+    Returns (wait seconds by ticket, unfinished urgent breads by ticket).
+    """
+    inputs = await _fetch_eta_inputs(r, bakery_id, time_per_bread)
+    wait_times = eta_engine.compute_wait_times(
+        reservation_dict, time_per_bread, now=time.time(), bread_ids=bread_ids, **inputs
+    )
+    return wait_times, inputs["urgent_by_ticket"]
 
-    def estimate_wait_until(tid: int) -> int:
-        need_total = int(total_needed_by_ticket.get(int(tid), 0))
-        if need_total <= 0:
-            return 0
 
-        breads_ts = breads_by_customer.get(int(tid), [])
-        if breads_ts and len(breads_ts) >= need_total:
-            ready_at = float(breads_ts[need_total - 1])
-            return max(0, int(ready_at - now))
-
-        if not all_breads:
-            total_wait_s = int(baking_time_s)
-            for key in reservation_keys:
-                if int(key) > int(tid):
-                    break
-                base_counts = reservation_dict[int(key)]
-                base_detail = {bid: int(c) for bid, c in zip(time_per_bread.keys(), base_counts)}
-                extra = urgent_by_ticket.get(int(key), {}) or {}
-                eff = dict(base_detail)
-                for k, v in extra.items():
-                    eff[k] = int(eff.get(k, 0)) + int(v)
-                total_wait_s += sum(int(count) * int(time_per_bread[str(bid)]) for bid, count in eff.items())
-            if urgent_remaining_time:
-                total_wait_s += int(urgent_remaining_time)
-            return int(total_wait_s)
-
-        if not breads_ts:
-            base_detail = dict(base_detail_by_ticket.get(int(tid), {}))
-            extra = urgent_by_ticket.get(int(tid), {}) or {}
-            eff = dict(base_detail)
-            for k, v in extra.items():
-                eff[k] = int(eff.get(k, 0)) + int(v)
-
-            prep_time = sum(int(count) * int(time_per_bread[str(bid)]) for bid, count in eff.items())
-
-            total_remaining_before = 0
-            for cid in [key for key in reservation_keys if int(key) < int(tid)]:
-                cid = int(cid)
-                made = len(breads_by_customer.get(cid, []))
-                needed = int(total_needed_by_ticket.get(cid, 0))
-                if made >= needed:
-                    continue
-                if made > 0:
-                    total_remaining_before += (needed - made) * int(avg_cook_time)
-                else:
-                    base_detail_prev = dict(base_detail_by_ticket.get(cid, {}))
-                    extra_prev = urgent_by_ticket.get(cid, {}) or {}
-                    eff_prev = dict(base_detail_prev)
-                    for k, v in extra_prev.items():
-                        eff_prev[k] = int(eff_prev.get(k, 0)) + int(v)
-                    total_remaining_before += sum(
-                        int(count) * int(time_per_bread[str(bid)])
-                        for bid, count in eff_prev.items()
-                    )
-
-            total_wait_s = int(total_remaining_before) + int(prep_time) + int(baking_time_s)
-            if urgent_remaining_time:
-                total_wait_s += int(urgent_remaining_time)
-            return int(total_wait_s)
-
-        remaining = need_total - len(breads_ts)
-        active_types = []
-        base_detail = dict(base_detail_by_ticket.get(int(tid), {}))
-        extra = urgent_by_ticket.get(int(tid), {}) or {}
-        eff = dict(base_detail)
-        for k, v in extra.items():
-            eff[k] = int(eff.get(k, 0)) + int(v)
-        for bread_type, count in eff.items():
-            if int(count) > 0:
-                active_types.append(int(time_per_bread[str(bread_type)]))
-        this_avg = (sum(active_types) // len(active_types)) if active_types else int(avg_cook_time)
-        return int(remaining * this_avg + baking_time_s)
-
-    best_tid = None
-    best_wait = None
-    for tid in order_ids:
-        if int(tid) not in reservation_dict:
-            continue
-        w = int(estimate_wait_until(int(tid)))
-        if best_wait is None or w < best_wait or (w == best_wait and int(tid) < int(best_tid)):
-            best_tid = int(tid)
-            best_wait = int(w)
+async def calculate_ready_status(
+        r, bakery_id: int, current_user_detail: dict, time_per_bread: dict,
+        reservation_keys: list, reservation_number: int, reservation_dict: dict
+):
+    """
+    Pick the queued ticket that will be ready first and report its wait.
+    Wait times come from eta_engine.compute_wait_times (see there for the
+    four estimate cases).
+    """
+    order_ids = [int(x) for x in reservation_keys]
+    reservation_dict = {int(k): [int(x) for x in v.split(',')] for k, v in reservation_dict.items()}
+    reservation_keys = sorted(reservation_dict.keys())
+
+    # Reservation vectors here follow time_per_bread's own key order.
+    wait_times, urgent_by_ticket = await compute_queue_wait_times(
+        r, bakery_id, reservation_dict, time_per_bread, bread_ids=list(time_per_bread.keys())
+    )
 
-    if best_tid is None:
+    best = eta_engine.select_best_ticket(order_ids, wait_times)
+    if best is None:
         return None
+    best_tid, best_wait = best
 
     return {
         "ticket_id": int(best_tid),
@@ -1482,39 +1993,213 @@ async def calculate_ready_status(
     }
 
 
-async def create_urgent_item(r, bakery_id, ticket_id, bread_requirements, time_per_bread, reason: str | None = None):
-    # Fix UnboundLocalError by initializing pipe immediately
+async def mark_eta_table_stale(r, bakery_id: int) -> None:
+    """Bump the ETA version so the next reader recomputes the table once."""
+    version_key = REDIS_KEY_ETA_VERSION.format(bakery_id)
+    pipe = r.pipeline()
+    pipe.incr(version_key)
+    pipe.expire(version_key, seconds_until_midnight_iran())
+    await pipe.execute()
+
+
+async def refresh_eta_table(r, bakery_id: int) -> dict[str, str]:
+    """
+    Recompute the materialized ETA table and swap it in atomically.
+
+    Hash fields (JSON values):
+      "<ticket>" - position, wait_s / ready_at (see eta_engine.compute_eta),
+                   counts, urgent_breads, in_queue_s (before timeout) and
+                   empty_slot_time_avg
+      "_totals"  - [[ticket, total breads], ...] in ticket order
+      "_meta"    - version it was built for, computed_at, size, the
+                   best-ticket candidates (the fixed-wait ticket that wins
+                   among fixed waits plus every ticket with a ready_at) and
+                   their rows, so the winner's row comes from the same read
+
+    Returns the written mapping.
+    """
+    pipe = r.pipeline()
+    pipe.get(REDIS_KEY_ETA_VERSION.format(bakery_id))
+    pipe.hgetall(REDIS_KEY_TIME_PER_BREAD.format(bakery_id))
+    pipe.hgetall(REDIS_KEY_RESERVATIONS.format(bakery_id))
+    pipe.zrange(REDIS_KEY_RESERVATION_ORDER.format(bakery_id), 0, -1)
+    version_raw, time_per_bread_raw, reservations_map, order_ids_raw = await pipe.execute()
+
+    time_per_bread = {str(k): int(v) for k, v in (time_per_bread_raw or {}).items()}
+    reservation_dict = {
+        int(k): [int(x) for x in str(v).split(',') if x != ''] for k, v in (reservations_map or {}).items()
+    }
+
+    etas, urgent_by_ticket = {}, {}
+    if time_per_bread and reservation_dict:
+        inputs = await _fetch_eta_inputs(r, bakery_id, time_per_bread)
+        urgent_by_ticket = inputs["urgent_by_ticket"]
+        # Reservation vectors follow time_per_bread's own key order.
+        etas = eta_engine.compute_eta(
+            reservation_dict, time_per_bread, bread_ids=list(time_per_bread.keys()), **inputs
+        )
+
+    keys = sorted(reservation_dict)
+    time_per_bread_list = [time_per_bread[str(b)] for b in sorted(int(k) for k in time_per_bread)]
+    average_bread_time = (sum(time_per_bread_list) // len(time_per_bread_list)) if time_per_bread_list else 0
+    empty_slots = eta_engine.empty_slot_counts(keys, reservation_dict)
+
+    rows = {}
+    totals = []
+    in_queue_s = 0
+    for position, tid in enumerate(keys):
+        counts = reservation_dict[tid]
+        in_queue_s += sum(c * t for c, t in zip(counts, time_per_bread_list))
+        wait_s, ready_at = etas.get(tid, (0, None))
+        rows[tid] = {
+            "position": position,
+            "wait_s": wait_s,
+            "ready_at": ready_at,
+            "counts": counts,
+            "urgent_breads": urgent_by_ticket.get(tid, {}),
+            "in_queue_s": in_queue_s,
+            "empty_slot_time_avg": empty_slots[tid] // 2 * average_bread_time,
+        }
+        totals.append([tid, sum(counts)])
+
+    order_ids = [int(x) for x in order_ids_raw or [] if int(x) in etas]
+    fixed = {tid: etas[tid][0] for tid in order_ids if etas[tid][1] is None}
+    best_fixed = eta_engine.select_best_ticket(order_ids, fixed)
+    ready_at = [[tid, etas[tid][1]] for tid in order_ids if etas[tid][1] is not None]
+    candidates = ([best_fixed[0]] if best_fixed else []) + [tid for tid, _ in ready_at]
+
+    mapping = {str(tid): json.dumps(row) for tid, row in rows.items()}
+    mapping["_totals"] = json.dumps(totals)
+    mapping["_meta"] = json.dumps({
+        "version": str(version_raw or 0),
+        "computed_at": time.time(),
+        "size": len(keys),
+        "best_fixed": list(best_fixed) if best_fixed else None,
+        "ready_at": ready_at,
+        "rows": {str(tid): rows[tid] for tid in candidates},
+    })
+
+    table_key = REDIS_KEY_ETA_TABLE.format(bakery_id)
+    tmp_key = f"{table_key}:tmp:{uuid.uuid4().hex}"
     pipe = r.pipeline(transaction=True)
+    pipe.hset(tmp_key, mapping=mapping)
+    pipe.expire(tmp_key, seconds_until_midnight_iran())
+    pipe.rename(tmp_key, table_key)
+    await pipe.execute()
+    return mapping
+
+
+async def get_eta_table_fields(r, bakery_id: int, *fields: str) -> list:
+    """
+    Read ``_meta`` plus ``fields`` from the ETA table in one round trip.
+
+    The table is rebuilt when its version is behind eta_version or it is
+    older than ETA_TABLE_MAX_AGE_S. Only one caller rebuilds at a time;
+    concurrent pollers keep serving the previous table meanwhile.
+
+    Returns the JSON-decoded values (None for missing), ``_meta`` first.
+    """
+    names = ["_meta", *fields]
+    pipe = r.pipeline()
+    pipe.get(REDIS_KEY_ETA_VERSION.format(bakery_id))
+    pipe.hmget(REDIS_KEY_ETA_TABLE.format(bakery_id), names)
+    version_raw, values = await pipe.execute()
+
+    meta = json.loads(values[0]) if values[0] else None
+    fresh = (
+        meta is not None
+        and meta.get("version") == str(version_raw or 0)
+        and time.time() - float(meta.get("computed_at", 0)) < ETA_TABLE_MAX_AGE_S
+    )
+    if not fresh:
+        lock_key = REDIS_KEY_ETA_LOCK.format(bakery_id)
+        acquired = await r.set(lock_key, "1", nx=True, ex=5)
+        if acquired or meta is None:
+            try:
+                mapping = await refresh_eta_table(r, bakery_id)
+            finally:
+                if acquired:
+                    await r.delete(lock_key)
+            values = [mapping.get(name) for name in names]
+
+    return [json.loads(v) if v else None for v in values]
+
+
+def select_best_eta_ticket(meta: dict | None, now: float | None = None) -> Optional[tuple[int, int]]:
+    """
+    (ticket, wait) that will be ready first, from an ETA table ``_meta``.
+    The ticket's row is ``meta["rows"][str(ticket)]``.
+    """
+    if not meta:
+        return None
+    now = time.time() if now is None else now
+    waits = {}
+    if meta.get("best_fixed"):
+        tid, wait_s = meta["best_fixed"]
+        waits[int(tid)] = int(wait_s)
+    for tid, ready_at in meta.get("ready_at") or []:
+        waits[int(tid)] = eta_engine.wait_at(None, ready_at, now)
+    return eta_engine.select_best_ticket(sorted(waits), waits)
+
+
+def _urgent_index_keys(bakery_id: int) -> list[str]:
+    """KEYS of the active urgent index, in the order the urgent scripts expect."""
+    return [
+        REDIS_KEY_URGENT_ACTIVE_IDS.format(bakery_id),
+        REDIS_KEY_URGENT_ACTIVE_BREADS.format(bakery_id),
+        REDIS_KEY_URGENT_REMAINING_S.format(bakery_id),
+        REDIS_KEY_TIME_PER_BREAD.format(bakery_id),
+    ]
+
+
+def _apply_urgent_active(r, bakery_id: int, urgent_id: str, bread_ids_sorted, sign: int, client=None):
+    """Add (sign=1) or remove (sign=-1) an urgent item in the active index.
+
+    Pass a transaction pipeline as ``client`` to apply it together with the
+    item's own writes; the script reads the item hash when it runs.
+    """
+    script = r.register_script(LUA_URGENT_ACTIVE_APPLY)
+    return script(
+        keys=[*_urgent_index_keys(bakery_id), get_urgent_item_key(bakery_id, urgent_id)],
+        args=[urgent_id, int(sign), ",".join(str(b) for b in bread_ids_sorted), seconds_until_midnight_iran()],
+        client=client,
+    )
+
+
+async def create_urgent_item(r, bakery_id, ticket_id, bread_requirements, time_per_bread, reason: str | None = None):
     bread_ids_sorted = sorted(time_per_bread.keys())
     encoded = ",".join(str(int(bread_requirements.get(bid, 0))) for bid in bread_ids_sorted)
     urgent_id = uuid.uuid4().hex
     now_ts = int(time.time())
-    ttl = seconds_until_midnight_iran()
 
     # Rule: Handle by Ticket ID order. We use Ticket ID as the ZSET score.
     score = int(ticket_id) if ticket_id else now_ts
 
-    item_key = get_urgent_item_key(bakery_id, urgent_id)
-    pipe.hset(item_key, mapping={
-        "ticket_id": "" if ticket_id is None else str(int(ticket_id)),
-        "original_breads": encoded,
-        "remaining_breads": encoded,
-        "status": "PENDING",
-        "created_at": str(now_ts),
-        "reason": str(reason or ""),
-    })
-    pipe.expire(item_key, ttl)
-    pipe.zadd(REDIS_KEY_URGENT_QUEUE.format(bakery_id), {urgent_id: score})
-    pipe.expire(REDIS_KEY_URGENT_QUEUE.format(bakery_id), ttl)
-    pipe.sadd(REDIS_KEY_URGENT_ALL_IDS.format(bakery_id), urgent_id)
-    
-    if ticket_id is not None:
-        h_key = f"{REDIS_KEY_URGENT_HISTORY.format(bakery_id)}:{int(ticket_id)}"
-        for bid, count in bread_requirements.items():
-            if int(count) > 0: pipe.hincrby(h_key, str(bid), int(count))
-        pipe.expire(h_key, ttl)
-        
-    await pipe.execute()
+    script = r.register_script(LUA_URGENT_CREATE)
+    await script(
+        keys=[
+            get_urgent_item_key(bakery_id, urgent_id),
+            REDIS_KEY_URGENT_QUEUE.format(bakery_id),
+            REDIS_KEY_URGENT_ALL_IDS.format(bakery_id),
+            *_urgent_index_keys(bakery_id),
+            *_outbox_keys(bakery_id),
+        ],
+        args=[
+            urgent_id,
+            "" if ticket_id is None else str(int(ticket_id)),
+            encoded,
+            str(now_ts),
+            str(reason or ""),
+            score,
+            seconds_until_midnight_iran(),
+            ",".join(bread_ids_sorted),
+            f"{REDIS_KEY_URGENT_HISTORY.format(bakery_id)}:",
+            _outbox_arg(bakery_id),
+            json.dumps([int(bakery_id), urgent_id, ticket_id, bread_requirements, reason]),
+        ],
+    )
+    await mark_eta_table_stale(r, bakery_id)
+    await request_dispatch(r, bakery_id)
     return urgent_id
 
 
@@ -1570,82 +2255,53 @@ async def get_urgent_history_by_ticket_ids(r, bakery_id: int, ticket_ids: list[i
     return out
 
 
+# Start the next PENDING urgent item of one ticket. urgent_queue scores
+# ticket-linked items by ticket id, so ZRANGEBYSCORE tid tid is that
+# ticket's sub-queue (ties in member order, as ZRANGE had them); status and
+# ticket_id are re-checked because standalone items are scored by time.
+LUA_START_NEXT_URGENT_FOR_TICKET = """
+    local urgent_queue = KEYS[1]
+    local urgent_prep = KEYS[2]
+    local ticket = tonumber(ARGV[1])
+    local urgent_item_prefix = ARGV[2]
+    local ttl = tonumber(ARGV[3])
+
+    local existing = redis.call('GET', urgent_prep)
+    if existing and existing ~= '' then
+        if tonumber(redis.call('HGET', urgent_item_prefix .. existing, 'ticket_id') or '') == ticket then
+            return existing
+        end
+        return false
+    end
+
+    for _, uid in ipairs(redis.call('ZRANGEBYSCORE', urgent_queue, ticket, ticket)) do
+        local item = urgent_item_prefix .. uid
+        if redis.call('HGET', item, 'status') == 'PENDING'
+                and tonumber(redis.call('HGET', item, 'ticket_id') or '') == ticket then
+            redis.call('ZREM', urgent_queue, uid)
+            redis.call('SET', urgent_prep, uid, 'EX', ttl)
+            redis.call('HSET', item, 'status', 'PROCESSING')
+            redis.call('EXPIRE', item, ttl)
+            return uid
+        end
+    end
+    return false
+"""
+
+
 async def start_next_urgent_for_ticket_if_available(r, bakery_id: int, ticket_id: int):
     """Start (set PROCESSING) the next PENDING urgent item for a specific ticket.
 
     This is used to ensure urgent breads never preempt a different ticket while
     still allowing a ticket to continue with its own urgent breads after its base
-    breads are finished.
+    breads are finished. Returns the processing urgent id of this ticket, or None.
     """
-    queue_key = REDIS_KEY_URGENT_QUEUE.format(bakery_id)
-    prep_key = REDIS_KEY_URGENT_PREP_STATE.format(bakery_id)
-    ttl = seconds_until_midnight_iran()
-
-    existing = await r.get(prep_key)
-    if existing:
-        existing_id = _normalize_redis_id(existing)
-        if not existing_id:
-            return None
-
-        item_key = get_urgent_item_key(bakery_id, str(existing_id))
-        existing_tid = await r.hget(item_key, "ticket_id")
-        try:
-            if existing_tid is not None:
-                existing_tid_txt = existing_tid.decode() if isinstance(existing_tid, (bytes, bytearray)) else str(existing_tid)
-            else:
-                existing_tid_txt = None
-            if existing_tid_txt is not None and existing_tid_txt != "" and int(existing_tid_txt) == int(ticket_id):
-                return str(existing_id)
-        except Exception:
-            return None
-        return None
-
-    urgent_ids = await r.zrange(queue_key, 0, -1)
-    if not urgent_ids:
-        return None
-
-    pipe = r.pipeline()
-    for uid in urgent_ids:
-        uid_txt = _normalize_redis_id(uid)
-        if not uid_txt:
-            continue
-        item_key = get_urgent_item_key(bakery_id, str(uid_txt))
-        pipe.hget(item_key, "status")
-        pipe.hget(item_key, "ticket_id")
-    raw = await pipe.execute()
-
-    chosen_id = None
-    for idx, uid in enumerate(urgent_ids):
-        status = raw[idx * 2]
-        tid = raw[idx * 2 + 1]
-        try:
-            status_txt = status.decode() if isinstance(status, (bytes, bytearray)) else str(status)
-        except Exception:
-            status_txt = str(status)
-        if status_txt != "PENDING":
-            continue
-        try:
-            tid_txt = tid.decode() if isinstance(tid, (bytes, bytearray)) else str(tid)
-            if tid_txt is None or tid_txt == "" or int(tid_txt) != int(ticket_id):
-                continue
-        except Exception:
-            continue
-        chosen_id = _normalize_redis_id(uid)
-        if not chosen_id:
-            continue
-        break
-
-    if not chosen_id:
-        return None
-
-    item_key = get_urgent_item_key(bakery_id, chosen_id)
-    pipe2 = r.pipeline(transaction=True)
-    pipe2.zrem(queue_key, chosen_id)
-    pipe2.set(prep_key, chosen_id, ex=ttl)
-    pipe2.hset(item_key, "status", "PROCESSING")
-    pipe2.expire(item_key, ttl)
-    await pipe2.execute()
-    return chosen_id
+    script = r.register_script(LUA_START_NEXT_URGENT_FOR_TICKET)
+    urgent_id = await script(
+        keys=[REDIS_KEY_URGENT_QUEUE.format(bakery_id), REDIS_KEY_URGENT_PREP_STATE.format(bakery_id)],
+        args=[int(ticket_id), get_urgent_item_key(bakery_id, ""), seconds_until_midnight_iran()],
+    )
+    return _normalize_redis_id(urgent_id) if urgent_id else None
 
 
 async def get_urgent_item(r, bakery_id: int, urgent_id: str):
@@ -1657,32 +2313,12 @@ async def get_urgent_item(r, bakery_id: int, urgent_id: str):
 
 
 async def start_next_urgent_if_available(r, bakery_id: int):
-    queue_key = REDIS_KEY_URGENT_QUEUE.format(bakery_id)
-    prep_key = REDIS_KEY_URGENT_PREP_STATE.format(bakery_id)
-    ttl = seconds_until_midnight_iran()
-
-    existing = await r.get(prep_key)
-    if existing:
-        existing_id = _normalize_redis_id(existing)
-        return str(existing_id) if existing_id else None
-
-    # ZRANGE now respects Ticket ID order (lowest first) because we set Score=TicketID
-    next_id = await r.zrange(queue_key, 0, 0)
-    if not next_id:
-        return None
-
-    urgent_id = _normalize_redis_id(next_id[0])
-    if not urgent_id:
-        return None
-    item_key = get_urgent_item_key(bakery_id, urgent_id)
-
-    pipe = r.pipeline(transaction=True)
-    pipe.zrem(queue_key, urgent_id)
-    pipe.set(prep_key, urgent_id, ex=ttl)
-    pipe.hset(item_key, "status", "PROCESSING")
-    pipe.expire(item_key, ttl)
-    await pipe.execute()
-    return urgent_id
+    script = r.register_script(LUA_URGENT_START_NEXT)
+    urgent_id = await script(
+        keys=[REDIS_KEY_URGENT_QUEUE.format(bakery_id), REDIS_KEY_URGENT_PREP_STATE.format(bakery_id)],
+        args=[get_urgent_item_key(bakery_id, ""), seconds_until_midnight_iran()],
+    )
+    return _normalize_redis_id(urgent_id) if urgent_id else None
 
 
 async def list_urgent_items(r, bakery_id: int):
@@ -1719,225 +2355,96 @@ async def list_urgent_items(r, bakery_id: int):
 
 
 async def get_urgent_breads_by_ticket(r, bakery_id: int, time_per_bread: dict) -> dict[int, dict[str, int]]:
-    """Return unfinished (PENDING/PROCESSING) urgent items only."""
+    """Return unfinished (PENDING/PROCESSING) urgent breads per ticket from the active index."""
     if not time_per_bread: return {}
-    def _txt(v): return v.decode() if isinstance(v, (bytes, bytearray)) else (str(v) if v else None)
-    
-    pipe0 = r.pipeline()
-    pipe0.smembers(REDIS_KEY_URGENT_ALL_IDS.format(bakery_id))
-    pipe0.hgetall(REDIS_KEY_URGENT_EPOCH.format(bakery_id))
-    all_ids, epoch_map_raw = await pipe0.execute()
-
-    if not all_ids: return {}
-
-    pipe = r.pipeline()
-    id_list = [(_normalize_redis_id(_txt(uid))) for uid in all_ids if _txt(uid)]
-    for uid in id_list:
-        item_key = get_urgent_item_key(bakery_id, uid)
-        pipe.hget(item_key, "ticket_id")
-        pipe.hget(item_key, "original_breads")
-        pipe.hget(item_key, "status")
-        pipe.hget(item_key, "created_at")
-    rows = await pipe.execute()
+    raw = await r.hgetall(REDIS_KEY_URGENT_ACTIVE_BREADS.format(bakery_id))
 
     out = {}
-    for i in range(0, len(rows), 4):
-        t_id_raw, orig_raw, status_raw, created_raw = rows[i:i+4]
-        status = _txt(status_raw)
-        # CRITICAL: Only count unfinished urgent work
-        if status not in ("PENDING", "PROCESSING"): continue
-        
-        tid = int(_txt(t_id_raw)) if t_id_raw else None
-        if tid:
-            bread_ids_sorted = sorted(time_per_bread.keys())
-            counts = _decode_counts(_txt(orig_raw) or "")
-            if len(counts) < len(bread_ids_sorted): counts += [0] * (len(bread_ids_sorted) - len(counts))
-            
-            m = out.setdefault(tid, {})
-            for bid, c in zip(bread_ids_sorted, counts):
-                if int(c) > 0: m[str(bid)] = m.get(str(bid), 0) + int(c)
-    return out
-
-
-async def cleanup_urgent_items_for_ticket(r, bakery_id: int, ticket_id: int, statuses=("DONE",)) -> int:
-    queue_key = REDIS_KEY_URGENT_QUEUE.format(bakery_id)
-    prep_key = REDIS_KEY_URGENT_PREP_STATE.format(bakery_id)
-    all_key = REDIS_KEY_URGENT_ALL_IDS.format(bakery_id)
-
-    def _as_text(v):
-        if v is None:
-            return None
-        if isinstance(v, (bytes, bytearray)):
-            try:
-                return v.decode()
-            except Exception:
-                return None
-        return str(v)
-
-    pipe0 = r.pipeline()
-    pipe0.smembers(all_key)
-    pipe0.zrange(queue_key, 0, -1)
-    pipe0.get(prep_key)
-    all_ids, urgent_ids, processing_raw = await pipe0.execute()
-
-    ids = list(all_ids or [])
-    for uid in (urgent_ids or []):
-        if uid not in ids:
-            ids.append(uid)
-    if processing_raw and processing_raw not in ids:
-        ids.append(processing_raw)
-
-    normalized_ids = []
-    seen = set()
-    for uid in ids:
-        uid_txt = _normalize_redis_id(_as_text(uid))
-        if not uid_txt:
-            continue
-        if uid_txt in seen:
-            continue
-        seen.add(uid_txt)
-        normalized_ids.append(uid_txt)
-
-    if not normalized_ids:
-        return 0
-
-    pipe = r.pipeline()
-    for uid_txt in normalized_ids:
-        item_key = get_urgent_item_key(bakery_id, str(uid_txt))
-        pipe.hget(item_key, "status")
-        pipe.hget(item_key, "ticket_id")
-    raw = await pipe.execute()
-
-    wanted = []
-    for idx, uid_txt in enumerate(normalized_ids):
-        status_raw = raw[idx * 2]
-        tid_raw = raw[idx * 2 + 1]
-        status_txt = _as_text(status_raw)
-        if status_txt is None or str(status_txt) not in set(str(x) for x in (statuses or [])):
-            continue
-        tid_txt = _as_text(tid_raw)
-        if not tid_txt:
-            continue
+    for field, count in (raw or {}).items():
+        tid_txt, _, bid = str(field).partition(":")
         try:
-            if int(tid_txt) != int(ticket_id):
-                continue
-        except Exception:
+            tid, c = int(tid_txt), int(count)
+        except (TypeError, ValueError):
             continue
-        wanted.append(str(uid_txt))
-
-    if not wanted:
-        return 0
+        if tid and c > 0:
+            out.setdefault(tid, {})[bid] = c
+    return out
 
-    processing_id = _normalize_redis_id(_as_text(processing_raw))
-    ttl = seconds_until_midnight_iran()
 
-    pipe2 = r.pipeline(transaction=True)
-    for uid_txt in wanted:
-        pipe2.srem(all_key, uid_txt)
-        pipe2.zrem(queue_key, uid_txt)
-        pipe2.delete(get_urgent_item_key(bakery_id, str(uid_txt)))
-    if processing_id and str(processing_id) in set(str(x) for x in wanted):
-        pipe2.delete(prep_key)
-    pipe2.expire(all_key, ttl)
-    pipe2.expire(queue_key, ttl)
-    await pipe2.execute()
-    return int(len(wanted))
+async def cleanup_urgent_items_for_ticket(r, bakery_id: int, ticket_id: int, statuses=("DONE",)) -> int:
+    time_per_bread = await get_bakery_time_per_bread(r, bakery_id)
+    script = r.register_script(LUA_URGENT_CLEANUP_FOR_TICKET)
+    removed = await script(
+        keys=[
+            REDIS_KEY_URGENT_ALL_IDS.format(bakery_id),
+            REDIS_KEY_URGENT_QUEUE.format(bakery_id),
+            REDIS_KEY_URGENT_PREP_STATE.format(bakery_id),
+            *_urgent_index_keys(bakery_id),
+        ],
+        args=[
+            int(ticket_id),
+            ",".join(str(x) for x in (statuses or [])),
+            get_urgent_item_key(bakery_id, ""),
+            seconds_until_midnight_iran(),
+            ",".join(sorted(time_per_bread.keys())),
+        ],
+    )
+    return int(removed or 0)
 
 
 async def update_urgent_item_if_pending(r, bakery_id: int, urgent_id: str, bread_requirements: dict, time_per_bread: dict, reason: str | None = None) -> bool:
-    item_key = get_urgent_item_key(bakery_id, urgent_id)
-    pipe0 = r.pipeline()
-    pipe0.hget(item_key, "status")
-    pipe0.hget(item_key, "ticket_id")
-    pipe0.hget(item_key, "original_breads")
-    status, ticket_id_raw, prev_original_raw = await pipe0.execute()
-    try:
-        status_txt = status.decode() if isinstance(status, (bytes, bytearray)) else str(status)
-    except Exception:
-        status_txt = str(status)
-    if status_txt != "PENDING":
-        return False
-
     bread_ids_sorted = sorted(time_per_bread.keys())
     encoded = ",".join(str(int(bread_requirements.get(bid, 0))) for bid in bread_ids_sorted)
-    ttl = seconds_until_midnight_iran()
 
-    pipe = r.pipeline(transaction=True)
-    update_map = {"original_breads": encoded, "remaining_breads": encoded}
-    if reason is not None:
-        update_map["reason"] = str(reason or "")
-    pipe.hset(item_key, mapping=update_map)
-    ticket_id_txt = None
-    try:
-        ticket_id_txt = ticket_id_raw.decode() if isinstance(ticket_id_raw, (bytes, bytearray)) else (str(ticket_id_raw) if ticket_id_raw is not None else None)
-    except Exception:
-        ticket_id_txt = None
-    if ticket_id_txt:
-        try:
-            tid_int = int(ticket_id_txt)
-        except Exception:
-            tid_int = None
-        if tid_int is not None:
-            history_prefix = REDIS_KEY_URGENT_HISTORY.format(bakery_id)
-            history_key = f"{history_prefix}:{int(tid_int)}"
-            prev_counts = _decode_counts(prev_original_raw)
-            if len(prev_counts) < len(bread_ids_sorted):
-                prev_counts = prev_counts + [0] * (len(bread_ids_sorted) - len(prev_counts))
-            new_counts = [int(bread_requirements.get(bid, 0)) for bid in bread_ids_sorted]
-            for bid, prev_c, new_c in zip(bread_ids_sorted, prev_counts[: len(bread_ids_sorted)], new_counts[: len(bread_ids_sorted)]):
-                delta = int(new_c) - int(prev_c)
-                if int(delta) == 0:
-                    continue
-                pipe.hincrby(history_key, str(int(bid)), int(delta))
-            pipe.expire(history_key, ttl)
-    pipe.expire(item_key, ttl)
-    await pipe.execute()
+    script = r.register_script(LUA_URGENT_UPDATE)
+    ok = await script(
+        keys=[
+            get_urgent_item_key(bakery_id, urgent_id),
+            *_urgent_index_keys(bakery_id),
+            *_outbox_keys(bakery_id),
+        ],
+        args=[
+            urgent_id,
+            encoded,
+            str(reason or ""),
+            "1" if reason is not None else "0",
+            seconds_until_midnight_iran(),
+            ",".join(bread_ids_sorted),
+            f"{REDIS_KEY_URGENT_HISTORY.format(bakery_id)}:",
+            _outbox_arg(bakery_id),
+            json.dumps([int(bakery_id), urgent_id, bread_requirements, reason]),
+        ],
+    )
+    if not int(ok):
+        return False
+    await mark_eta_table_stale(r, bakery_id)
+    await request_dispatch(r, bakery_id)
     return True
 
 
 async def delete_urgent_item_if_pending(r, bakery_id: int, urgent_id: str) -> bool:
-    item_key = get_urgent_item_key(bakery_id, urgent_id)
-    pipe0 = r.pipeline()
-    pipe0.hget(item_key, "status")
-    pipe0.hget(item_key, "ticket_id")
-    pipe0.hget(item_key, "original_breads")
-    status, ticket_id_raw, original_raw = await pipe0.execute()
-    try:
-        status_txt = status.decode() if isinstance(status, (bytes, bytearray)) else str(status)
-    except Exception:
-        status_txt = str(status)
-    if status_txt != "PENDING":
-        return False
-
-    queue_key = REDIS_KEY_URGENT_QUEUE.format(bakery_id)
     time_per_bread = await get_bakery_time_per_bread(r, bakery_id)
-    pipe = r.pipeline(transaction=True)
-    pipe.zrem(queue_key, urgent_id)
-    ticket_id_txt = None
-    try:
-        ticket_id_txt = ticket_id_raw.decode() if isinstance(ticket_id_raw, (bytes, bytearray)) else (str(ticket_id_raw) if ticket_id_raw is not None else None)
-    except Exception:
-        ticket_id_txt = None
-    if ticket_id_txt:
-        try:
-            tid_int = int(ticket_id_txt)
-        except Exception:
-            tid_int = None
-        if tid_int is not None and time_per_bread:
-            history_prefix = REDIS_KEY_URGENT_HISTORY.format(bakery_id)
-            history_key = f"{history_prefix}:{int(tid_int)}"
-            ttl = seconds_until_midnight_iran()
-            counts = _decode_counts(original_raw)
-            bread_ids_sorted = sorted(time_per_bread.keys())
-            if len(counts) < len(bread_ids_sorted):
-                counts = counts + [0] * (len(bread_ids_sorted) - len(counts))
-            for bid, c in zip(bread_ids_sorted, counts[: len(bread_ids_sorted)]):
-                if int(c) <= 0:
-                    continue
-                pipe.hincrby(history_key, str(int(bid)), int(-int(c)))
-            pipe.expire(history_key, ttl)
-    pipe.delete(item_key)
-    await pipe.execute()
+    script = r.register_script(LUA_URGENT_DELETE)
+    ok = await script(
+        keys=[
+            get_urgent_item_key(bakery_id, urgent_id),
+            REDIS_KEY_URGENT_QUEUE.format(bakery_id),
+            *_urgent_index_keys(bakery_id),
+            *_outbox_keys(bakery_id),
+        ],
+        args=[
+            urgent_id,
+            seconds_until_midnight_iran(),
+            ",".join(sorted(time_per_bread.keys())),
+            f"{REDIS_KEY_URGENT_HISTORY.format(bakery_id)}:",
+            _outbox_arg(bakery_id),
+            json.dumps([int(bakery_id), urgent_id]),
+        ],
+    )
+    if not int(ok):
+        return False
+    await mark_eta_table_stale(r, bakery_id)
+    await request_dispatch(r, bakery_id)
     return True
 
 
@@ -1961,109 +2468,124 @@ async def consume_one_urgent_bread(r, bakery_id: int, time_per_bread: dict):
 
     Returns a dict describing the urgent state after consuming one bread.
     """
-    prep_key = REDIS_KEY_URGENT_PREP_STATE.format(bakery_id)
-    urgent_id_raw = await r.get(prep_key)
-    if not urgent_id_raw:
-        return None
-
-    urgent_id = _normalize_redis_id(urgent_id_raw)
-    if not urgent_id:
-        return None
-    item_key = get_urgent_item_key(bakery_id, urgent_id)
-
-    pipe0 = r.pipeline()
-    pipe0.hget(item_key, "ticket_id")
-    pipe0.hget(item_key, "remaining_breads")
-    ticket_id_raw, remaining_raw = await pipe0.execute()
-
     bread_ids_sorted = sorted(time_per_bread.keys())
-    remaining_counts = _decode_counts(remaining_raw)
-    if len(remaining_counts) < len(bread_ids_sorted):
-        remaining_counts = remaining_counts + [0] * (len(bread_ids_sorted) - len(remaining_counts))
-
-    chosen_idx = None
-    for i, c in enumerate(remaining_counts[: len(bread_ids_sorted)]):
-        if int(c) > 0:
-            chosen_idx = i
-            break
+    script = r.register_script(LUA_URGENT_CONSUME_ONE)
+    raw = await script(
+        keys=[
+            REDIS_KEY_URGENT_PREP_STATE.format(bakery_id),
+            *_urgent_index_keys(bakery_id),
+        ],
+        args=[get_urgent_item_key(bakery_id, ""), seconds_until_midnight_iran(), ",".join(bread_ids_sorted)],
+    )
+    if not raw:
+        return None
 
-    if chosen_idx is None:
-        pipe_cleanup = r.pipeline(transaction=True)
-        pipe_cleanup.hset(item_key, "status", "DONE")
-        pipe_cleanup.delete(prep_key)
-        await pipe_cleanup.execute()
+    state = json.loads(raw)
+    await mark_eta_table_stale(r, bakery_id)
+    await request_dispatch(r, bakery_id)
+    ticket_id = int(state["ticket_id"]) if state.get("ticket_id") else None
+    if not state["chosen"]:
         return {
             "urgent": True,
-            "urgent_id": urgent_id,
-            "ticket_id": int(ticket_id_raw) if ticket_id_raw else None,
+            "urgent_id": state["urgent_id"],
+            "ticket_id": ticket_id,
             "remaining_total": 0,
             "done": True,
         }
 
-    remaining_counts[chosen_idx] = int(remaining_counts[chosen_idx]) - 1
-    remaining_total = sum(int(x) for x in remaining_counts[: len(bread_ids_sorted)])
-    ttl = seconds_until_midnight_iran()
-
-    pipe = r.pipeline(transaction=True)
-    pipe.hset(item_key, "remaining_breads", _encode_counts(remaining_counts[: len(bread_ids_sorted)]))
-    if remaining_total <= 0:
-        pipe.hset(item_key, "status", "DONE")
-        pipe.delete(prep_key)
-    pipe.expire(item_key, ttl)
-    await pipe.execute()
-
-    remaining_by_type = {bid: int(count) for bid, count in zip(bread_ids_sorted, remaining_counts)}
+    remaining_total = int(state["total"])
+    # cjson cannot tell an empty list from an empty object
+    remaining = state["remaining"] if isinstance(state["remaining"], list) else []
+    remaining_by_type = {bid: int(count) for bid, count in zip(bread_ids_sorted, remaining)}
     return {
         "urgent": True,
-        "urgent_id": urgent_id,
-        "ticket_id": int(ticket_id_raw.decode() if isinstance(ticket_id_raw, (bytes, bytearray)) else ticket_id_raw) if ticket_id_raw else None,
-        "remaining_total": int(remaining_total),
+        "urgent_id": state["urgent_id"],
+        "ticket_id": ticket_id,
+        "remaining_total": remaining_total,
         "remaining_by_type": remaining_by_type,
         "done": remaining_total <= 0,
-        "consumed_bread_type": bread_ids_sorted[chosen_idx],
+        "consumed_bread_type": bread_ids_sorted[int(state["chosen"]) - 1],
     }
 
 
 async def get_urgent_remaining_total_time(r, bakery_id: int, time_per_bread: dict) -> int:
-    queue_key = REDIS_KEY_URGENT_QUEUE.format(bakery_id)
-    prep_key = REDIS_KEY_URGENT_PREP_STATE.format(bakery_id)
-    urgent_ids = await r.zrange(queue_key, 0, -1)
-    processing_id = await r.get(prep_key)
+    """Outstanding urgent bread-seconds (running urgent_remaining_s counter)."""
+    raw = await r.get(REDIS_KEY_URGENT_REMAINING_S.format(bakery_id))
+    if raw is None:
+        return await rebuild_urgent_remaining_seconds(r, bakery_id)
+    return max(0, int(raw))
 
-    ids = list(urgent_ids)
-    pid = _normalize_redis_id(processing_id)
-    ids_txt = [(_normalize_redis_id(x) or "") for x in ids]
-    if pid and pid not in ids_txt:
-        ids.append(pid)
 
-    if not ids:
-        return 0
+async def rebuild_urgent_remaining_seconds(r, bakery_id: int) -> int:
+    """Recount urgent_remaining_s from the active urgent items."""
+    script = r.register_script(LUA_URGENT_REMAINING_REBUILD)
+    total = await script(*_urgent_remaining_rebuild_call(bakery_id))
+    return max(0, int(total or 0))
+
+
+def _urgent_remaining_rebuild_call(bakery_id: int):
+    keys = [
+        REDIS_KEY_URGENT_ACTIVE_IDS.format(bakery_id),
+        REDIS_KEY_URGENT_REMAINING_S.format(bakery_id),
+        REDIS_KEY_TIME_PER_BREAD.format(bakery_id),
+    ]
+    return keys, [get_urgent_item_key(bakery_id, ""), seconds_until_midnight_iran()]
+
+
+def _urgent_log_project_call(bakery_id: int, urgent_id: str, status: str, ticket_id=None, breads=None, created_at=None):
+    keys = [REDIS_KEY_URGENT_LOG_TICKETS.format(bakery_id)]
+    args = [
+        f"{REDIS_KEY_URGENT_LOG.format(bakery_id)}:",
+        str(urgent_id),
+        "" if ticket_id is None else str(int(ticket_id)),
+        str(status),
+        "" if breads is None else json.dumps({str(k): int(v) for k, v in breads.items()}),
+        int(created_at if created_at is not None else time.time()),
+        seconds_until_midnight_iran(),
+    ]
+    return keys, args
+
+
+def project_urgent_log_sync(r, bakery_id: int, urgent_id: str, status: str, ticket_id=None, breads=None) -> bool:
+    """Apply one UrgentBreadLog change to the Redis projection (sync client, used by Celery)."""
+    script = r.register_script(LUA_URGENT_LOG_PROJECT)
+    return bool(script(*_urgent_log_project_call(bakery_id, urgent_id, status, ticket_id=ticket_id, breads=breads)))
 
+
+async def get_urgent_log_summary(r, bakery_id: int, ticket_ids) -> dict[int, dict[str, dict]]:
+    """Today's non-cancelled urgent logs per ticket, from the urgent_log projection.
+
+    Returns {ticket: {urgent_id: {"breads": {bread_id: count}, "status": str}}}
+    with urgent ids in creation order.
+    """
+    ticket_ids = [int(t) for t in (ticket_ids or [])]
+    if not ticket_ids:
+        return {}
+
+    prefix = REDIS_KEY_URGENT_LOG.format(bakery_id)
     pipe = r.pipeline()
-    for uid in ids:
-        uid_txt = _normalize_redis_id(uid)
-        if not uid_txt:
-            continue
-        item_key = get_urgent_item_key(bakery_id, str(uid_txt))
-        pipe.hget(item_key, "status")
-        pipe.hget(item_key, "remaining_breads")
-    raw = await pipe.execute()
+    for tid in ticket_ids:
+        pipe.hgetall(f"{prefix}:{tid}")
+    rows = await pipe.execute()
 
-    bread_ids_sorted = sorted(time_per_bread.keys())
-    total = 0
-    for i in range(0, len(raw), 2):
-        status = raw[i]
-        remaining = raw[i + 1]
-        try:
-            status_txt = status.decode() if isinstance(status, (bytes, bytearray)) else str(status)
-        except Exception:
-            status_txt = str(status)
-        if status_txt not in ("PENDING", "PROCESSING"):
-            continue
-        counts = _decode_counts(remaining)
-        for bid, count in zip(bread_ids_sorted, counts):
-            total += int(count) * int(time_per_bread[bid])
-    return int(total)
+    out = {}
+    for tid, raw in zip(ticket_ids, rows):
+        entries = []
+        for urgent_id, payload in (raw or {}).items():
+            try:
+                entry = json.loads(payload)
+            except (TypeError, ValueError):
+                continue
+            if not isinstance(entry, dict) or entry.get("status") == "CANCELLED":
+                continue
+            entries.append((int(entry.get("created_at") or 0), str(urgent_id), entry))
+        entries.sort(key=lambda e: e[0])
+        if entries:
+            out[tid] = {
+                urgent_id: {"breads": dict(entry.get("breads") or {}), "status": str(entry.get("status") or "")}
+                for _, urgent_id, entry in entries
+            }
+    return out
 
 
 async def get_urgent_original_counts_for_ticket(r, bakery_id: int, ticket_id: int, time_per_bread: dict) -> dict:
@@ -2148,10 +2670,642 @@ async def get_urgent_original_counts_for_ticket(r, bakery_id: int, ticket_id: in
     return result
 
 
+# Secondary bread indexes, maintained together with the breads ZSET:
+#   bread_counts      HASH   ticket -> breads currently in the ZSET
+#   bread_last_ts     HASH   ticket -> latest ready timestamp among them
+#   bread_max_ticket  STRING highest ticket that had a bread today
+#                            (monotonic; not lowered when breads are consumed)
+#   bread_seq         STRING INCR counter handing out bread indexes (ZSET
+#                            score); seeded from the DB on startup
+#   ticket_breads:{t} SET    breads ZSET members of ticket t, so a ticket's
+#                            breads can be consumed without scanning the ZSET
+_LUA_RECORD_BREAD_FN = """
+    local function record_bread(breads, counts, last_ts, max_ticket, ticket_breads_prefix, cook_ts, idx, ticket, ttl)
+        local member = cook_ts .. ':' .. idx .. ':' .. ticket
+        local ticket_breads = ticket_breads_prefix .. ticket
+        redis.call('ZADD', breads, idx, member)
+        redis.call('SADD', ticket_breads, member)
+        redis.call('HINCRBY', counts, ticket, 1)
+        if tonumber(cook_ts) > (tonumber(redis.call('HGET', last_ts, ticket) or '0') or 0) then
+            redis.call('HSET', last_ts, ticket, cook_ts)
+        end
+        if tonumber(ticket) > (tonumber(redis.call('GET', max_ticket) or '0') or 0) then
+            redis.call('SET', max_ticket, ticket)
+        end
+        for _, key in ipairs({breads, ticket_breads, counts, last_ts, max_ticket}) do
+            redis.call('EXPIRE', key, ttl)
+        end
+    end
+"""
+
+_LUA_CONSUME_TICKET_BREADS_FN = """
+    local function consume_ticket_breads(breads, counts, last_ts, ticket_breads_prefix, ticket)
+        local ticket_breads = ticket_breads_prefix .. ticket
+        local members = redis.call('SMEMBERS', ticket_breads)
+        if #members == 0 and (tonumber(redis.call('HGET', counts, ticket) or '0') or 0) > 0 then
+            -- Breads recorded before the per-ticket sets existed
+            local suffix = ':' .. ticket
+            for _, member in ipairs(redis.call('ZRANGE', breads, 0, -1)) do
+                if string.sub(member, -#suffix) == suffix then
+                    members[#members + 1] = member
+                end
+            end
+        end
+        local removed = 0
+        for i = 1, #members, 500 do
+            removed = removed + redis.call('ZREM', breads, unpack(members, i, math.min(i + 499, #members)))
+        end
+        redis.call('DEL', ticket_breads)
+        redis.call('HDEL', counts, ticket)
+        redis.call('HDEL', last_ts, ticket)
+        return removed
+    end
+"""
+
+LUA_CONSUME_TICKET_BREADS = _LUA_CONSUME_TICKET_BREADS_FN + """
+    return consume_ticket_breads(KEYS[1], KEYS[2], KEYS[3], ARGV[1], ARGV[2])
+"""
+
+# Index of unfinished (PENDING/PROCESSING) urgent work:
+#   urgent_active_ids     SET    urgent ids that are PENDING or PROCESSING
+#   urgent_active_breads  HASH   "{ticket}:{bread_id}" -> original breads of
+#                                the active items injected into that ticket
+#   urgent_remaining_s    STRING remaining breads of active items times
+#                                time_per_bread (outstanding urgent seconds)
+# An item is added once when it becomes active and removed once when it is
+# DONE, cancelled or deleted; the SADD/SREM result guards double counting.
+# Edits remove the item with its old counts and add it back with the new;
+# each consumed bread takes its own seconds off urgent_remaining_s.
+# ``index`` is {ids, breads, remaining_s, time_per_bread} (key names).
+_LUA_URGENT_ACTIVE_FN = """
+    local function urgent_counts(encoded, n)
+        local counts = {}
+        for part in string.gmatch(encoded or '', '[^,]+') do
+            counts[#counts + 1] = tonumber(part) or 0
+        end
+        for i = #counts + 1, n do
+            counts[i] = 0
+        end
+        return counts
+    end
+
+    local function urgent_seconds(time_per_bread, bread_ids, counts)
+        local total = 0
+        for i, bid in ipairs(bread_ids) do
+            if (counts[i] or 0) ~= 0 then
+                total = total + counts[i] * (tonumber(redis.call('HGET', time_per_bread, bid) or '0') or 0)
+            end
+        end
+        return total
+    end
+
+    local function urgent_active_apply(index, item, urgent_id, bread_ids, sign)
+        if sign > 0 then
+            if redis.call('SADD', index.ids, urgent_id) == 0 then
+                return
+            end
+        elseif redis.call('SREM', index.ids, urgent_id) == 0 then
+            return
+        end
+        local remaining = urgent_counts(redis.call('HGET', item, 'remaining_breads'), #bread_ids)
+        local seconds = urgent_seconds(index.time_per_bread, bread_ids, remaining)
+        if seconds ~= 0 then
+            redis.call('INCRBY', index.remaining_s, sign * seconds)
+        end
+        local tid = redis.call('HGET', item, 'ticket_id')
+        if not tid or tid == '' then
+            return
+        end
+        local i = 0
+        for part in string.gmatch(redis.call('HGET', item, 'original_breads') or '', '[^,]+') do
+            i = i + 1
+            local c = tonumber(part) or 0
+            if c > 0 and bread_ids[i] then
+                local field = tid .. ':' .. bread_ids[i]
+                if redis.call('HINCRBY', index.breads, field, sign * c) <= 0 then
+                    redis.call('HDEL', index.breads, field)
+                end
+            end
+        end
+    end
+
+    local function urgent_index_expire(index, ttl)
+        redis.call('EXPIRE', index.ids, ttl)
+        redis.call('EXPIRE', index.breads, ttl)
+        redis.call('EXPIRE', index.remaining_s, ttl)
+    end
+"""
+
+# Urgent item state machine: PENDING (in urgent_queue) -> PROCESSING
+# (urgent_prep_state) -> DONE; PENDING items can be edited or deleted.
+# Each transition is one script that checks the status and updates the
+# queue, prep state, item hash, ticket history and active index together.
+_LUA_URGENT_FNS = _LUA_URGENT_ACTIVE_FN + """
+    local function urgent_bread_ids(csv)
+        local ids = {}
+        for part in string.gmatch(csv or '', '[^,]+') do
+            ids[#ids + 1] = part
+        end
+        return ids
+    end
+
+    -- urgent_history:{ticket} += sign * counts (bread_ids order)
+    local function urgent_history_add(history_prefix, ticket, bread_ids, counts, sign, ttl)
+        if not tonumber(ticket or '') then
+            return
+        end
+        local key = history_prefix .. ticket
+        for i, bid in ipairs(bread_ids) do
+            if (counts[i] or 0) ~= 0 then
+                redis.call('HINCRBY', key, bid, sign * counts[i])
+            end
+        end
+        redis.call('EXPIRE', key, ttl)
+    end
+
+    -- PENDING -> PROCESSING for the head of urgent_queue (lowest ticket first)
+    local function start_next_urgent(urgent_queue, urgent_prep, urgent_item_prefix, ttl)
+        local existing = redis.call('GET', urgent_prep)
+        if existing and existing ~= '' then
+            return existing
+        end
+        local next_id = redis.call('ZRANGE', urgent_queue, 0, 0)[1]
+        if not next_id or next_id == '' then
+            return nil
+        end
+        local item = urgent_item_prefix .. next_id
+        redis.call('ZREM', urgent_queue, next_id)
+        redis.call('SET', urgent_prep, next_id, 'EX', ttl)
+        redis.call('HSET', item, 'status', 'PROCESSING')
+        redis.call('EXPIRE', item, ttl)
+        return next_id
+    end
+
+    -- One bread off the PROCESSING item (first type with remaining > 0);
+    -- PROCESSING -> DONE once nothing remains. Returns chosen, remaining, total.
+    local function consume_urgent_bread(urgent_prep, index, item, urgent_id, bread_ids, ttl)
+        local remaining = urgent_counts(redis.call('HGET', item, 'remaining_breads'), #bread_ids)
+        local chosen = nil
+        for i = 1, #bread_ids do
+            if remaining[i] > 0 then
+                chosen = i
+                break
+            end
+        end
+        local total = 0
+        if chosen then
+            remaining[chosen] = remaining[chosen] - 1
+            local encoded = {}
+            for i = 1, #bread_ids do
+                total = total + remaining[i]
+                encoded[i] = tostring(remaining[i])
+            end
+            redis.call('HSET', item, 'remaining_breads', table.concat(encoded, ','))
+            redis.call('EXPIRE', item, ttl)
+            if redis.call('SISMEMBER', index.ids, urgent_id) == 1 then
+                local one = {}
+                one[chosen] = 1
+                redis.call('INCRBY', index.remaining_s, -urgent_seconds(index.time_per_bread, bread_ids, one))
+            end
+        end
+        if total <= 0 then
+            redis.call('HSET', item, 'status', 'DONE')
+            urgent_active_apply(index, item, urgent_id, bread_ids, -1)
+            redis.call('DEL', urgent_prep)
+        end
+        urgent_index_expire(index, ttl)
+        return chosen, remaining, total
+    end
+"""
+
+LUA_URGENT_CREATE = _LUA_URGENT_FNS + _LUA_OUTBOX_FN + """
+    local item, urgent_queue, all_ids = KEYS[1], KEYS[2], KEYS[3]
+    local index = {ids = KEYS[4], breads = KEYS[5], remaining_s = KEYS[6], time_per_bread = KEYS[7]}
+    local urgent_id, ticket, encoded = ARGV[1], ARGV[2], ARGV[3]
+    local ttl = tonumber(ARGV[7])
+    local bread_ids = urgent_bread_ids(ARGV[8])
+
+    redis.call('HSET', item,
+        'ticket_id', ticket,
+        'original_breads', encoded,
+        'remaining_breads', encoded,
+        'status', 'PENDING',
+        'created_at', ARGV[4],
+        'reason', ARGV[5])
+    redis.call('EXPIRE', item, ttl)
+    redis.call('ZADD', urgent_queue, tonumber(ARGV[6]), urgent_id)
+    redis.call('EXPIRE', urgent_queue, ttl)
+    redis.call('SADD', all_ids, urgent_id)
+    redis.call('EXPIRE', all_ids, ttl)
+    urgent_active_apply(index, item, urgent_id, bread_ids, 1)
+    urgent_index_expire(index, ttl)
+    urgent_history_add(ARGV[9], ticket, bread_ids, urgent_counts(encoded, #bread_ids), 1, ttl)
+    outbox_add(outbox_at(8, 10), 'log_urgent_inject', ARGV[11])
+    return 1
+"""
+
+LUA_URGENT_START_NEXT = _LUA_URGENT_FNS + """
+    return start_next_urgent(KEYS[1], KEYS[2], ARGV[1], tonumber(ARGV[2])) or false
+"""
+
+LUA_URGENT_CONSUME_ONE = _LUA_URGENT_FNS + """
+    local urgent_prep = KEYS[1]
+    local index = {ids = KEYS[2], breads = KEYS[3], remaining_s = KEYS[4], time_per_bread = KEYS[5]}
+    local ttl = tonumber(ARGV[2])
+    local bread_ids = urgent_bread_ids(ARGV[3])
+
+    local urgent_id = redis.call('GET', urgent_prep)
+    if not urgent_id or urgent_id == '' then
+        return false
+    end
+    local item = ARGV[1] .. urgent_id
+    local ticket = redis.call('HGET', item, 'ticket_id') or ''
+    local chosen, remaining, total = consume_urgent_bread(urgent_prep, index, item, urgent_id, bread_ids, ttl)
+    local remaining_list = {}
+    for i = 1, #bread_ids do
+        remaining_list[i] = remaining[i]
+    end
+    return cjson.encode({urgent_id = urgent_id, ticket_id = ticket, chosen = chosen or 0, remaining = remaining_list, total = total})
+"""
+
+LUA_URGENT_UPDATE = _LUA_URGENT_FNS + _LUA_OUTBOX_FN + """
+    local item = KEYS[1]
+    local index = {ids = KEYS[2], breads = KEYS[3], remaining_s = KEYS[4], time_per_bread = KEYS[5]}
+    local urgent_id, encoded = ARGV[1], ARGV[2]
+    local ttl = tonumber(ARGV[5])
+    local bread_ids = urgent_bread_ids(ARGV[6])
+
+    if redis.call('HGET', item, 'status') ~= 'PENDING' then
+        return 0
+    end
+    local prev = urgent_counts(redis.call('HGET', item, 'original_breads'), #bread_ids)
+    urgent_active_apply(index, item, urgent_id, bread_ids, -1)
+    redis.call('HSET', item, 'original_breads', encoded, 'remaining_breads', encoded)
+    if ARGV[4] == '1' then
+        redis.call('HSET', item, 'reason', ARGV[3])
+    end
+    urgent_active_apply(index, item, urgent_id, bread_ids, 1)
+    urgent_index_expire(index, ttl)
+
+    local new = urgent_counts(encoded, #bread_ids)
+    local delta = {}
+    for i = 1, #bread_ids do
+        delta[i] = new[i] - prev[i]
+    end
+    urgent_history_add(ARGV[7], redis.call('HGET', item, 'ticket_id'), bread_ids, delta, 1, ttl)
+    redis.call('EXPIRE', item, ttl)
+    outbox_add(outbox_at(6, 8), 'log_urgent_edit', ARGV[9])
+    return 1
+"""
+
+LUA_URGENT_DELETE = _LUA_URGENT_FNS + _LUA_OUTBOX_FN + """
+    local item, urgent_queue = KEYS[1], KEYS[2]
+    local index = {ids = KEYS[3], breads = KEYS[4], remaining_s = KEYS[5], time_per_bread = KEYS[6]}
+    local urgent_id = ARGV[1]
+    local ttl = tonumber(ARGV[2])
+    local bread_ids = urgent_bread_ids(ARGV[3])
+
+    if redis.call('HGET', item, 'status') ~= 'PENDING' then
+        return 0
+    end
+    redis.call('ZREM', urgent_queue, urgent_id)
+    urgent_active_apply(index, item, urgent_id, bread_ids, -1)
+    local original = urgent_counts(redis.call('HGET', item, 'original_breads'), #bread_ids)
+    urgent_history_add(ARGV[4], redis.call('HGET', item, 'ticket_id'), bread_ids, original, -1, ttl)
+    redis.call('DEL', item)
+    outbox_add(outbox_at(7, 5), 'log_urgent_cancel', ARGV[6])
+    return 1
+"""
+
+# Drop one ticket's urgent items whose status is in ARGV[2] (csv), looking
+# at every id in urgent_all_ids, urgent_queue and urgent_prep_state.
+LUA_URGENT_CLEANUP_FOR_TICKET = _LUA_URGENT_FNS + """
+    local all_ids, urgent_queue, urgent_prep = KEYS[1], KEYS[2], KEYS[3]
+    local index = {ids = KEYS[4], breads = KEYS[5], remaining_s = KEYS[6], time_per_bread = KEYS[7]}
+    local ticket = tonumber(ARGV[1])
+    local urgent_item_prefix = ARGV[3]
+    local ttl = tonumber(ARGV[4])
+    local bread_ids = urgent_bread_ids(ARGV[5])
+
+    local statuses = {}
+    for _, st in ipairs(urgent_bread_ids(ARGV[2])) do
+        statuses[st] = true
+    end
+
+    local processing = redis.call('GET', urgent_prep)
+    local candidates = redis.call('SMEMBERS', all_ids)
+    for _, uid in ipairs(redis.call('ZRANGE', urgent_queue, 0, -1)) do
+        candidates[#candidates + 1] = uid
+    end
+    if processing and processing ~= '' then
+        candidates[#candidates + 1] = processing
+    end
+
+    local seen, removed = {}, 0
+    for _, uid in ipairs(candidates) do
+        if not seen[uid] then
+            seen[uid] = true
+            local item = urgent_item_prefix .. uid
+            local status = redis.call('HGET', item, 'status')
+            if status and statuses[status] and tonumber(redis.call('HGET', item, 'ticket_id') or '') == ticket then
+                redis.call('SREM', all_ids, uid)
+                redis.call('ZREM', urgent_queue, uid)
+                urgent_active_apply(index, item, uid, bread_ids, -1)
+                redis.call('DEL', item)
+                if uid == processing then
+                    redis.call('DEL', urgent_prep)
+                end
+                removed = removed + 1
+            end
+        end
+    end
+    if removed > 0 then
+        redis.call('EXPIRE', all_ids, ttl)
+        redis.call('EXPIRE', urgent_queue, ttl)
+    end
+    return removed
+"""
+
+LUA_URGENT_ACTIVE_APPLY = _LUA_URGENT_ACTIVE_FN + """
+    local bread_ids = {}
+    for part in string.gmatch(ARGV[3], '[^,]+') do
+        bread_ids[#bread_ids + 1] = part
+    end
+    local index = {ids = KEYS[1], breads = KEYS[2], remaining_s = KEYS[3], time_per_bread = KEYS[4]}
+    urgent_active_apply(index, KEYS[5], ARGV[1], bread_ids, tonumber(ARGV[2]))
+    urgent_index_expire(index, tonumber(ARGV[4]))
+    return 1
+"""
+
+# Recount urgent_remaining_s from the active items, e.g. after
+# time_per_bread was recalibrated. Cost is proportional to active urgent work.
+LUA_URGENT_REMAINING_REBUILD = _LUA_URGENT_ACTIVE_FN + """
+    local active_ids, remaining_s, time_per_bread = KEYS[1], KEYS[2], KEYS[3]
+    local urgent_item_prefix = ARGV[1]
+    local ttl = tonumber(ARGV[2])
+
+    local bread_ids = redis.call('HKEYS', time_per_bread)
+    table.sort(bread_ids)
+
+    local total = 0
+    for _, uid in ipairs(redis.call('SMEMBERS', active_ids)) do
+        local item = urgent_item_prefix .. uid
+        local status = redis.call('HGET', item, 'status')
+        if status == 'PENDING' or status == 'PROCESSING' then
+            local remaining = urgent_counts(redis.call('HGET', item, 'remaining_breads'), #bread_ids)
+            total = total + urgent_seconds(time_per_bread, bread_ids, remaining)
+        end
+    end
+    redis.call('SET', remaining_s, total, 'EX', ttl)
+    return total
+"""
+
+# Fold one urgent log change into the per-ticket projection
+# urgent_log:{ticket} (urgent_id -> {breads, status, created_at}).
+# ARGV[3] may be '' when the caller does not know the ticket; it is then
+# taken from urgent_log_tickets. ARGV[5] = '' keeps the stored breads.
+# Status-only updates for unknown urgent ids are dropped.
+LUA_URGENT_LOG_PROJECT = """
+    local tickets = KEYS[1]
+    local urgent_log_prefix = ARGV[1]
+    local urgent_id = ARGV[2]
+    local ticket = ARGV[3]
+    local status = ARGV[4]
+    local breads = ARGV[5]
+    local created_at = tonumber(ARGV[6])
+    local ttl = tonumber(ARGV[7])
+
+    if ticket == '' then
+        ticket = redis.call('HGET', tickets, urgent_id)
+        if not ticket then
+            return 0
+        end
+    else
+        redis.call('HSET', tickets, urgent_id, ticket)
+        redis.call('EXPIRE', tickets, ttl)
+    end
+
+    local key = urgent_log_prefix .. ticket
+    if status == 'CANCELLED' then
+        redis.call('HDEL', key, urgent_id)
+        return 1
+    end
+
+    local raw = redis.call('HGET', key, urgent_id)
+    local entry
+    if raw then
+        entry = cjson.decode(raw)
+    elseif breads ~= '' then
+        entry = {created_at = created_at}
+    else
+        return 0
+    end
+    entry.status = status
+    if breads ~= '' then
+        entry.breads = cjson.decode(breads)
+    end
+    redis.call('HSET', key, urgent_id, cjson.encode(entry))
+    redis.call('EXPIRE', key, ttl)
+    return 1
+"""
+
+# auto_dispatch:due holds bakery -> earliest time its queue must be looked
+# at again; auto_dispatch:armed the deadline of the next dispatcher run.
+# Returns 1 when no run is armed at or before ARGV[2], i.e. the caller must
+# arm one for that time.
+LUA_DISPATCH_SCHEDULE = """
+    local due, armed = KEYS[1], KEYS[2]
+    local bakery = ARGV[1]
+    local at = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local grace = tonumber(ARGV[4])
+
+    redis.call('ZADD', due, 'LT', at, bakery)
+    local armed_at = tonumber(redis.call('GET', armed) or '')
+    if armed_at and armed_at <= at then
+        return 0
+    end
+    redis.call('SET', armed, ARGV[2], 'PX', math.max(1, math.ceil((at - now + grace) * 1000)))
+    return 1
+"""
+
+# HSET KEYS[1] ARGV[1] ARGV[2] if ARGV[2] is larger than the stored value.
+LUA_HASH_MAX = """
+    local current = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '')
+    if not current or tonumber(ARGV[2]) > current then
+        redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    end
+"""
+
+# Delete lock KEYS[1] only if it still holds our token ARGV[1].
+LUA_RELEASE_LOCK = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+"""
+
+# Reset lock KEYS[1] to ARGV[2] seconds only if it still holds our token ARGV[1].
+LUA_EXTEND_LOCK = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+    end
+    return 0
+"""
+
+# Pop the earliest bakery whose deadline has passed.
+LUA_DISPATCH_POP_DUE = """
+    local head = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    if not head[1] or tonumber(head[2]) > tonumber(ARGV[1]) then
+        return false
+    end
+    redis.call('ZREM', KEYS[1], head[1])
+    return head[1]
+"""
+
+# Arm the next dispatcher run for the earliest deadline left in
+# auto_dispatch:due. Returns that deadline, or nil when nothing needs arming
+# (queue empty, or a pending run is already armed early enough).
+LUA_DISPATCH_REARM = """
+    local due, armed = KEYS[1], KEYS[2]
+    local now = tonumber(ARGV[1])
+    local grace = tonumber(ARGV[2])
+
+    local head = redis.call('ZRANGE', due, 0, 0, 'WITHSCORES')
+    if not head[1] then
+        redis.call('DEL', armed)
+        return false
+    end
+    local at = tonumber(head[2])
+    local armed_at = tonumber(redis.call('GET', armed) or '')
+    if armed_at and armed_at > now and armed_at <= at then
+        return false
+    end
+    redis.call('SET', armed, head[2], 'PX', math.max(1, math.ceil((math.max(at, now) - now + grace) * 1000)))
+    return head[2]
+"""
+
+_LUA_SEND_TO_WAIT_LIST_FN = _LUA_CONSUME_TICKET_BREADS_FN + """
+    -- KEYS[1..9]: reservations, order, wait_list, base_done, urgent_epoch,
+    -- user_current_ticket, breads, bread_counts, bread_last_ts
+    local function send_to_wait_list(ticket, now, ttl, ticket_breads_prefix)
+        local reservations = KEYS[1]
+        local order = KEYS[2]
+        local wait_list = KEYS[3]
+        local base_done = KEYS[4]
+        local urgent_epoch = KEYS[5]
+        local user_current_ticket = KEYS[6]
+
+        local reservation = redis.call('HGET', reservations, ticket)
+        local removed_res = redis.call('HDEL', reservations, ticket)
+        local removed_order = redis.call('ZREM', order, ticket)
+        if removed_res == 0 or removed_order == 0 then
+            return {0, reservation or '', 0}
+        end
+
+        redis.call('HSET', wait_list, ticket, reservation)
+        redis.call('EXPIRE', wait_list, ttl)
+        redis.call('SADD', base_done, ticket)
+        redis.call('EXPIRE', base_done, ttl)
+        redis.call('HSET', urgent_epoch, ticket, now)
+        redis.call('EXPIRE', urgent_epoch, ttl)
+        redis.call('SET', user_current_ticket, ticket, 'EX', ttl)
+
+        local removed = consume_ticket_breads(KEYS[7], KEYS[8], KEYS[9], ticket_breads_prefix, ticket)
+        return {1, reservation, removed}
+    end
+"""
+
+# Move the tickets in ARGV[7..] from the queue to the wait list, in that
+# order, consume their breads and mark the moved ones served. KEYS[10..12]
+# are queue_meta, queue_events and queue_served, KEYS[13..14] the outbox; one
+# send_tickets_to_wait_list entry (source ARGV[5], remove_upcoming
+# ARGV[6] == '1') records the moved tickets. Returns one
+# {moved, reservation, breads_removed} per ticket; moved is 0 when the
+# ticket was not both in reservations and reservation_order.
+LUA_SEND_MANY_TO_WAIT_LIST = _LUA_SEND_TO_WAIT_LIST_FN + _LUA_MARK_TICKET_SERVED_FN + _LUA_OUTBOX_FN + """
+    local now = ARGV[1]
+    local ttl = tonumber(ARGV[2])
+    local ticket_breads_prefix = ARGV[3]
+
+    local results = {}
+    local moved = {}
+    for i = 7, #ARGV do
+        local result = send_to_wait_list(ARGV[i], now, ttl, ticket_breads_prefix)
+        if result[1] == 1 then
+            mark_ticket_served(KEYS[10], KEYS[11], KEYS[12], ARGV[i], now, ttl)
+            moved[#moved + 1] = tonumber(ARGV[i])
+        end
+        results[#results + 1] = result
+    end
+
+    local outbox = outbox_at(13, 4)
+    if outbox and #moved > 0 then
+        outbox_add(outbox, 'send_tickets_to_wait_list',
+            cjson.encode({moved, tonumber(outbox.bakery_id), ARGV[5], ARGV[6] == '1'}))
+    end
+    return results
+"""
+
+# Take ticket ARGV[1] off the wait list (KEYS[1]) and queue its
+# serve_wait_list_ticket entry in the outbox (KEYS[3..4]). Returns
+# {reservation or nil, HGETALL time_per_bread (KEYS[2])}.
+LUA_TAKE_FROM_WAIT_LIST = _LUA_OUTBOX_FN + """
+    local reservation = redis.call('HGET', KEYS[1], ARGV[1])
+    if reservation then
+        redis.call('HDEL', KEYS[1], ARGV[1])
+        local outbox = outbox_at(3, 2)
+        if outbox and reservation ~= '' then
+            outbox_add(outbox, 'serve_wait_list_ticket', cjson.encode({tonumber(ARGV[1]), tonumber(outbox.bakery_id)}))
+        end
+    end
+    return {reservation or false, redis.call('HGETALL', KEYS[2])}
+"""
+
+LUA_RAISE_COUNTER = """
+    local current = tonumber(redis.call('GET', KEYS[1]) or '0') or 0
+    if tonumber(ARGV[1]) > current then
+        redis.call('SET', KEYS[1], ARGV[1])
+    end
+    redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+    return 1
+"""
+
+
+def _ticket_breads_prefix(bakery_id: int) -> str:
+    return f"{REDIS_KEY_TICKET_BREADS.format(bakery_id)}:"
+
+
+def _bread_index_keys(bakery_id: int) -> list[str]:
+    return [
+        REDIS_KEY_BREADS.format(bakery_id),
+        REDIS_KEY_BREAD_COUNTS.format(bakery_id),
+        REDIS_KEY_BREAD_LAST_TS.format(bakery_id),
+        REDIS_KEY_BREAD_MAX_TICKET.format(bakery_id),
+    ]
+
+
+def decode_bread_index(counts_raw, last_ts_raw) -> tuple[dict[int, int], dict[int, float]]:
+    """Decode HGETALL results of bread_counts / bread_last_ts."""
+    counts = {int(k): int(v) for k, v in (counts_raw or {}).items() if int(v) > 0}
+    last_ts = {int(k): float(v) for k, v in (last_ts_raw or {}).items()}
+    return counts, last_ts
+
+
+async def get_bread_index(r, bakery_id: int) -> tuple[dict[int, int], dict[int, float]]:
+    """Per-ticket bread counts and latest ready timestamps, O(tickets with breads)."""
+    _, counts_key, last_ts_key, _ = _bread_index_keys(bakery_id)
+    pipe = r.pipeline()
+    pipe.hgetall(counts_key)
+    pipe.hgetall(last_ts_key)
+    counts_raw, last_ts_raw = await pipe.execute()
+    return decode_bread_index(counts_raw, last_ts_raw)
+
+
 async def consume_ready_breads(r, bakery_id: int, customer_id: int):
     """
     Remove breads for a specific customer from Redis.
-    Now we know exactly which breads belong to which customer!
+    Uses the ticket's ticket_breads set, so only that ticket's breads are touched.
 
     Args:
         r: Redis connection
@@ -2161,70 +3315,566 @@ async def consume_ready_breads(r, bakery_id: int, customer_id: int):
     Returns:
         Number of breads removed
     """
-    breads_key = REDIS_KEY_BREADS.format(bakery_id)
+    breads_key, counts_key, last_ts_key, _ = _bread_index_keys(bakery_id)
+    script = r.register_script(LUA_CONSUME_TICKET_BREADS)
+    removed = await script(
+        keys=[breads_key, counts_key, last_ts_key],
+        args=[_ticket_breads_prefix(bakery_id), str(int(customer_id))],
+    )
+    await mark_eta_table_stale(r, bakery_id)
+    return int(removed or 0)
 
-    # Get all breads
-    all_breads = await r.zrangebyscore(breads_key, '-inf', '+inf')
 
-    if not all_breads:
-        return 0
+async def take_from_wait_list(r, bakery_id: int, ticket_id: int) -> tuple[dict, Optional[str]]:
+    """
+    Remove a ticket from the wait list. Returns (time_per_bread, reservation);
+    reservation is None when the ticket was not on the wait list.
+    """
+    script = r.register_script(LUA_TAKE_FROM_WAIT_LIST)
+    reservation, time_per_bread = await script(
+        keys=[
+            REDIS_KEY_WAIT_LIST.format(bakery_id),
+            REDIS_KEY_TIME_PER_BREAD.format(bakery_id),
+            *_outbox_keys(bakery_id),
+        ],
+        args=[str(int(ticket_id)), _outbox_arg(bakery_id)],
+    )
+    return dict(zip(time_per_bread[::2], time_per_bread[1::2])), (reservation or None)
 
-    # Find breads belonging to this customer
-    customer_breads = []
-    for bread_value in all_breads:
-        if ':' not in str(bread_value):
-            continue
-        try:
-            parts = str(bread_value).split(':')
-            if len(parts) < 2:
-                continue
-            cid_str = parts[-1]
-            if int(cid_str) == int(customer_id):
-                customer_breads.append(bread_value)
-        except Exception:
-            continue
 
-    if not customer_breads:
-        return 0
+async def send_tickets_to_wait_list(
+    r, bakery_id: int, ticket_ids, source: str = "system", remove_upcoming: bool = False
+) -> list[tuple[int, bool, Optional[str], int]]:
+    """Atomically move tickets from the queue to the wait list and consume their breads.
+
+    Returns (ticket, moved, reservation_str, breads_removed) per ticket, in
+    the given order; only moved tickets are marked served. A ticket that was
+    not in the Redis queue is not moved; callers reload reservations from the
+    DB and retry. With the outbox on, the DB side (tasks.send_tickets_to_wait_list
+    with ``source`` and ``remove_upcoming``) is queued by the same script.
+    """
+    ticket_ids = [int(t) for t in ticket_ids]
+    if not ticket_ids:
+        return []
+    breads_key, counts_key, last_ts_key, _ = _bread_index_keys(bakery_id)
+    meta_key, _, _, events_key = _queue_state_keys(bakery_id)
+    script = r.register_script(LUA_SEND_MANY_TO_WAIT_LIST)
+    rows = await script(
+        keys=[
+            REDIS_KEY_RESERVATIONS.format(bakery_id),
+            REDIS_KEY_RESERVATION_ORDER.format(bakery_id),
+            REDIS_KEY_WAIT_LIST.format(bakery_id),
+            REDIS_KEY_BASE_DONE.format(bakery_id),
+            REDIS_KEY_URGENT_EPOCH.format(bakery_id),
+            REDIS_KEY_USER_CURRENT_TICKET.format(bakery_id),
+            breads_key,
+            counts_key,
+            last_ts_key,
+            meta_key,
+            events_key,
+            REDIS_KEY_QUEUE_SERVED.format(bakery_id),
+            *_outbox_keys(bakery_id),
+        ],
+        args=[
+            str(int(time.time())),
+            str(seconds_until_midnight_iran()),
+            _ticket_breads_prefix(bakery_id),
+            _outbox_arg(bakery_id),
+            str(source),
+            "1" if remove_upcoming else "0",
+            *[str(t) for t in ticket_ids],
+        ],
+    )
+    await mark_eta_table_stale(r, bakery_id)
+    return [
+        (tid, bool(int(moved)), (reservation or None), int(removed or 0))
+        for tid, (moved, reservation, removed) in zip(ticket_ids, rows)
+    ]
 
-    # Remove all breads for this customer
-    removed_count = await r.zrem(breads_key, *customer_breads)
-    return removed_count
+
+async def _delete_ticket_bread_sets(r, bakery_id: int) -> None:
+    keys = [k async for k in r.scan_iter(match=f"{_ticket_breads_prefix(bakery_id)}*", count=200)]
+    if keys:
+        await r.delete(*keys)
 
 
 async def load_breads_from_db(r, bakery_id: int):
     """
     Load today's breads from database into Redis on initialization
     """
-    breads_key = REDIS_KEY_BREADS.format(bakery_id)
+    breads_key, counts_key, last_ts_key, max_ticket_key = _bread_index_keys(bakery_id)
 
     with SessionLocal() as db:
         today_breads = crud.get_today_breads(db, bakery_id)
+        max_bread_id = crud.get_today_max_bread_id(db, bakery_id)
 
         pipe = r.pipeline()
-        pipe.delete(breads_key)
+        pipe.delete(breads_key, counts_key, last_ts_key)
 
         bread_mapping = {}  # ✅ initialize here
+        counts = defaultdict(int)
+        last_ts = {}
+        members_by_ticket = defaultdict(list)
 
         if today_breads:
             for bread in today_breads:
                 # Get hardware customer ID from internal customer ID
                 if bread.customer:
+                    ticket_id = int(bread.customer.ticket_id)
                     baked_at_timestamp = int(bread.baked_at.timestamp())
-                    bread_value = f"{baked_at_timestamp}:{int(bread.id)}:{bread.customer.ticket_id}"
+                    bread_value = f"{baked_at_timestamp}:{int(bread.id)}:{ticket_id}"
                     # Use bread.id as score (unique identifier)
                     bread_mapping[bread_value] = bread.id
+                    counts[ticket_id] += 1
+                    members_by_ticket[ticket_id].append(bread_value)
+                    last_ts[ticket_id] = max(last_ts.get(ticket_id, 0), baked_at_timestamp)
 
             if bread_mapping:
-                pipe.zadd(breads_key, bread_mapping)
                 ttl = seconds_until_midnight_iran()
+                pipe.zadd(breads_key, bread_mapping)
+                pipe.hset(counts_key, mapping=counts)
+                pipe.hset(last_ts_key, mapping=last_ts)
                 pipe.expire(breads_key, ttl)
-
+                pipe.expire(counts_key, ttl)
+                pipe.expire(last_ts_key, ttl)
+                for ticket_id, members in members_by_ticket.items():
+                    ticket_breads_key = f"{_ticket_breads_prefix(bakery_id)}{ticket_id}"
+                    pipe.sadd(ticket_breads_key, *members)
+                    pipe.expire(ticket_breads_key, ttl)
+
+        await _delete_ticket_bread_sets(r, bakery_id)
         await pipe.execute()
+
+        # Bread indexes must keep growing past every bread id loaded above.
+        raise_seq = r.register_script(LUA_RAISE_COUNTER)
+        await raise_seq(
+            keys=[REDIS_KEY_BREAD_SEQ.format(bakery_id)],
+            args=[max_bread_id, seconds_until_midnight_iran()],
+        )
+
+        if counts:
+            # Only raise the max marker: consumed breads may have pushed it higher.
+            current_max = await r.get(max_ticket_key)
+            if max(counts) > int(current_max or 0):
+                await r.set(max_ticket_key, max(counts), ex=seconds_until_midnight_iran())
+        await mark_eta_table_stale(r, bakery_id)
+        await request_dispatch(r, bakery_id)
         print(f"Loaded {len(bread_mapping)} breads from database for bakery {bakery_id}")
 
 
 
+# Baker state machine. One EVALSHA per hardware button press:
+#   "rebuild" - pick what the baker works on next (prep_state / urgent_prep)
+#   "bake"    - rebuild, cook one bread for the current work item, rebuild
+# Urgent item hashes and urgent history hashes are per-id keys, so their
+# prefixes are passed in ARGV instead of KEYS (single-node Redis only).
+# Baked breads and urgent progress go to the outbox (KEYS[19..20]) when on.
+LUA_BAKE_ONE_BREAD = _LUA_RECORD_BREAD_FN + _LUA_URGENT_FNS + _LUA_OUTBOX_FN + """
+    local prep_state = KEYS[1]
+    local urgent_prep = KEYS[2]
+    local order = KEYS[3]
+    local reservations = KEYS[4]
+    local base_done = KEYS[5]
+    local urgent_queue = KEYS[6]
+    local time_per_bread = KEYS[7]
+    local baking_time = KEYS[8]
+    local breads = KEYS[9]
+    local bread_counts = KEYS[10]
+    local bread_last_ts = KEYS[11]
+    local bread_max_ticket = KEYS[12]
+    local last_bread_time = KEYS[13]
+    local bread_time_diff = KEYS[14]
+    local bread_seq = KEYS[15]
+    local urgent_index = {ids = KEYS[16], breads = KEYS[17], remaining_s = KEYS[18], time_per_bread = time_per_bread}
+
+    local mode = ARGV[1]
+    local now = tonumber(ARGV[2])
+    local ttl = tonumber(ARGV[3])
+    local urgent_item_prefix = ARGV[4]
+    local urgent_history_prefix = ARGV[5]
+    local ticket_breads_prefix = ARGV[6]
+    local outbox = outbox_at(19, 7)
+
+    local bread_ids = redis.call('HKEYS', time_per_bread)
+    table.sort(bread_ids)
+
+    local function present(v)
+        return v and v ~= ''
+    end
+
+    local function decode_counts(encoded)
+        local counts = {}
+        for part in string.gmatch(encoded or '', '[^,]+') do
+            counts[#counts + 1] = tonumber(part) or 0
+        end
+        for i = #counts + 1, #bread_ids do
+            counts[i] = 0
+        end
+        return counts
+    end
+
+    -- Base reservation + urgent history (get_tickets_total_bread_counts)
+    local function ticket_bread_counts(tid)
+        local counts = {}
+        local base = decode_counts(redis.call('HGET', reservations, tid) or '')
+        for i, bid in ipairs(bread_ids) do
+            counts[bid] = base[i]
+        end
+        local history = redis.call('HGETALL', urgent_history_prefix .. tid)
+        for i = 1, #history, 2 do
+            counts[history[i]] = (counts[history[i]] or 0) + (tonumber(history[i + 1]) or 0)
+        end
+        return counts
+    end
+
+    local function total_needed(tid)
+        local total = 0
+        for _, c in pairs(ticket_bread_counts(tid)) do
+            total = total + c
+        end
+        return total
+    end
+
+    local function made_count(tid)
+        return tonumber(redis.call('HGET', bread_counts, tid) or '0') or 0
+    end
+
+    local function rebuild_prep_state()
+        local order_ids = redis.call('ZRANGE', order, 0, -1)
+        local urgent_active = present(redis.call('GET', urgent_prep))
+
+        if #order_ids == 0 then
+            redis.call('DEL', prep_state)
+            -- Urgent-only mode: standalone urgent items still get processed.
+            if not urgent_active and redis.call('ZCARD', urgent_queue) > 0 then
+                start_next_urgent(urgent_queue, urgent_prep, urgent_item_prefix, ttl)
+            end
+            return
+        end
+
+        -- 1. Urgent lock
+        if urgent_active then
+            redis.call('DEL', prep_state)
+            return
+        end
+
+        -- 2. Normal lock: keep working on a started ticket until it is complete
+        local current = redis.call('GET', prep_state)
+        local tid = present(current) and string.match(current, '^(%d+):')
+        if tid and redis.call('ZSCORE', order, tid) then
+            local needed = total_needed(tid)
+            local made = made_count(tid)
+            if redis.call('SISMEMBER', base_done, tid) == 1 and made < needed then
+                made = needed
+            end
+            if made < needed then
+                redis.call('SET', prep_state, tid .. ':' .. made, 'EX', ttl)
+                return
+            end
+            redis.call('DEL', prep_state)
+        end
+
+        -- 3. Urgent queue
+        if redis.call('ZCARD', urgent_queue) > 0 then
+            redis.call('DEL', prep_state)
+            start_next_urgent(urgent_queue, urgent_prep, urgent_item_prefix, ttl)
+            return
+        end
+
+        -- 4. Normal priority: first ticket in order that still needs breads
+        for _, t in ipairs(order_ids) do
+            if redis.call('SISMEMBER', base_done, t) == 0 and made_count(t) < total_needed(t) then
+                redis.call('SET', prep_state, t .. ':0', 'EX', ttl)
+                return
+            end
+        end
+    end
+
+    -- ETA readers only need a new table when the prep or urgent state moved
+    local function prep_snapshot()
+        return (redis.call('GET', prep_state) or '') .. '|' .. (redis.call('GET', urgent_prep) or '')
+    end
+
+    local before = prep_snapshot()
+    rebuild_prep_state()
+    if mode ~= 'bake' then
+        return cjson.encode({changed = prep_snapshot() ~= before})
+    end
+
+    local function next_bread_idx()
+        if redis.call('EXISTS', bread_seq) == 0 then
+            -- Not seeded (e.g. key lost): continue after the highest bread we hold
+            local last_bread = redis.call('ZREVRANGE', breads, 0, 0, 'WITHSCORES')
+            redis.call('SET', bread_seq, last_bread[2] and math.floor(tonumber(last_bread[2])) or 0)
+        end
+        local idx = redis.call('INCR', bread_seq)
+        redis.call('EXPIRE', bread_seq, ttl)
+        return idx
+    end
+
+    local result = {}
+    local baking_time_s = tonumber(redis.call('GET', baking_time) or '0') or 0
+    local cook_ts = now + baking_time_s
+
+    local urgent_id = redis.call('GET', urgent_prep)
+    local prep = redis.call('GET', prep_state)
+
+    if present(urgent_id) then
+        -- Consume one urgent bread (first bread type with remaining > 0)
+        local item = urgent_item_prefix .. urgent_id
+        local item_ticket = redis.call('HGET', item, 'ticket_id')
+        local chosen, remaining, total = consume_urgent_bread(urgent_prep, urgent_index, item, urgent_id, bread_ids, ttl)
+
+        local urgent_log = {urgent_id = urgent_id, remaining_by_type = {}, done = total <= 0}
+        if chosen then
+            for i, bid in ipairs(bread_ids) do
+                urgent_log.remaining_by_type[bid] = remaining[i]
+            end
+        end
+        result.urgent_log = urgent_log
+        if outbox then
+            outbox_add(outbox, 'log_urgent_remaining', cjson.encode(
+                {tonumber(outbox.bakery_id), urgent_id, urgent_log.remaining_by_type, urgent_log.done}))
+        end
+
+        -- Ticket-linked urgent bread, or standalone (ticket 0)
+        local tid = present(item_ticket) and item_ticket or '0'
+        local idx = next_bread_idx()
+        record_bread(breads, bread_counts, bread_last_ts, bread_max_ticket, ticket_breads_prefix, cook_ts, idx, tid, ttl)
+
+        local original = decode_counts(redis.call('HGET', item, 'original_breads'))
+        local customer_breads = {}
+        for i, bid in ipairs(bread_ids) do
+            customer_breads[bid] = original[i]
+        end
+        result.response = {
+            customer_id = tonumber(tid),
+            customer_breads = customer_breads,
+            next_customer = false,
+            urgent = true,
+            urgent_id = urgent_id,
+        }
+    elseif present(prep) and string.find(prep, ':') then
+        local tid, progress = string.match(prep, '^(%d+):(%d+)$')
+        local idx = next_bread_idx()
+        record_bread(breads, bread_counts, bread_last_ts, bread_max_ticket, ticket_breads_prefix, cook_ts, idx, tid, ttl)
+
+        local last_ts = redis.call('GET', last_bread_time)
+        redis.call('SET', last_bread_time, now, 'EX', ttl)
+        if present(last_ts) then
+            redis.call('ZADD', bread_time_diff, now - math.floor(tonumber(last_ts)), idx)
+        end
+        redis.call('SET', prep_state, tid .. ':' .. (tonumber(progress) + 1), 'EX', ttl)
+
+        result.bread = {ticket_id = tonumber(tid), cook_ts = cook_ts, idx = idx, pressed_at = now}
+        if outbox then
+            outbox_add(outbox, 'save_bread_to_db', cjson.encode({tonumber(tid), tonumber(outbox.bakery_id), cook_ts, idx, now}))
+        end
+        result.response = {
+            customer_id = tonumber(tid),
+            customer_breads = ticket_bread_counts(tid),
+            next_customer = false,
+        }
+    else
+        result.response = {has_customer = false, belongs_to_customer = false}
+    end
+
+    rebuild_prep_state()
+    result.changed = true
+    return cjson.encode(result)
+"""
+
+
+def _prep_state_script_keys(bakery_id: int) -> list[str]:
+    return [
+        REDIS_KEY_PREP_STATE.format(bakery_id),
+        REDIS_KEY_URGENT_PREP_STATE.format(bakery_id),
+        REDIS_KEY_RESERVATION_ORDER.format(bakery_id),
+        REDIS_KEY_RESERVATIONS.format(bakery_id),
+        REDIS_KEY_BASE_DONE.format(bakery_id),
+        REDIS_KEY_URGENT_QUEUE.format(bakery_id),
+        REDIS_KEY_TIME_PER_BREAD.format(bakery_id),
+        REDIS_KEY_BAKING_TIME_S.format(bakery_id),
+        *_bread_index_keys(bakery_id),
+        REDIS_KEY_LAST_BREAD_TIME.format(bakery_id),
+        REDIS_KEY_BREAD_TIME_DIFFS.format(bakery_id),
+        REDIS_KEY_BREAD_SEQ.format(bakery_id),
+        REDIS_KEY_URGENT_ACTIVE_IDS.format(bakery_id),
+        REDIS_KEY_URGENT_ACTIVE_BREADS.format(bakery_id),
+        REDIS_KEY_URGENT_REMAINING_S.format(bakery_id),
+        *_outbox_keys(bakery_id),
+    ]
+
+
+async def _run_prep_state_script(r, bakery_id: int, mode: str) -> dict:
+    script = r.register_script(LUA_BAKE_ONE_BREAD)
+    raw = await script(
+        keys=_prep_state_script_keys(bakery_id),
+        args=[
+            mode,
+            str(int(time.time())),
+            str(seconds_until_midnight_iran()),
+            get_urgent_item_key(bakery_id, ""),
+            f"{REDIS_KEY_URGENT_HISTORY.format(bakery_id)}:",
+            _ticket_breads_prefix(bakery_id),
+            _outbox_arg(bakery_id),
+        ],
+    )
+    result = json.loads(raw)
+    if result.pop("changed", False):
+        await mark_eta_table_stale(r, bakery_id)
+    return result
+
+
+async def bake_one_bread(r, bakery_id: int) -> dict:
+    """Handle one bread button press atomically.
+
+    Returns a dict with:
+      response   - payload for /hc/new_bread
+      bread      - {"ticket_id", "cook_ts", "idx", "pressed_at"} when a normal
+                   bread was baked; idx comes from bread_seq and is unique per
+                   bakery and Tehran day of pressed_at (the press time;
+                   cook_ts adds the baking time and may fall on the next day)
+      urgent_log - {"urgent_id", "remaining_by_type", "done"} when an urgent
+                   bread was consumed
+    """
+    result = await _run_prep_state_script(r, bakery_id, "bake")
+    await request_dispatch(r, bakery_id)
+    response = result.get("response") or {}
+    if "customer_breads" in response and not response["customer_breads"]:
+        response["customer_breads"] = {}
+    urgent_log = result.get("urgent_log")
+    if urgent_log and not urgent_log.get("remaining_by_type"):
+        urgent_log["remaining_by_type"] = {}
+    result["response"] = response
+    return result
+
+
+async def enqueue_bread_write(r, bakery_id: int, bread: dict):
+    """Queue a baked bread (bake_one_bread's ``bread``) for the bread writer."""
+    await r.xadd(
+        REDIS_KEY_BREAD_WRITES,
+        {
+            "bakery_id": int(bakery_id),
+            "ticket_id": int(bread.get("ticket_id") or 0),
+            "baked_at": bread["cook_ts"],
+            "seq": int(bread["idx"]),
+            "pressed_at": bread["pressed_at"],
+        },
+    )
+
+
+async def ensure_bread_writes_group(r):
+    """Create the bread_writes consumer group (and stream) if missing."""
+    try:
+        await r.xgroup_create(REDIS_KEY_BREAD_WRITES, BREAD_WRITES_GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+async def read_bread_writes(r, count: int, block_ms: int | None = None, pending: bool = False) -> list[tuple[str, dict]]:
+    """
+    Up to ``count`` bread_writes entries as (entry_id, fields). With
+    ``pending`` the entries delivered earlier but never acknowledged are
+    returned instead of new ones.
+    """
+    streams = await r.xreadgroup(
+        BREAD_WRITES_GROUP,
+        BREAD_WRITES_CONSUMER,
+        {REDIS_KEY_BREAD_WRITES: "0" if pending else ">"},
+        count=int(count),
+        block=None if pending else block_ms,
+    )
+    if not streams:
+        return []
+    entries = streams[0][1]
+    # A pending entry deleted from the stream comes back without fields; just settle it.
+    gone = [entry_id for entry_id, fields in entries if not fields]
+    if gone:
+        await r.xack(REDIS_KEY_BREAD_WRITES, BREAD_WRITES_GROUP, *gone)
+    return [(entry_id, fields) for entry_id, fields in entries if fields]
+
+
+async def ack_bread_writes(r, entry_ids):
+    """Acknowledge persisted bread_writes entries and drop them from the stream."""
+    if not entry_ids:
+        return
+    pipe = r.pipeline()
+    pipe.xack(REDIS_KEY_BREAD_WRITES, BREAD_WRITES_GROUP, *entry_ids)
+    pipe.xdel(REDIS_KEY_BREAD_WRITES, *entry_ids)
+    await pipe.execute()
+
+
+async def acquire_mqtt_state_lock(r, topic: str, token: str, ttl_ms: int) -> bool:
+    """Take the per-topic lock held while a state is compared, published and recorded."""
+    return bool(await r.set(REDIS_KEY_MQTT_STATE_LOCK.format(topic), token, nx=True, px=int(ttl_ms)))
+
+
+async def release_mqtt_state_lock(r, topic: str, token: str):
+    script = r.register_script(LUA_RELEASE_LOCK)
+    await script(keys=[REDIS_KEY_MQTT_STATE_LOCK.format(topic)], args=[token])
+
+
+async def extend_lock(r, lock_key: str, token: str, ttl_s: int) -> bool:
+    """Renew a lock we hold; False when it expired or another holder took it."""
+    script = r.register_script(LUA_EXTEND_LOCK)
+    return bool(await script(keys=[lock_key], args=[token, int(ttl_s)]))
+
+
+async def get_mqtt_state(r, topic: str) -> str | None:
+    return await r.get(REDIS_KEY_MQTT_STATE.format(topic))
+
+
+async def record_mqtt_state(r, topic: str, value: str, ttl_s: int):
+    """
+    Record ``value`` as the retained state the broker acknowledged for
+    ``topic``. The record expires after ``ttl_s`` so the state is sent again
+    now and then, in case the broker lost its retained copy.
+    """
+    await r.set(REDIS_KEY_MQTT_STATE.format(topic), value, ex=int(ttl_s))
+
+
+async def forget_mqtt_state(r, topic: str):
+    await r.delete(REDIS_KEY_MQTT_STATE.format(topic))
+
+
+def enqueue_admin_notification_sync(r, msg: str, message_thread_id: int, parse_mode: str | None, category: str):
+    """Queue one admin message for application.admin_notifier (sync client)."""
+    r.xadd(
+        REDIS_KEY_ADMIN_NOTIFICATIONS,
+        {
+            "msg": str(msg),
+            "thread_id": int(message_thread_id),
+            "parse_mode": parse_mode or "",
+            "category": str(category),
+        },
+        maxlen=ADMIN_NOTIFICATIONS_MAXLEN,
+        approximate=True,
+    )
+
+
+async def take_admin_notifications(r, count: int, block_ms: int | None = None) -> list[dict]:
+    """
+    Pop up to ``count`` queued admin messages, oldest first. Entries are
+    deleted as they are read: a notifier that dies loses what it buffered,
+    which is acceptable for notifications.
+    """
+    streams = await r.xread({REDIS_KEY_ADMIN_NOTIFICATIONS: "0"}, count=int(count), block=block_ms)
+    entries = streams[0][1] if streams else []
+    if entries:
+        await r.xdel(REDIS_KEY_ADMIN_NOTIFICATIONS, *[entry_id for entry_id, _ in entries])
+    return [
+        {
+            "msg": fields["msg"],
+            "thread_id": int(fields["thread_id"]),
+            "parse_mode": fields.get("parse_mode") or None,
+            "category": fields.get("category") or "info",
+        }
+        for _, fields in entries
+    ]
+
+
 async def set_display_flag(r, bakery_id: int):
     """
     Set flag to show customer info on display.
@@ -2,7 +2,7 @@ import secrets
 from sqlalchemy.types import Unicode
 from application.database import Base
 from sqlalchemy import Integer, String, Column, Boolean, ForeignKey, DateTime, BigInteger, Date
-from sqlalchemy import ForeignKeyConstraint
+from sqlalchemy import ForeignKeyConstraint, Index
 from datetime import datetime
 from pytz import UTC
 from sqlalchemy.orm import relationship
@@ -164,8 +164,15 @@ class Bread(Base):
     belongs_to = Column(Integer, ForeignKey('customer.id', ondelete='CASCADE'), nullable=True)
     consumed = Column(Boolean, default=False)
     bakery_id = Column(Integer, ForeignKey('bakery.bakery_id', ondelete='CASCADE'))
+    # Redis bread_seq index the bread was baked with, and the Tehran day it
+    # belongs to; the pair is unique per bakery (NULLs never conflict).
+    seq = Column(Integer, nullable=True)
+    baked_date = Column(Date, nullable=True)
     customer = relationship("Customer", back_populates="breads_associations")
     bakery = relationship("Bakery", back_populates="breads_associations")
+    __table_args__ = (
+        Index('uq_bread_bakery_date_seq', 'bakery_id', 'baked_date', 'seq', unique=True),
+    )
 
 
 class QueueStateSnapshot(Base):
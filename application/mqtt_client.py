@@ -1,8 +1,13 @@
 import json
 import asyncio
+import atexit
+import os
+import threading
 import time
-from application.tasks import report_to_admin_api
-from application.helpers import endpoint_helper
+import uuid
+from collections import deque
+from application.tasks import notify_admin
+from application.helpers import endpoint_helper, redis_helper
 from application.setting import settings
 import aiomqtt
 from application.logger_config import logger as app_logger
@@ -16,6 +21,8 @@ MQTT_CALL_CUSTOMER = f"{MQTT_BAKERY_PREFIX}/call_customer"
 MQTT_PRINT_TICKET = f"{MQTT_BAKERY_PREFIX}/print_ticket"
 MQTT_TICKET_JOB = f"{MQTT_BAKERY_PREFIX}/ticket_job"
 
+MQTT_RECONNECT_DELAY_S = 5
+
 mqtt_connected = asyncio.Event()
 
 
@@ -30,11 +37,11 @@ def _mqtt_log(level: str, event: str, **fields):
         app_logger.info(message, extra=fields)
 
 
-async def _publish_with_qos_fallback(client, topic: str, msg: str):
+async def _publish_with_qos_fallback(client, topic: str, msg: str, retain: bool = False):
     """Publish with QoS1 first; fallback to QoS0 on timeout to avoid dropped user flow."""
     try:
         _mqtt_log("info", "publish_qos1_attempt", topic=topic, payload=msg)
-        await client.publish(topic, msg, qos=1)
+        await client.publish(topic, msg, qos=1, retain=retain)
         _mqtt_log("info", "publish_qos1_ok", topic=topic)
         return
     except aiomqtt.MqttError as e:
@@ -44,7 +51,7 @@ async def _publish_with_qos_fallback(client, topic: str, msg: str):
         _mqtt_log("warning", "publish_qos1_timeout_retry_qos0", topic=topic, error=str(e))
 
     _mqtt_log("info", "publish_qos0_attempt", topic=topic, payload=msg)
-    await client.publish(topic, msg, qos=0)
+    await client.publish(topic, msg, qos=0, retain=retain)
     _mqtt_log("info", "publish_qos0_ok", topic=topic)
 
 async def mqtt_handler(app):
@@ -64,7 +71,7 @@ async def mqtt_handler(app):
                     text = (f"[🔴 MQTT ERROR]:"
                             f"\n\nBakeryID: {bakery_id}"
                             f"\nPayload: {payload}")
-                    report_to_admin_api.delay(text, message_thread_id=settings.HARDWARE_CLIENT_ERROR_THREAD_ID)
+                    notify_admin(text, message_thread_id=settings.HARDWARE_CLIENT_ERROR_THREAD_ID)
 
         except aiomqtt.MqttError as e:
             mqtt_connected.clear()  # Signal disconnection
@@ -77,7 +84,7 @@ async def mqtt_handler(app):
             await asyncio.sleep(5)
 
 
-async def safe_publish(request, topic: str, payload: dict) -> bool:
+async def safe_publish(request, topic: str, payload: dict, retain: bool = False) -> bool:
     """Try to publish quickly; never block request flow for long."""
     started_at = time.monotonic()
     try:
@@ -89,7 +96,7 @@ async def safe_publish(request, topic: str, payload: dict) -> bool:
     try:
         msg = json.dumps(payload)
         await asyncio.wait_for(
-            _publish_with_qos_fallback(request.app.state.mqtt_client, topic, msg),
+            _publish_with_qos_fallback(request.app.state.mqtt_client, topic, msg, retain=retain),
             timeout=float(settings.MQTT_PUBLISH_TIMEOUT_S),
         )
         _mqtt_log(
@@ -109,19 +116,85 @@ async def safe_publish(request, topic: str, payload: dict) -> bool:
         return False
 
 
+# Latest value per state topic waiting for its coalescing window, the task
+# that will publish it, and a counter bumped on every update so an older
+# flush can tell it has been superseded.
+_state_pending: dict[str, dict] = {}
+_state_flush_tasks: dict[str, asyncio.Task] = {}
+_state_generation: dict[str, int] = {}
+
+
+async def publish_state(request, topic: str, payload: dict):
+    """
+    Publish ``payload`` as the retained state of ``topic`` without waiting.
+
+    Values given within MQTT_STATE_COALESCE_MS are merged (the last one
+    wins), and a value equal to the last one the broker acknowledged from any
+    API process is skipped, so repeated polls do not reach the broker.
+    Retained, the state reaches devices when they (re)subscribe.
+    """
+    _state_pending[topic] = payload
+    _state_generation[topic] = _state_generation.get(topic, 0) + 1
+    if topic not in _state_flush_tasks:
+        _state_flush_tasks[topic] = asyncio.create_task(_flush_state(request, topic))
+
+
+async def _flush_state(request, topic: str):
+    coalesce_s = float(settings.MQTT_STATE_COALESCE_MS) / 1000
+    try:
+        await asyncio.sleep(coalesce_s)
+    finally:
+        _state_flush_tasks.pop(topic, None)
+        payload = _state_pending.pop(topic, None)
+        generation = _state_generation.get(topic)
+
+    def superseded():
+        return _state_generation.get(topic) != generation
+
+    r = request.app.state.redis
+    value = json.dumps(payload, sort_keys=True)
+    token = uuid.uuid4().hex
+    # Compare, publish and record under one per-topic lock, so API processes
+    # publish a topic one at a time and the record only ever holds a value
+    # the broker acknowledged last.
+    lock_ms = int((float(settings.MQTT_PUBLISH_TIMEOUT_S) + 1) * 1000)
+    try:
+        while not await redis_helper.acquire_mqtt_state_lock(r, topic, token, lock_ms):
+            if superseded():
+                return
+            await asyncio.sleep(coalesce_s)
+        try:
+            if superseded():
+                _mqtt_log("info", "state_superseded_skip_publish", topic=topic, payload=payload)
+                return
+            if await redis_helper.get_mqtt_state(r, topic) == value:
+                _mqtt_log("info", "state_unchanged_skip_publish", topic=topic, payload=payload)
+                return
+            if await safe_publish(request, topic, payload, retain=True):
+                await redis_helper.record_mqtt_state(r, topic, value, settings.MQTT_STATE_REFRESH_S)
+            else:
+                # The broker may or may not have it: let the next update publish again.
+                await redis_helper.forget_mqtt_state(r, topic)
+        finally:
+            await redis_helper.release_mqtt_state_lock(r, topic, token)
+    except Exception as e:
+        _mqtt_log("error", "state_publish_exception", topic=topic, payload=payload, error=str(e))
+        await endpoint_helper.log_and_report_error(f'mqtt_client:publish_state:{topic}', e)
+
+
 async def update_time_per_bread(request, bakery_id, new_config):
     topic = MQTT_UPDATE_BREAD_TIME.format(bakery_id)
-    await safe_publish(request, topic, new_config)
+    await publish_state(request, topic, new_config)
 
 
 async def update_has_customer_in_queue(request, bakery_id, state=True):
     topic = MQTT_UPDATE_HAS_CUSTOMER_IN_QUEUE.format(bakery_id)
-    await safe_publish(request, topic, {"state": state})
+    await publish_state(request, topic, {"state": state})
 
 
 async def update_has_upcoming_customer_in_queue(request, bakery_id, state=True):
     topic = MQTT_UPDATE_HAS_UPCOMING_CUSTOMER_IN_QUEUE.format(bakery_id)
-    await safe_publish(request, topic, {"state": state})
+    await publish_state(request, topic, {"state": state})
 
 
 async def notify_new_ticket(request, bakery_id: int, ticket_id: int, token: str):
@@ -151,6 +224,174 @@ async def publish_ticket_job(request, bakery_id: int, ticket_id: int, token: str
     await safe_publish(request, topic, payload)
 
 
+class BackgroundPublisher:
+    """
+    One persistent MQTT connection per process for publishes made outside
+    request handlers (Celery tasks, application.dispatch_worker).
+
+    The connection lives on its own thread and event loop, so callers on any
+    loop - including the short-lived asyncio.run loops of Celery tasks - share
+    it. ``publish`` only enqueues; the queue holds MQTT_PUBLISHER_QUEUE_SIZE
+    messages and drops the oldest when full. A dropped connection is
+    re-established and the message being sent is tried once more.
+    ``stats()`` reports queue depth and publish latency; they are also
+    logged every MQTT_PUBLISHER_STATS_INTERVAL_S.
+    """
+
+    def __init__(self, queue_size: int):
+        self.queue_size = max(1, int(queue_size))
+        self.connected = False
+        self.published = 0
+        self.dropped = 0
+        self.failed = 0
+        # Enqueue-to-ack latency of recent publishes.
+        self._latencies_ms = deque(maxlen=1000)
+        self._loop = None
+        self._queue = None
+        self._serve_task = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="mqtt-publisher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self._ready.wait()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._serve_task = self._loop.create_task(self._serve())
+        self._loop.call_soon(self._ready.set)
+        try:
+            self._loop.run_until_complete(self._serve_task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._loop.close()
+
+    def publish(self, topic: str, payload: dict):
+        """Queue ``payload`` (JSON) for ``topic``; safe to call from any thread."""
+        self._loop.call_soon_threadsafe(self._put, (topic, json.dumps(payload), time.monotonic()))
+
+    def _put(self, item):
+        if self._queue.full():
+            dropped_topic, _, _ = self._queue.get_nowait()
+            self._queue.task_done()
+            self.dropped += 1
+            _mqtt_log("warning", "publisher_queue_full_dropped_oldest", topic=dropped_topic, queue_size=self.queue_size)
+        self._queue.put_nowait(item)
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies_ms)
+        return {
+            "connected": self.connected,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "queue_size": self.queue_size,
+            "published": self.published,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "latency_avg_ms": round(sum(latencies) / len(latencies), 2) if latencies else None,
+            "latency_p95_ms": latencies[int(len(latencies) * 0.95)] if latencies else None,
+            "latency_max_ms": latencies[-1] if latencies else None,
+        }
+
+    async def _report_stats(self):
+        while True:
+            await asyncio.sleep(float(settings.MQTT_PUBLISHER_STATS_INTERVAL_S))
+            _mqtt_log("info", "publisher_stats", **self.stats())
+
+    async def _serve(self):
+        reporter = asyncio.create_task(self._report_stats())
+        client = aiomqtt.Client(hostname=settings.MQTT_BROKER_HOST, port=settings.MQTT_BROKER_PORT, timeout=30)
+        # (item, failed attempts) of the message being sent, kept across reconnects.
+        current = None
+        try:
+            while True:
+                try:
+                    async with client:
+                        self.connected = True
+                        _mqtt_log("info", "publisher_connected")
+                        while True:
+                            if current is None:
+                                current = (await self._queue.get(), 0)
+                            (topic, msg, queued_at), attempts = current
+                            try:
+                                await asyncio.wait_for(
+                                    _publish_with_qos_fallback(client, topic, msg),
+                                    timeout=float(settings.MQTT_PUBLISH_TIMEOUT_S),
+                                )
+                            except (aiomqtt.MqttError, asyncio.TimeoutError):
+                                current = ((topic, msg, queued_at), attempts + 1)
+                                raise
+                            current = None
+                            self.published += 1
+                            self._latencies_ms.append(round((time.monotonic() - queued_at) * 1000, 2))
+                            self._queue.task_done()
+                except (aiomqtt.MqttError, asyncio.TimeoutError) as e:
+                    _mqtt_log("warning", "publisher_reconnecting", error=str(e) or type(e).__name__)
+                finally:
+                    self.connected = False
+
+                if current is not None and current[1] >= 2:
+                    self.failed += 1
+                    self._queue.task_done()
+                    _mqtt_log("error", "publisher_publish_failed", topic=current[0][0])
+                    current = None
+                await asyncio.sleep(MQTT_RECONNECT_DELAY_S)
+        finally:
+            reporter.cancel()
+
+    async def _drain(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._serve_task.cancel()
+
+    def close(self, timeout: float = 5.0):
+        """Send what is queued (for at most ``timeout`` seconds), then disconnect."""
+        if self._loop is None or self._loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self._drain(timeout), self._loop)
+        self._thread.join(timeout + 1)
+        _mqtt_log("info", "publisher_closed", **self.stats())
+
+
+_background_publisher = None
+_background_publisher_pid = None
+_background_publisher_lock = threading.Lock()
+
+
+def background_publisher() -> BackgroundPublisher:
+    """This process's BackgroundPublisher, started on first use (again in a forked child)."""
+    global _background_publisher, _background_publisher_pid
+    with _background_publisher_lock:
+        if _background_publisher is None or _background_publisher_pid != os.getpid():
+            _background_publisher = BackgroundPublisher(settings.MQTT_PUBLISHER_QUEUE_SIZE)
+            _background_publisher.start()
+            _background_publisher_pid = os.getpid()
+        return _background_publisher
+
+
+def close_background_publisher(timeout: float = 5.0):
+    if _background_publisher is not None and _background_publisher_pid == os.getpid():
+        _background_publisher.close(timeout)
+
+
+# Last resort for processes that exit without a shutdown hook of their own.
+atexit.register(close_background_publisher)
+
+
+async def _publish_background(topic: str, payload: dict):
+    """Publish from non-request contexts through the process's BackgroundPublisher."""
+    try:
+        background_publisher().publish(topic, payload)
+        _mqtt_log("info", "background_publish_queued", topic=topic, payload=payload)
+    except Exception as e:
+        _mqtt_log("error", "background_publish_exception", topic=topic, payload=payload, error=str(e))
+        await endpoint_helper.log_and_report_error(f'mqtt_client:publish_ticket_job_background:{topic}', e)
+
+
 async def publish_ticket_job_background(bakery_id: int, ticket_id: int, token: str, print_ticket: bool, show_on_display: bool):
     """Publish ticket_job from non-request contexts (e.g., Celery tasks)."""
     topic = MQTT_TICKET_JOB.format(bakery_id)
@@ -161,16 +402,29 @@ async def publish_ticket_job_background(bakery_id: int, ticket_id: int, token: s
         "print": bool(print_ticket),
         "show_on_display": bool(show_on_display),
     }
-    try:
-        _mqtt_log("info", "background_publish_attempt", topic=topic, payload=payload)
-        async with aiomqtt.Client(hostname=settings.MQTT_BROKER_HOST, port=settings.MQTT_BROKER_PORT, timeout=30) as client:
-            await asyncio.wait_for(
-                _publish_with_qos_fallback(client, topic, json.dumps(payload)),
-                timeout=float(settings.MQTT_PUBLISH_TIMEOUT_S),
-            )
-        _mqtt_log("info", "background_publish_success", topic=topic, payload=payload)
-    except aiomqtt.MqttError as e:
-        _mqtt_log("warning", "background_publish_mqtt_error", topic=topic, payload=payload, error=str(e))
-    except Exception as e:
-        _mqtt_log("error", "background_publish_exception", topic=topic, payload=payload, error=str(e))
-        await endpoint_helper.log_and_report_error(f'mqtt_client:publish_ticket_job_background:{topic}', e)
+    await _publish_background(topic, payload)
+
+
+async def publish_ticket_jobs_background(bakery_id: int, ticket_ids, token: str, print_ticket: bool, show_on_display: bool):
+    """One ticket_job for several tickets dispatched together.
+
+    A single ticket gets the plain publish_ticket_job_background payload.
+    Otherwise ``ticket_id`` holds the first ticket, for devices that only
+    read one, and ``ticket_ids`` the whole batch in dispatch order.
+    """
+    ticket_ids = [int(t) for t in ticket_ids]
+    if not ticket_ids:
+        return
+    if len(ticket_ids) == 1:
+        await publish_ticket_job_background(bakery_id, ticket_ids[0], token, print_ticket, show_on_display)
+        return
+    topic = MQTT_TICKET_JOB.format(bakery_id)
+    payload = {
+        "bakery_id": int(bakery_id),
+        "ticket_id": ticket_ids[0],
+        "ticket_ids": ticket_ids,
+        "token": str(token),
+        "print": bool(print_ticket),
+        "show_on_display": bool(show_on_display),
+    }
+    await _publish_background(topic, payload)
@@ -0,0 +1,185 @@
+"""Transactional outbox relay.
+
+    python -m application.outbox_worker
+
+With OUTBOX enabled the Lua scripts that change queue state (new tickets,
+ticket moves, wait-list serves, urgent injects/edits/cancels, baked breads)
+also append the matching DB write to the bakery's ``outbox`` stream in the
+same script, so Redis and the queued DB write can no longer disagree when the
+API process dies between the two. This process applies those entries in stream order per
+bakery by running the task body from application.tasks directly; runs of
+``save_bread_to_db`` entries are written with one crud.create_breads_bulk.
+
+An entry is deleted only after it is applied, so a restart replays whatever
+was left; every outbox task is idempotent. A bakery whose head entry fails is
+retried every RETRY_DELAY_S (later entries wait behind it to keep the order);
+after OUTBOX_MAX_ATTEMPTS the entry is parked in ``outbox:dead`` and reported.
+"""
+import asyncio
+import signal
+import time
+import traceback
+
+from redis import asyncio as aioredis
+
+from application import crud, tasks
+from application.database import SessionLocal
+from application.helpers import redis_helper
+from application.logger_config import celery_logger
+from application.setting import settings
+
+RETRY_DELAY_S = 5
+# Longest a read blocks while every outbox is empty.
+IDLE_BLOCK_MS = 1000
+
+# Tasks the scripts may emit; anything else is dead-lettered untouched.
+OUTBOX_TASKS = {
+    "register_new_customer",
+    "serve_wait_list_ticket",
+    "send_ticket_to_wait_list",
+    "send_tickets_to_wait_list",
+    "remove_customer_from_upcoming_customers",
+    "log_urgent_inject",
+    "log_urgent_edit",
+    "log_urgent_cancel",
+    "log_urgent_remaining",
+    "save_bread_to_db",
+}
+
+
+# save_bread_to_db args, in order; entries queued before pressed_at existed
+# have only the first four.
+_BREAD_FIELDS = ("ticket_id", "bakery_id", "baked_at", "seq", "pressed_at")
+
+
+def _write_breads(entries) -> None:
+    breads = [dict(zip(_BREAD_FIELDS, args)) for _, _, args in entries]
+    with SessionLocal() as db:
+        crud.create_breads_bulk(db, breads)
+
+
+def _apply(entries) -> tuple[list[str], tuple | None]:
+    """
+    Apply ``entries`` in order until one fails. Returns the applied entry ids
+    and ``(entry, error)`` for the failing one, if any.
+    """
+    applied = []
+    i = 0
+    while i < len(entries):
+        entry_id, task, args = entries[i]
+        if task not in OUTBOX_TASKS:
+            return applied, (entries[i], f"unknown outbox task {task!r}")
+
+        if task == "save_bread_to_db":
+            j = i
+            while j < len(entries) and entries[j][1] == "save_bread_to_db":
+                j += 1
+            run = entries[i:j]
+        else:
+            run = entries[i:i + 1]
+
+        try:
+            if task == "save_bread_to_db":
+                _write_breads(run)
+            else:
+                getattr(tasks, task).run(*args)
+        except Exception as e:
+            celery_logger.error(
+                "outbox_worker apply failed",
+                extra={"entry_id": entry_id, "task": task, "error": str(e), "traceback": traceback.format_exc()},
+            )
+            # A failed bread batch is retried from its first entry.
+            return applied, (entries[i], str(e))
+
+        applied.extend(e_id for e_id, _, _ in run)
+        i += len(run)
+    return applied, None
+
+
+async def _relay(r, bakery_id: int, entries, attempts: dict, retry_at: dict):
+    started_at = time.monotonic()
+    applied, failure = await asyncio.to_thread(_apply, entries)
+    await redis_helper.drop_outbox_entries(r, bakery_id, applied)
+    for entry_id in applied:
+        attempts.pop(entry_id, None)
+
+    if failure:
+        (entry_id, task, args), error = failure
+        attempts[entry_id] = attempts.get(entry_id, 0) + 1
+        if task not in OUTBOX_TASKS or attempts[entry_id] >= int(settings.OUTBOX_MAX_ATTEMPTS):
+            await redis_helper.dead_letter_outbox_entry(r, bakery_id, entry_id, task, args, error)
+            attempts.pop(entry_id, None)
+            tasks.notify_admin(
+                f"[🔴 ERROR] outbox_worker"
+                f"\n\nBakery ID: {bakery_id}"
+                f"\nEntry: {entry_id} ({task})"
+                f"\nReason: {error}"
+                f"\nAction: moved to {redis_helper.REDIS_KEY_OUTBOX_DEAD}"
+            )
+        else:
+            retry_at[bakery_id] = time.monotonic() + RETRY_DELAY_S
+
+    celery_logger.info(
+        "outbox_worker applied",
+        extra={
+            "bakery_id": bakery_id,
+            "applied": len(applied),
+            "failed": failure is not None,
+            "duration_ms": round((time.monotonic() - started_at) * 1000, 2),
+        },
+    )
+
+
+async def run():
+    r = aioredis.from_url(settings.REDIS_URL, decode_responses=True)
+    batch_size = max(1, int(settings.OUTBOX_BATCH_SIZE))
+    attempts: dict[str, int] = {}
+    retry_at: dict[int, float] = {}
+    celery_logger.info("outbox_worker started")
+    try:
+        while True:
+            now = time.monotonic()
+            bakery_ids = [
+                b for b in await redis_helper.outbox_bakeries(r) if retry_at.get(b, 0) <= now
+            ]
+            batches = await redis_helper.read_outbox(r, bakery_ids, batch_size)
+            if not batches:
+                # Nothing to do right now: wait for new entries, or for the next retry.
+                block_ms = IDLE_BLOCK_MS
+                if retry_at:
+                    block_ms = max(1, min(block_ms, int((min(retry_at.values()) - now) * 1000)))
+                if bakery_ids:
+                    await redis_helper.read_outbox(r, bakery_ids, 1, block_ms=block_ms)
+                else:
+                    await asyncio.sleep(block_ms / 1000)
+                retry_at = {b: t for b, t in retry_at.items() if t > time.monotonic()}
+                continue
+
+            await asyncio.gather(
+                *(_relay(r, b, entries, attempts, retry_at) for b, entries in batches.items())
+            )
+    finally:
+        await r.aclose()
+        celery_logger.info("outbox_worker stopped")
+
+
+def main():
+    if not settings.OUTBOX:
+        celery_logger.info("outbox_worker not started: needs OUTBOX")
+        return
+
+    async def _main():
+        worker = asyncio.create_task(run())
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, worker.cancel)
+        try:
+            await worker
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(_main())
+
+
+if __name__ == "__main__":
+    main()
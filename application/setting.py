@@ -31,6 +31,10 @@ class Settings(BaseSettings):
     MQTT_BROKER_HOST: str
     MQTT_BROKER_PORT: int
     MQTT_PUBLISH_TIMEOUT_S: float = 5.0
+    MQTT_PUBLISHER_QUEUE_SIZE: int = 1000
+    MQTT_PUBLISHER_STATS_INTERVAL_S: float = 60.0
+    MQTT_STATE_COALESCE_MS: int = 200
+    MQTT_STATE_REFRESH_S: int = 300
 
     # Redis
     REDIS_URL: str
@@ -38,6 +42,24 @@ class Settings(BaseSettings):
     # Celery
     CELERY_BROKER_URL: str
     ENABLE_AUTO_DISPATCH_READY_TICKETS: bool = True
+    AUTO_DISPATCH_SWEEP_INTERVAL_S: float = 30.0
+    AUTO_DISPATCH_WORKER: bool = False
+    AUTO_DISPATCH_CONCURRENCY: int = 8
+    AUTO_DISPATCH_BAKERY_TIMEOUT_S: float = 8.0
+    QUEUE_STATE_COMPACT_INTERVAL_S: float = 60.0
+    QUEUE_STATE_WINDOWED: bool = True
+    BREAD_WRITER: bool = False
+    BREAD_WRITER_BATCH_SIZE: int = 200
+    BREAD_WRITER_FLUSH_MS: int = 500
+    OUTBOX: bool = False
+    OUTBOX_BATCH_SIZE: int = 200
+    OUTBOX_MAX_ATTEMPTS: int = 5
+    TELEGRAM_API_URL: str = "https://api.telegram.org"
+    ADMIN_NOTIFIER: bool = False
+    ADMIN_NOTIFIER_DIGEST_S: float = 30.0
+    ADMIN_NOTIFIER_RATE_PER_MIN: int = 20
+    ADMIN_NOTIFIER_BURST: int = 5
+    ADMIN_NOTIFIER_MAX_PENDING: int = 1000
 
     class Config:
         env_file = "../.env"  # only needed for local/dev; ignored in Docker if env vars already set
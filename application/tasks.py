@@ -2,6 +2,7 @@ import functools, requests
 import json
 from application import crud
 from celery import Celery
+from celery.signals import worker_process_shutdown, worker_shutdown
 from datetime import datetime
 from pytz import UTC
 from application.logger_config import celery_logger
@@ -11,8 +12,10 @@ import traceback, redis
 from uuid import uuid4
 from application.auth import OTPStore
 from application.helpers import redis_helper
+from application.helpers.general_helpers import generate_daily_customer_token
 from redis import asyncio as aioredis
 import asyncio
+import time
 from contextlib import contextmanager
 
 celery_app = Celery(
@@ -22,15 +25,34 @@ celery_app = Celery(
 )
 
 
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def close_mqtt_publisher(**kwargs):
+    # Send ticket jobs still queued on this worker process's MQTT connection.
+    # Prefork children get worker_process_shutdown; the threads pool (our
+    # compose worker) only sends worker_shutdown, in the main process.
+    from application import mqtt_client
+    mqtt_client.close_background_publisher()
+
+
 @celery_app.on_after_finalize.connect
 def setup_periodic_tasks(sender, **kwargs):
-    # Run every 5 seconds to dispatch any ready tickets to wait list.
-    if settings.ENABLE_AUTO_DISPATCH_READY_TICKETS:
-        sender.add_periodic_task(5.0, auto_dispatch_ready_tickets.s(), name="auto_dispatch_ready_tickets_every_5s")
+    # Auto-dispatch is event driven (see redis_helper.request_dispatch); this
+    # sweep only re-arms the dispatcher if an armed run was lost. The
+    # dedicated dispatch worker (AUTO_DISPATCH_WORKER) does its own sweeping.
+    if settings.ENABLE_AUTO_DISPATCH_READY_TICKETS and not settings.AUTO_DISPATCH_WORKER:
+        sender.add_periodic_task(
+            settings.AUTO_DISPATCH_SWEEP_INTERVAL_S, auto_dispatch_ready_tickets.s(), name="auto_dispatch_sweep"
+        )
         celery_logger.info("Periodic auto-dispatch is enabled")
     else:
         celery_logger.info("Periodic auto-dispatch is disabled by configuration")
 
+    # Fold queue event logs into their snapshots.
+    sender.add_periodic_task(
+        settings.QUEUE_STATE_COMPACT_INTERVAL_S, compact_queue_states.s(), name="compact_queue_states"
+    )
+
 
 @contextmanager
 def session_scope():
@@ -45,14 +67,19 @@ def session_scope():
         db.close()
 
 
+def telegram_proxy_url() -> str | None:
+    proxy_url = settings.TELEGRAM_PROXY_URL
+    if proxy_url:
+        proxy_url = proxy_url.strip().strip('"').strip("'")
+    return proxy_url or None
+
+
 @celery_app.task(autoretry_for=(Exception,), retry_kwargs={"max_retries": 3, "countdown": 5})
 def report_to_admin_api(msg, message_thread_id=settings.ERR_THREAD_ID, parse_mode: str | None = None):
     json_data = {'chat_id': settings.TELEGRAM_CHAT_ID, 'text': msg[:4096], 'message_thread_id': message_thread_id}
     if parse_mode:
         json_data['parse_mode'] = parse_mode
-    proxy_url = settings.TELEGRAM_PROXY_URL
-    if proxy_url:
-        proxy_url = proxy_url.strip().strip('"').strip("'")
+    proxy_url = telegram_proxy_url()
 
     proxies = None
     if proxy_url:
@@ -63,13 +90,41 @@ def report_to_admin_api(msg, message_thread_id=settings.ERR_THREAD_ID, parse_mod
         }
 
     response = requests.post(
-        url=f"https://api.telegram.org/bot{settings.TELEGRAM_TOKEN}/sendMessage",
+        url=f"{settings.TELEGRAM_API_URL}/bot{settings.TELEGRAM_TOKEN}/sendMessage",
         json=json_data,
         timeout=10,
         proxies=proxies
     )
     response.raise_for_status()
 
+
+_notify_redis = None
+
+
+def notify_admin(msg, message_thread_id=settings.ERR_THREAD_ID, parse_mode: str | None = None, category: str | None = None):
+    """
+    Send a message to the admin Telegram group. With ADMIN_NOTIFIER on it is
+    queued for application.admin_notifier, which merges messages into digests
+    and keeps under Telegram's rate limit; otherwise (or if Redis is down) it
+    goes out as its own report_to_admin_api task.
+
+    ``category`` is an endpoint_helper.report_to_admin level; it defaults to
+    "error" for the error threads and "info" elsewhere.
+    """
+    global _notify_redis
+    if settings.ADMIN_NOTIFIER:
+        if category is None:
+            error_threads = (settings.ERR_THREAD_ID, settings.HARDWARE_CLIENT_ERROR_THREAD_ID)
+            category = "error" if message_thread_id in error_threads else "info"
+        try:
+            if _notify_redis is None:
+                _notify_redis = redis.from_url(settings.REDIS_URL, decode_responses=True)
+            redis_helper.enqueue_admin_notification_sync(_notify_redis, msg, message_thread_id, parse_mode, category)
+            return
+        except Exception as e:
+            celery_logger.error("notify_admin could not queue message", extra={"error": str(e)})
+    report_to_admin_api.delay(msg, message_thread_id, parse_mode)
+
 def handle_task_errors(func):
     @functools.wraps(func)
     def wrapper(self, *args, **kwargs):
@@ -94,15 +149,20 @@ def handle_task_errors(func):
                 f"\nError ID: {error_id}"
             )
 
-            report_to_admin_api.delay(err_msg)
+            notify_admin(err_msg)
             raise
     return wrapper
 
 
 @celery_app.task(bind=True, autoretry_for=(Exception,), retry_kwargs={"max_retries": 3, "countdown": 5})
 @handle_task_errors
-def register_new_customer(self, customer_ticket_id, bakery_id, bread_requirements, customer_in_upcoming_customer=False, token: str | None = None, note: str | None = None):
+def register_new_customer(self, customer_ticket_id, bakery_id, bread_requirements, customer_in_upcoming_customer=False, token: str | None = None, note: str | None = None, issued_at: float | None = None):
+    # Entries queued by LUA_ISSUE_TICKET carry the issue time instead of the token.
+    token = token or generate_daily_customer_token(bakery_id, customer_ticket_id, issued_at)
     with session_scope() as db:
+        # Outbox entries can be applied twice (worker stopped before dropping them).
+        if crud.customer_ticket_exists_today(db, customer_ticket_id, bakery_id):
+            return
         c_id = crud.new_customer_no_commit(db, customer_ticket_id, bakery_id, True, token, note)
         crud.new_bread_customers(db, c_id, bread_requirements)
         if customer_in_upcoming_customer:
@@ -157,7 +217,56 @@ def send_ticket_to_wait_list(self, ticket_id, bakery_id, source: str = "system")
         f"\n• Ticket Number: {int(ticket_id)}"
         f"\n• Source: {str(source)}"
     )
-    report_to_admin_api.delay(msg, settings.BAKERY_TICKET_THREAD_ID)
+    notify_admin(msg, settings.BAKERY_TICKET_THREAD_ID, category="ticket")
+
+
+@celery_app.task(bind=True, autoretry_for=(Exception,), retry_kwargs={"max_retries": 3, "countdown": 5})
+@handle_task_errors
+def send_tickets_to_wait_list(self, ticket_ids, bakery_id, source: str = "system", remove_upcoming: bool = False):
+    """
+    DB side of one batch dispatch: wait-list every ticket, consume its breads
+    and, with ``remove_upcoming``, drop it from the upcoming customers.
+
+    Every step is idempotent, so a retry after a partial failure redoes the
+    whole batch safely.
+    """
+    ticket_ids = [int(t) for t in ticket_ids]
+    celery_logger.info(
+        "send_tickets_to_wait_list started",
+        extra={"bakery_id": int(bakery_id), "ticket_ids": ticket_ids, "source": str(source)},
+    )
+    missing = []
+    with session_scope() as db:
+        for ticket_id in ticket_ids:
+            customer_id = crud.update_customer_status_to_false(db, ticket_id, bakery_id)
+            if customer_id is None:
+                customer = crud.get_customer_by_ticket_id_any_status(db, ticket_id, bakery_id)
+                customer_id = customer.id if customer else None
+
+            if customer_id is None:
+                missing.append(ticket_id)
+                continue
+
+            crud.add_new_ticket_to_wait_list(db, customer_id, True)
+            crud.consume_breads_for_customer_today(db, bakery_id, ticket_id)
+            if remove_upcoming:
+                crud.remove_upcoming_customer(db, ticket_id, bakery_id)
+
+    if missing:
+        raise ValueError(f"Customer not found for ticket_ids={missing}, bakery_id={bakery_id}")
+
+    celery_logger.info(
+        "send_tickets_to_wait_list persisted to DB",
+        extra={"bakery_id": int(bakery_id), "ticket_ids": ticket_ids},
+    )
+
+    msg = (
+        f"📌 Tickets Sent To Wait List"
+        f"\n• Bakery Id: {int(bakery_id)}"
+        f"\n• Ticket Numbers: {', '.join(str(t) for t in ticket_ids)}"
+        f"\n• Source: {str(source)}"
+    )
+    notify_admin(msg, settings.BAKERY_TICKET_THREAD_ID, category="ticket")
 
 
 @celery_app.task(bind=True, autoretry_for=(Exception,), retry_kwargs={"max_retries": 3, "countdown": 5})
@@ -205,9 +314,207 @@ def schedule_auto_dispatch(self, bakery_id: int, countdown_s: int = 0):
     auto_dispatch_ready_tickets.apply_async(kwargs={"bakery_id": int(bakery_id)}, countdown=delay)
 
 
+# After a failed dispatch the bakery is looked at again this much later.
+AUTO_DISPATCH_RETRY_DELAY_S = 5
+# auto_dispatch_lock expiry; renewed every third of it while the dispatch runs,
+# so it only lapses when the process holding it is gone.
+AUTO_DISPATCH_LOCK_TTL_S = 10
+
+
+def arm_auto_dispatch(at: float):
+    """Run auto_dispatch_ready_tickets at ``at`` (epoch seconds)."""
+    auto_dispatch_ready_tickets.apply_async(countdown=max(0.0, float(at) - time.time()))
+
+
+async def _renew_auto_dispatch_lock(r, lock_key: str, lock_token: str):
+    while await redis_helper.extend_lock(r, lock_key, lock_token, AUTO_DISPATCH_LOCK_TTL_S):
+        await asyncio.sleep(AUTO_DISPATCH_LOCK_TTL_S / 3)
+
+
+async def auto_dispatch_bakery(r, current_bakery_id: int):
+    """
+    Move every ready ticket of the bakery to the wait list in one batch, or
+    park the bakery at its next ready deadline.
+    """
+    await redis_helper.rebuild_prep_state(r, current_bakery_id)
+    lock_key = f"bakery:{current_bakery_id}:auto_dispatch_lock"
+    lock_token = uuid4().hex
+    acquired = await r.set(lock_key, lock_token, nx=True, ex=AUTO_DISPATCH_LOCK_TTL_S)
+    if not acquired:
+        celery_logger.info(
+            "auto_dispatch_ready_tickets skipped because lock is held",
+            extra={"bakery_id": current_bakery_id, "lock_key": lock_key},
+        )
+        await redis_helper.schedule_dispatch(r, current_bakery_id, time.time() + 1)
+        return
+
+    renewer = asyncio.create_task(_renew_auto_dispatch_lock(r, lock_key, lock_token))
+    try:
+        ready_ids, next_wait = await redis_helper.select_ready_tickets_by_ready_time(r, current_bakery_id)
+        if not ready_ids:
+            celery_logger.info(
+                "auto_dispatch_ready_tickets no ready ticket",
+                extra={"bakery_id": current_bakery_id, "next_wait": next_wait},
+            )
+            if next_wait is not None:
+                await redis_helper.schedule_dispatch(r, current_bakery_id, time.time() + int(next_wait))
+            return
+
+        _, time_per_bread, upcoming_breads = await redis_helper.get_customer_ticket_data_pipe_without_reservations_with_upcoming_breads(
+            r, current_bakery_id
+        )
+        remove_upcoming = bool(time_per_bread) and any(
+            bread in time_per_bread.keys() for bread in (upcoming_breads or [])
+        )
+
+        results = await redis_helper.send_tickets_to_wait_list(
+            r, current_bakery_id, ready_ids, source="auto_dispatch", remove_upcoming=remove_upcoming
+        )
+        moved_ids = [tid for tid, moved, _, _ in results if moved]
+        not_moved = [tid for tid, moved, _, _ in results if not moved]
+        if not_moved:
+            reservation_list = await redis_helper.get_bakery_reservations(
+                r, current_bakery_id, fetch_from_redis_first=False
+            )
+            if reservation_list:
+                results = await redis_helper.send_tickets_to_wait_list(
+                    r, current_bakery_id, not_moved, source="auto_dispatch", remove_upcoming=remove_upcoming
+                )
+                moved_ids += [tid for tid, moved, _, _ in results if moved]
+        if not moved_ids:
+            return
+
+        # Tickets may become ready while this batch is handled; look again right away.
+        await redis_helper.schedule_dispatch(r, current_bakery_id)
+        await redis_helper.rebuild_prep_state(r, current_bakery_id)
+
+        from application import mqtt_client
+        await mqtt_client.publish_ticket_jobs_background(
+            bakery_id=current_bakery_id,
+            ticket_ids=moved_ids,
+            token="does not matter",
+            print_ticket=False,
+            show_on_display=True,
+        )
+
+        if remove_upcoming:
+            await redis_helper.remove_customers_from_upcoming_customers(r, current_bakery_id, moved_ids)
+
+        # With the outbox on, send_tickets_to_wait_list queued the DB side itself.
+        db_waitlist_task_id = None
+        if not settings.OUTBOX:
+            db_waitlist_task_id = send_tickets_to_wait_list.delay(
+                moved_ids, current_bakery_id, "auto_dispatch", remove_upcoming
+            ).id
+        celery_logger.info(
+            "auto_dispatch_ready_tickets moved tickets to wait list",
+            extra={
+                "bakery_id": current_bakery_id,
+                "ticket_ids": moved_ids,
+                "db_waitlist_task_id": db_waitlist_task_id,
+            },
+        )
+
+        msg = (
+            f"Bakery ID: {current_bakery_id}"
+            f"\nTicket Numbers: {', '.join(str(t) for t in moved_ids)}"
+            f"\nAction: auto-dispatch to wait list"
+        )
+        notify_admin(msg, settings.BAKERY_TICKET_THREAD_ID, category="ticket")
+    finally:
+        renewer.cancel()
+        try:
+            await renewer
+        except asyncio.CancelledError:
+            pass
+        current_token = await r.get(lock_key)
+        if current_token == lock_token:
+            await r.delete(lock_key)
+
+
+async def _timed_auto_dispatch(r, bakery_id: int):
+    """auto_dispatch_bakery with its own error handling and duration stats."""
+    started_at = time.monotonic()
+    outcome = "ok"
+    try:
+        await auto_dispatch_bakery(r, bakery_id)
+    except Exception as e:
+        outcome = "error"
+        await redis_helper.schedule_dispatch(r, bakery_id, time.time() + AUTO_DISPATCH_RETRY_DELAY_S)
+        celery_logger.error(
+            "auto_dispatch_bakery failed",
+            extra={"bakery_id": bakery_id, "error": str(e), "traceback": traceback.format_exc()},
+        )
+        notify_admin(
+            f"[🔴 ERROR] auto-dispatch"
+            f"\n\nBakery ID: {bakery_id}"
+            f"\nType: {type(e)}"
+            f"\nReason: {str(e)}"
+        )
+    finally:
+        duration_ms = round((time.monotonic() - started_at) * 1000, 2)
+        await redis_helper.record_dispatch_stats(r, bakery_id, duration_ms, outcome)
+        celery_logger.info(
+            "auto_dispatch_bakery finished",
+            extra={"bakery_id": bakery_id, "duration_ms": duration_ms, "outcome": outcome},
+        )
+
+
+async def dispatch_due_bakeries(r, stragglers: set | None = None):
+    """
+    Dispatch every bakery whose deadline in auto_dispatch:due has passed,
+    at most AUTO_DISPATCH_CONCURRENCY at a time.
+
+    A bakery still running after AUTO_DISPATCH_BAKERY_TIMEOUT_S gives up its
+    slot but is not cancelled (that could leave a ticket half moved); it keeps
+    its auto_dispatch_lock, renewed every AUTO_DISPATCH_LOCK_TTL_S / 3 while
+    it runs, until done. Such stragglers are collected in
+    ``stragglers`` when given (long-running worker), otherwise awaited before
+    returning.
+    """
+    limit = max(1, int(settings.AUTO_DISPATCH_CONCURRENCY))
+    timeout_s = float(settings.AUTO_DISPATCH_BAKERY_TIMEOUT_S)
+    pending_stragglers = set() if stragglers is None else stragglers
+    running: dict[asyncio.Task, tuple[int, float]] = {}
+
+    while True:
+        while len(running) < limit:
+            bakery_id = await redis_helper.pop_due_dispatch(r)
+            if bakery_id is None:
+                break
+            task = asyncio.create_task(_timed_auto_dispatch(r, bakery_id))
+            running[task] = (bakery_id, time.monotonic() + timeout_s)
+        if not running:
+            break
+
+        next_timeout = max(0.0, min(deadline for _, deadline in running.values()) - time.monotonic())
+        done, _ = await asyncio.wait(running, timeout=next_timeout, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            running.pop(task)
+
+        now = time.monotonic()
+        for task, (bakery_id, deadline) in list(running.items()):
+            if deadline <= now:
+                running.pop(task)
+                pending_stragglers.add(task)
+                task.add_done_callback(pending_stragglers.discard)
+                await redis_helper.record_dispatch_stats(r, bakery_id, None, "timeout")
+                celery_logger.warning(
+                    "auto_dispatch_bakery timed out",
+                    extra={"bakery_id": bakery_id, "timeout_s": timeout_s},
+                )
+
+    if stragglers is None and pending_stragglers:
+        await asyncio.wait(pending_stragglers)
+
+
 @celery_app.task(bind=True)
 @handle_task_errors
 def auto_dispatch_ready_tickets(self, bakery_id: int | None = None):
+    """
+    Run dispatch_due_bakeries, then arm the next run for the earliest
+    remaining deadline. With ``bakery_id`` only that bakery is checked.
+    """
 
     async def _task(target_bakery_id: int | None):
         r = aioredis.from_url(
@@ -215,114 +522,17 @@ def auto_dispatch_ready_tickets(self, bakery_id: int | None = None):
             decode_responses=True
         )
         try:
-            with SessionLocal() as session:
-                bakeries = crud.get_all_active_bakeries(session)
-
-            target_bakery_ids = []
             if target_bakery_id is not None:
-                target_bakery_ids = [int(target_bakery_id)]
+                await _timed_auto_dispatch(r, int(target_bakery_id))
             else:
-                for bakery in bakeries or []:
-                    target_bakery_ids.append(int(getattr(bakery, "bakery_id", bakery)))
-
-            for current_bakery_id in target_bakery_ids:
-                await redis_helper.rebuild_prep_state(r, current_bakery_id)
-                lock_key = f"bakery:{current_bakery_id}:auto_dispatch_lock"
-                lock_token = uuid4().hex
-                acquired = await r.set(lock_key, lock_token, nx=True, ex=10)
-                if not acquired:
-                    celery_logger.info(
-                        "auto_dispatch_ready_tickets skipped because lock is held",
-                        extra={"bakery_id": current_bakery_id, "lock_key": lock_key},
-                    )
-                    continue
-
-                try:
-                    best = await redis_helper.select_best_ticket_by_ready_time(r, current_bakery_id)
-                    if not best or not bool(best.get("ready")):
-                        celery_logger.info(
-                            "auto_dispatch_ready_tickets no ready ticket",
-                            extra={"bakery_id": current_bakery_id, "best": best},
-                        )
-                        continue
-
-                    ticket_id = int(best["ticket_id"])
-
-                    order_key = redis_helper.REDIS_KEY_RESERVATION_ORDER.format(current_bakery_id)
-                    res_key = redis_helper.REDIS_KEY_RESERVATIONS.format(current_bakery_id)
-
-                    pipe = r.pipeline()
-                    pipe.hget(res_key, str(ticket_id))
-                    pipe.hdel(res_key, ticket_id)
-                    pipe.zrem(order_key, ticket_id)
-                    current_customer_reservation, r1, r2 = await pipe.execute()
-
-                    if not bool(r1 and r2):
-                        reservation_list = await redis_helper.get_bakery_reservations(
-                            r, current_bakery_id, fetch_from_redis_first=False
-                        )
-                        if not reservation_list:
-                            continue
-                        status, current_customer_reservation = await redis_helper.remove_customer_id_from_reservation(
-                            r, current_bakery_id, ticket_id
-                        )
-                        if not status:
-                            continue
-
-                    queue_state = await redis_helper.load_queue_state(r, current_bakery_id)
-                    queue_state.mark_ticket_served(ticket_id)
-                    await redis_helper.save_queue_state(r, current_bakery_id, queue_state)
-
-                    await redis_helper.add_customer_to_wait_list(
-                        r, current_bakery_id, ticket_id, reservations_str=current_customer_reservation
-                    )
-                    await redis_helper.set_user_current_ticket(r, current_bakery_id, ticket_id)
-                    await redis_helper.consume_ready_breads(r, current_bakery_id, ticket_id)
-                    await redis_helper.rebuild_prep_state(r, current_bakery_id)
-
-                    _, time_per_bread, upcoming_breads = await redis_helper.get_customer_ticket_data_pipe_without_reservations_with_upcoming_breads(
-                        r, current_bakery_id
-                    )
-
-                    from application import mqtt_client
-                    await mqtt_client.publish_ticket_job_background(
-                        bakery_id=current_bakery_id,
-                        ticket_id=ticket_id,
-                        token="does not matter",
-                        print_ticket=False,
-                        show_on_display=True,
-                    )
-
-                    db_waitlist_task = send_ticket_to_wait_list.delay(ticket_id, current_bakery_id, "auto_dispatch")
-                    celery_logger.info(
-                        "auto_dispatch_ready_tickets moved ticket to wait list",
-                        extra={
-                            "bakery_id": current_bakery_id,
-                            "ticket_id": ticket_id,
-                            "db_waitlist_task_id": db_waitlist_task.id,
-                        },
-                    )
-
-                    if time_per_bread and any(bread in time_per_bread.keys() for bread in (upcoming_breads or [])):
-                        await redis_helper.remove_customer_from_upcoming_customers(r, current_bakery_id, ticket_id)
-                        remove_customer_from_upcoming_customers.delay(ticket_id, current_bakery_id)
-
-                    with SessionLocal() as db:
-                        crud.consume_breads_for_customer_today(db, current_bakery_id, ticket_id)
-
-                    msg = (
-                        f"Bakery ID: {current_bakery_id}"
-                        f"\nTicket Number: {ticket_id}"
-                        f"\nAction: auto-dispatch to wait list"
-                    )
-                    report_to_admin_api.delay(msg, settings.BAKERY_TICKET_THREAD_ID)
-                finally:
-                    current_token = await r.get(lock_key)
-                    if current_token == lock_token:
-                        await r.delete(lock_key)
-
+                await dispatch_due_bakeries(r)
         finally:
-            await r.close()
+            try:
+                wake_at = await redis_helper.rearm_dispatch(r)
+                if wake_at is not None:
+                    arm_auto_dispatch(wake_at)
+            finally:
+                await r.close()
 
     asyncio.run(_task(bakery_id))
 
@@ -405,10 +615,51 @@ def calculate_new_time_per_bread(self, bakery_id):
     r.zrem(bread_diff_key, *[bread_index for bread_index, _ in zitems])
 
 
+@celery_app.task(bind=True)
+@handle_task_errors
+def compact_queue_states(self):
+    """Fold each bakery's queue event log into its snapshot (Redis + DB)."""
+
+    async def _task():
+        r = aioredis.from_url(
+            settings.REDIS_URL,
+            decode_responses=True
+        )
+        try:
+            with SessionLocal() as session:
+                bakery_ids = [int(b.bakery_id) for b in crud.get_all_active_bakeries(session)]
+
+            compacted = {}
+            for bakery_id in bakery_ids:
+                state = await redis_helper.compact_queue_state(
+                    r, bakery_id, archive_served=settings.QUEUE_STATE_WINDOWED
+                )
+                if state is not None:
+                    compacted[bakery_id] = state.to_dict()
+            return compacted
+        finally:
+            await r.close()
+
+    for bakery_id, state_dict in asyncio.run(_task()).items():
+        with session_scope() as db:
+            crud.upsert_queue_state_snapshot(db, bakery_id, state_dict)
+
+
 @celery_app.task(bind=True, autoretry_for=(Exception,), retry_kwargs={"max_retries": 3, "countdown": 5})
 @handle_task_errors
-def save_bread_to_db(self, ticket_id, bakery_id, baked_at_timestamp):
+def save_bread_to_db(self, ticket_id, bakery_id, baked_at_timestamp, seq=None, pressed_at=None):
     with session_scope() as db:
+        if seq is not None:
+            # Same path as the bread writer, so a retried task stores the bread once.
+            crud.create_breads_bulk(db, [{
+                "bakery_id": bakery_id,
+                "ticket_id": ticket_id,
+                "baked_at": baked_at_timestamp,
+                "seq": seq,
+                "pressed_at": pressed_at,
+            }])
+            return
+
         customer_id = None
         consumed = True
         if ticket_id is not None and ticket_id != 0:
@@ -421,21 +672,34 @@ def save_bread_to_db(self, ticket_id, bakery_id, baked_at_timestamp):
         crud.create_bread(db, bakery_id, customer_id, baked_at, consumed)
 
 
+def _project_urgent_log(bakery_id: int, urgent_id: str, status: str, ticket_id=None, breads=None):
+    # Keep the urgent_log projection (read by serve/summary endpoints) in step with UrgentBreadLog.
+    r = redis.from_url(settings.REDIS_URL, decode_responses=True)
+    try:
+        redis_helper.project_urgent_log_sync(
+            r, int(bakery_id), str(urgent_id), status, ticket_id=ticket_id, breads=breads
+        )
+    finally:
+        r.close()
+
+
 @celery_app.task(bind=True, autoretry_for=(Exception,), retry_kwargs={"max_retries": 3, "countdown": 5})
 @handle_task_errors
 def log_urgent_inject(self, bakery_id: int, urgent_id: str, ticket_id: int | None, bread_requirements: dict, reason: str | None = None):
     with session_scope() as db:
         bread_map = {str(k): int(v) for k, v in (bread_requirements or {}).items()}
-        crud.create_urgent_bread_log(
-            db,
-            bakery_id=int(bakery_id),
-            urgent_id=str(urgent_id),
-            ticket_id=int(ticket_id) if ticket_id is not None else None,
-            status="PENDING",
-            original_breads=bread_map,
-            remaining_breads=bread_map,
-            reason=str(reason or ""),
-        )
+        if not crud.urgent_bread_log_exists(db, bakery_id, urgent_id):
+            crud.create_urgent_bread_log(
+                db,
+                bakery_id=int(bakery_id),
+                urgent_id=str(urgent_id),
+                ticket_id=int(ticket_id) if ticket_id is not None else None,
+                status="PENDING",
+                original_breads=bread_map,
+                remaining_breads=bread_map,
+                reason=str(reason or ""),
+            )
+    _project_urgent_log(bakery_id, urgent_id, "PENDING", ticket_id=ticket_id, breads=bread_map)
 
 
 @celery_app.task(bind=True, autoretry_for=(Exception,), retry_kwargs={"max_retries": 3, "countdown": 5})
@@ -463,6 +727,7 @@ def log_urgent_edit(self, bakery_id: int, urgent_id: str, bread_requirements: di
                 remaining_breads=bread_map,
                 reason=str(reason or ""),
             )
+    _project_urgent_log(bakery_id, urgent_id, "PENDING", breads=bread_map)
 
 
 @celery_app.task(bind=True, autoretry_for=(Exception,), retry_kwargs={"max_retries": 3, "countdown": 5})
@@ -486,6 +751,7 @@ def log_urgent_cancel(self, bakery_id: int, urgent_id: str):
                 original_breads={},
                 remaining_breads={},
             )
+    _project_urgent_log(bakery_id, urgent_id, "CANCELLED")
 
 
 @celery_app.task(bind=True, autoretry_for=(Exception,), retry_kwargs={"max_retries": 3, "countdown": 5})
@@ -508,6 +774,7 @@ def log_urgent_processing(self, bakery_id: int, urgent_id: str):
                 original_breads={},
                 remaining_breads={},
             )
+    _project_urgent_log(bakery_id, urgent_id, "PROCESSING")
 
 
 @celery_app.task(bind=True, autoretry_for=(Exception,), retry_kwargs={"max_retries": 3, "countdown": 5})
@@ -523,3 +790,4 @@ def log_urgent_remaining(self, bakery_id: int, urgent_id: str, remaining_breads:
             remaining_breads=remaining_map,
             done=bool(done),
         )
+    _project_urgent_log(bakery_id, urgent_id, "DONE" if done else "PROCESSING")
@@ -64,7 +64,7 @@ async def create_user(user: schemas.SignUpRequirement, request: Request, respons
     for key, value in extra.items():
         msg += f"\n{key}: {value}"
 
-    tasks.report_to_admin_api.delay(msg, message_thread_id=settings.NEW_USER_THREAD_ID)
+    tasks.notify_admin(msg, message_thread_id=settings.NEW_USER_THREAD_ID)
 
     return {'msg': 'user created', 'user_id': create_user_db.user_id}
 
@@ -84,7 +84,7 @@ async def enter_number(user: schemas.LogInRequirement):
     code = str(generate_otp())
     task = tasks.send_otp.delay(phone, code)
     # TODO: REMOVE THIS IN PRODACTION
-    tasks.report_to_admin_api.delay(f"OTP CODE: {code}")
+    tasks.notify_admin(f"OTP CODE: {code}", category="otp")
     logger.info(f"{FILE_NAME}:enter_number", extra={"phone_number": phone})
     return {'status': 'OK', 'message': 'OTP sent','task_id': task.id}
 
@@ -126,7 +126,7 @@ async def verify_otp(request: Request, response: Response, data: schemas.VerifyO
                    f"\nClient IP: {client_ip}"
                    f"\nUser Agent: {user_agent}")
 
-        tasks.report_to_admin_api.delay(message, message_thread_id=settings.INFO_THREAD_ID)
+        tasks.notify_admin(message, message_thread_id=settings.INFO_THREAD_ID)
         step = 'login'
 
 
@@ -2,7 +2,6 @@ from fastapi import APIRouter, Request, HTTPException
 import json
 from fastapi.responses import RedirectResponse
 from application.helpers import endpoint_helper, redis_helper, token_helpers
-from application.algorithm import Algorithm
 from application.auth import decode_token
 from application.database import SessionLocal
 from application import crud, schemas
@@ -18,24 +17,6 @@ handle_errors = endpoint_helper.handle_endpoint_errors(FILE_NAME)
 
 
 
-async def _calculate_ready_status_for_res(r, bakery_id: int, user_breads: dict | None, bread_time_for_calc: dict, reservation_keys: list, reservation_number: int, reservation_dict_for_calc: dict):
-    """Isolated adapter for /res: supports legacy tuple or new dict return from helper."""
-    result = await redis_helper.calculate_ready_status(
-        r, bakery_id, user_breads, bread_time_for_calc, reservation_keys, reservation_number, reservation_dict_for_calc
-    )
-
-    if isinstance(result, dict):
-        return (
-            bool(result.get("ready", False)),
-            bool(result.get("accurate_time", True)),
-            result.get("wait_until"),
-        )
-
-    if isinstance(result, (list, tuple)) and len(result) >= 3:
-        return bool(result[0]), bool(result[1]), result[2]
-
-    raise HTTPException(status_code=500, detail="Unexpected ready-status result format")
-
 def _parse_count_vector(value):
     """Normalize Redis/DB count vector that may be a CSV string or python list."""
     if value is None:
@@ -72,34 +53,16 @@ def _as_text(v):
     return str(v)
 
 
-def _count_breads_by_ticket(all_breads):
-    breads_per_customer = {}
-    for bread_value in all_breads or []:
-        bread_value = _as_text(bread_value)
-        if not bread_value or ':' not in bread_value:
-            continue
-        try:
-            parts = str(bread_value).split(':')
-            if len(parts) < 2:
-                continue
-            ticket_id = int(parts[-1])
-        except Exception:
-            continue
-        breads_per_customer[ticket_id] = breads_per_customer.get(ticket_id, 0) + 1
-    return breads_per_customer
-
-
 async def _resolve_current_working_ticket_id(
     r,
     bakery_id: int,
     reservation_dict: dict[int, list[int]],
-    all_breads,
+    breads_per_customer: dict[int, int],
     prep_state_raw,
     urgent_processing_raw,
     base_done_raw,
     current_served_raw,
 ):
-    breads_per_customer = _count_breads_by_ticket(all_breads)
     base_done_ids = set(int(_as_text(x)) for x in (base_done_raw or []) if _as_text(x) is not None)
 
     locked_normal_ticket_id = None
@@ -181,35 +144,22 @@ async def queue_check(
 
     # Redis keys
     time_key = redis_helper.REDIS_KEY_TIME_PER_BREAD.format(bakery_id)
-    res_key = redis_helper.REDIS_KEY_RESERVATIONS.format(bakery_id)
     name_key = redis_helper.REDIS_KEY_BREAD_NAMES
     wait_list_key = redis_helper.REDIS_KEY_WAIT_LIST.format(bakery_id)
     served_key = redis_helper.REDIS_KEY_SERVED_TICKETS.format(bakery_id)
-    breads_key = redis_helper.REDIS_KEY_BREADS.format(bakery_id)
-    prep_state_key = redis_helper.REDIS_KEY_PREP_STATE.format(bakery_id)
-    urgent_prep_key = redis_helper.REDIS_KEY_URGENT_PREP_STATE.format(bakery_id)
-    base_done_key = redis_helper.REDIS_KEY_BASE_DONE.format(bakery_id)
-    current_served_key = redis_helper.REDIS_KEY_CURRENT_SERVED.format(bakery_id)
+    timeout_key = redis_helper.REDIS_KEY_TIMEOUT_SEC.format(bakery_id)
 
     user_current_ticket_raw = None
 
     pipe = r.pipeline()
     pipe.hgetall(time_key)
-    pipe.hgetall(res_key)
     pipe.hgetall(name_key)
     pipe.hget(wait_list_key, t)
     pipe.sismember(served_key, t)
-    pipe.zrangebyscore(breads_key, '-inf', '+inf')
-    pipe.get(prep_state_key)
-    pipe.get(urgent_prep_key)
-    pipe.smembers(base_done_key)
-    pipe.get(current_served_key)
-    time_per_bread_raw, reservations_map, bread_names_raw, wait_list_hit, is_served_flag, all_breads, prep_state_raw, urgent_processing_raw, base_done_raw, current_served_raw = await pipe.execute()
+    pipe.get(timeout_key)
+    time_per_bread_raw, bread_names_raw, wait_list_hit, is_served_flag, timeout_raw = await pipe.execute()
 
     bread_time = {int(k): int(v) for k, v in time_per_bread_raw.items()}
-    reservation_dict = {
-        int(k): _parse_count_vector(v) for k, v in reservations_map.items()
-    }
     bread_names = {int(k): v for k, v in bread_names_raw.items()}
     bread_ids_sorted = sorted(bread_time.keys())
 
@@ -240,11 +190,11 @@ async def queue_check(
             "user_breads": user_breads_persian,
         }
 
-    if not reservation_dict:
-        return {'msg': 'queue is empty'}
+    # Everything queue-dependent comes precomputed from the ETA table.
+    eta_meta, eta_row = await redis_helper.get_eta_table_fields(r, bakery_id, str(t))
 
-    reservation_keys = sorted(reservation_dict.keys())
-    algorithm_instance = Algorithm()
+    if not eta_meta or not eta_meta.get("size"):
+        return {'msg': 'queue is empty'}
 
     # /res should expose the latest ticket moved to wait list (user-facing current customer).
     # This key is updated when tickets are sent to wait list, including urgent-related flows.
@@ -255,80 +205,38 @@ async def queue_check(
         except (TypeError, ValueError):
             current_ticket_id = None
 
-    is_user_exist = t in reservation_keys
-
-    if not is_user_exist:
+    if eta_row is None:
         raise HTTPException(status_code=404, detail="Ticket does not Exist")
 
-    reservation_number = t if is_user_exist else reservation_keys[-1]
-
-    people_in_queue = sum(1 for key in reservation_keys if key < reservation_number)
+    timeout_second = int(timeout_raw) if timeout_raw is not None else await redis_helper.get_timeout_second(r, bakery_id)
+    in_queue_customers_time = int(eta_row["in_queue_s"]) + timeout_second
 
-    average_bread_time = sum(bread_time.values()) // len(bread_time)
+    calc_counts = [int(x) for x in eta_row["counts"]]
+    display_counts = calc_counts
+    if display_counts and all(int(x) == 0 for x in display_counts):
+        with SessionLocal() as db:
+            breads_map_db = crud.get_customer_breads_by_ticket_ids_today(db, bakery_id, [t])
+        bread_counts = breads_map_db.get(t, {})
+        display_counts = [int(bread_counts.get(int(bid), 0)) for bid in bread_ids_sorted]
 
-    bread_ids_sorted = sorted(bread_time.keys())
-    time_per_bread_list = [bread_time[k] for k in bread_ids_sorted]
-
-    in_queue_customers_time = await algorithm_instance.calculate_in_queue_customers_time(
-        reservation_keys,
-        reservation_number,
-        reservation_dict,
-        time_per_bread_list,
-        r=r,
-        bakery_id=bakery_id
-    )
-
-    empty_slot_time = algorithm_instance.compute_empty_slot_time(
-        reservation_keys,
-        reservation_number,
-        reservation_dict
-    ) // 2 * average_bread_time
-
-    urgent_by_ticket = await redis_helper.get_urgent_breads_by_ticket(r, bakery_id, {str(k): int(v) for k, v in bread_time.items()})
-    urgent_breads = urgent_by_ticket.get(int(t), {})
-
-    user_breads_persian = user_breads = None
-    if is_user_exist:
-
-        calc_counts = reservation_dict[reservation_number]
-        calc_user_breads = {bid: count for bid, count in zip(bread_ids_sorted, calc_counts)}
-
-        display_counts = calc_counts
-        if display_counts and all(int(x) == 0 for x in display_counts):
-            with SessionLocal() as db:
-                breads_map_db = crud.get_customer_breads_by_ticket_ids_today(db, bakery_id, [reservation_number])
-            bread_counts = breads_map_db.get(reservation_number, {})
-            display_counts = [int(bread_counts.get(int(bid), 0)) for bid in bread_ids_sorted]
-
-        user_breads_persian = {
-            bread_names.get(bid, str(bid)): count
-            for bid, count in zip(bread_ids_sorted, display_counts)
-        }
-        user_breads = {
-            bid: count
-            for bid, count in zip(bread_ids_sorted, calc_counts)
-        }
-
-    reservation_dict_for_calc = {
-        int(k): (",".join(map(str, v)) if isinstance(v, (list, tuple)) else str(v))
-        for k, v in reservation_dict.items()
+    user_breads_persian = {
+        bread_names.get(bid, str(bid)): count
+        for bid, count in zip(bread_ids_sorted, display_counts)
     }
 
-    bread_time_for_calc = {str(k): int(v) for k, v in bread_time.items()}
-
-    ready, accurate_time, wait_until = await _calculate_ready_status_for_res(
-        r, bakery_id, user_breads, bread_time_for_calc, reservation_keys, reservation_number, reservation_dict_for_calc
-    )
+    # Same figure calculate_ready_status reports: the ticket that will be ready first.
+    best = redis_helper.select_best_eta_ticket(eta_meta)
+    wait_until = int(best[1]) if best else 0
 
     return {
-        "ready": ready,
-        "accurate_time": accurate_time,
+        "ready": wait_until == 0,
+        "accurate_time": True,
         "wait_until": wait_until,
-        "people_in_queue": people_in_queue,
-        "empty_slot_time_avg": empty_slot_time,
+        "people_in_queue": int(eta_row["position"]),
+        "empty_slot_time_avg": int(eta_row["empty_slot_time_avg"]),
         "in_queue_customers_time": in_queue_customers_time,
         "user_breads": user_breads_persian,
-        "urgent_breads": urgent_breads,
+        "urgent_breads": eta_row.get("urgent_breads") or {},
         "current_ticket_id": current_ticket_id,
         "ticket_id": t,
         "customer_id": customer_id,
@@ -377,18 +285,16 @@ async def queue_until_ticket_summary(
     t = customer.ticket_id
 
     time_key = redis_helper.REDIS_KEY_TIME_PER_BREAD.format(bakery_id)
-    res_key = redis_helper.REDIS_KEY_RESERVATIONS.format(bakery_id)
     wait_list_key = redis_helper.REDIS_KEY_WAIT_LIST.format(bakery_id)
     served_key = redis_helper.REDIS_KEY_SERVED_TICKETS.format(bakery_id)
 
     pipe = r.pipeline()
-    pipe.hgetall(time_key)
-    pipe.hgetall(res_key)
+    pipe.exists(time_key)
     pipe.hget(wait_list_key, t)
     pipe.sismember(served_key, t)
-    time_per_bread_raw, reservations_map, wait_list_hit, is_served_flag = await pipe.execute()
+    has_breads, wait_list_hit, is_served_flag = await pipe.execute()
 
-    if not time_per_bread_raw:
+    if not has_breads:
         return {'msg': 'bakery does not exist or does not have any bread'}
 
     # First, report served or wait-list status (200) if applicable
@@ -405,24 +311,21 @@ async def queue_until_ticket_summary(
             "ticket_id": t,
         }
 
-    if not reservations_map:
+    eta_meta, eta_row, totals = await redis_helper.get_eta_table_fields(r, bakery_id, str(t), "_totals")
+
+    if not eta_meta or not eta_meta.get("size"):
         # Queue is empty, but user might be in wait list
         return {'msg': 'queue is empty'}
 
-    reservation_dict = {
-        int(k): _parse_count_vector(v) for k, v in reservations_map.items()
-    }
-
-    reservation_keys = sorted(reservation_dict.keys())
-
-    if t not in reservation_keys:
+    if eta_row is None:
         raise HTTPException(status_code=404, detail="Ticket does not Exist")
 
-    included_tickets = [key for key in reservation_keys if key < t]
+    # _totals is in ticket order, so the tickets before t are its first `position` entries.
+    included_tickets = (totals or [])[: int(eta_row["position"])]
 
     people_in_queue_until_this_ticket = len(included_tickets)
     tickets_and_their_bread_count = {
-        str(key): sum(reservation_dict[key]) for key in included_tickets
+        str(key): int(total) for key, total in included_tickets
     }
 
     return {
@@ -445,7 +348,7 @@ async def queue_all_ticket_summary(
     name_key = redis_helper.REDIS_KEY_BREAD_NAMES
     wait_list_key = redis_helper.REDIS_KEY_WAIT_LIST.format(bakery_id)
     served_key = redis_helper.REDIS_KEY_SERVED_TICKETS.format(bakery_id)
-    breads_key = redis_helper.REDIS_KEY_BREADS.format(bakery_id)
+    bread_counts_key = redis_helper.REDIS_KEY_BREAD_COUNTS.format(bakery_id)
     prep_state_key = redis_helper.REDIS_KEY_PREP_STATE.format(bakery_id)
     urgent_prep_key = redis_helper.REDIS_KEY_URGENT_PREP_STATE.format(bakery_id)
     base_done_key = redis_helper.REDIS_KEY_BASE_DONE.format(bakery_id)
@@ -457,12 +360,12 @@ async def queue_all_ticket_summary(
     pipe.hgetall(name_key)
     pipe.hgetall(wait_list_key)
     pipe.smembers(served_key)
-    pipe.zrangebyscore(breads_key, '-inf', '+inf')
+    pipe.hgetall(bread_counts_key)
     pipe.get(prep_state_key)
     pipe.get(urgent_prep_key)
     pipe.smembers(base_done_key)
     pipe.get(current_served_key)
-    time_per_bread_raw, reservations_map, bread_names_raw, wait_list_map, served_set, all_breads, prep_state_raw, urgent_processing_raw, base_done_raw, current_served_raw = await pipe.execute()
+    time_per_bread_raw, reservations_map, bread_names_raw, wait_list_map, served_set, bread_counts_raw, prep_state_raw, urgent_processing_raw, base_done_raw, current_served_raw = await pipe.execute()
 
     if not time_per_bread_raw:
         return {'msg': 'bakery does not exist or does not have any bread'}
@@ -492,9 +395,10 @@ async def queue_all_ticket_summary(
         token_map = crud.get_customer_tokens_by_ticket_ids_today(db, bakery_id, all_ticket_ids)
         note_map = crud.get_customer_notes_by_ticket_ids_today(db, bakery_id, all_ticket_ids)
         breads_map_db = crud.get_customer_breads_by_ticket_ids_today(db, bakery_id, all_ticket_ids)
-        urgent_rows = crud.get_today_urgent_bread_logs(db, bakery_id)
 
-    breads_per_customer = _count_breads_by_ticket(all_breads)
+    urgent_log_by_ticket = await redis_helper.get_urgent_log_summary(r, bakery_id, all_ticket_ids)
+
+    breads_per_customer, _ = redis_helper.decode_bread_index(bread_counts_raw, None)
 
     base_done_ids = set(int(_as_text(x)) for x in (base_done_raw or []) if _as_text(x) is not None)
 
@@ -506,7 +410,7 @@ async def queue_all_ticket_summary(
         r=r,
         bakery_id=bakery_id,
         reservation_dict=reservation_dict,
-        all_breads=all_breads,
+        breads_per_customer=breads_per_customer,
         prep_state_raw=prep_state_raw,
         urgent_processing_raw=urgent_processing_raw,
         base_done_raw=base_done_raw,
@@ -516,50 +420,30 @@ async def queue_all_ticket_summary(
     all_ticket_ids_set = set(int(x) for x in all_ticket_ids)
     if current_working_ticket_id is not None and int(current_working_ticket_id) not in all_ticket_ids_set:
         current_working_ticket_id = None
-    def _safe_json_map(raw_value):
-        if not raw_value:
-            return {}
-        try:
-            payload = json.loads(raw_value)
-            return payload if isinstance(payload, dict) else {}
-        except Exception:
-            return {}
-
     urgent_grouped_by_ticket = {}
-    for row in urgent_rows or []:
-        if str(getattr(row, "status", "")) == "CANCELLED":
-            continue
-        if getattr(row, "ticket_id", None) is None:
-            continue
-        try:
-            tid_int = int(row.ticket_id)
-        except Exception:
-            continue
-        if tid_int not in all_ticket_ids_set:
-            continue
-
-        urgent_map = _safe_json_map(getattr(row, "original_breads_json", None))
-        named = {}
-        for bid_raw, count in (urgent_map or {}).items():
-            try:
-                c = int(count)
-            except Exception:
-                c = 0
-            if c <= 0:
-                continue
-            try:
-                bid_int = int(bid_raw)
-            except Exception:
-                bid_int = None
-            key = bread_names.get(int(bid_int), str(bid_int)) if bid_int is not None else str(bid_raw)
-            named[str(key)] = int(named.get(str(key), 0)) + int(c)
-
-        if named:
-            urgent_grouped_by_ticket.setdefault(int(tid_int), {})[str(getattr(row, "urgent_id", ""))] = {
-                "breads": named,
-                "is_prepared": str(getattr(row, "status", "")) == "DONE",
-                "reason": "",
-            }
+    for tid_int, urgent_logs in urgent_log_by_ticket.items():
+        for urgent_id, entry in urgent_logs.items():
+            named = {}
+            for bid_raw, count in (entry["breads"] or {}).items():
+                try:
+                    c = int(count)
+                except Exception:
+                    c = 0
+                if c <= 0:
+                    continue
+                try:
+                    bid_int = int(bid_raw)
+                except Exception:
+                    bid_int = None
+                key = bread_names.get(int(bid_int), str(bid_int)) if bid_int is not None else str(bid_raw)
+                named[str(key)] = int(named.get(str(key), 0)) + int(c)
+
+            if named:
+                urgent_grouped_by_ticket.setdefault(int(tid_int), {})[str(urgent_id)] = {
+                    "breads": named,
+                    "is_prepared": entry["status"] == "DONE",
+                    "reason": "",
+                }
 
     urgent_ids_all = []
     for urgent_map in (urgent_grouped_by_ticket or {}).values():